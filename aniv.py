@@ -1,93 +1,250 @@
 import signal
 import os
-import ujson
+import sys
 import random
 import re
 import asyncio
 import time
-import shutil
 import datetime
-import aiofiles
 import copy
+import sqlite3
 from twitchio.ext import commands
-from auth import Auth
+from auth import Auth, TokenManager, TWITCH_OAUTH_URL
+from model import LayeredModel, BatchSampler
+from suffix_model import SuffixArrayModel, write_suffix_model
+from journal import DeltaJournal
+from provenance import ProvenanceLog
+from snapshot import Snapshot, merge_layers, write_snapshot, convert_json_snapshot
+from filters import ContentFilter
+from executor import InlineModel, ModelExecutor
+from model_service import ModelClient, serve
+from trainer import train
+from metrics import Registry, MetricsServer
+from logger import BufferedLogger
+from store import SettingsStore
+from pregen import PregenCache
+from ingest import IngestQueue, DROP_OLDEST
+from chat import MessagePreprocessor, RollingWindow
+from sharding import JoinLimiter, JOIN_RATE, JOIN_BURST, owner_of, shard_channels
 from concurrent.futures import ThreadPoolExecutor
-from googletrans import Translator, LANGUAGES
+from googletrans import LANGUAGES
+from translate import AsyncTranslator, GoogleTranslateBackend
+
+LOGGER = BufferedLogger('log.jsonl')
 
 class Utils():
-    def load_json_file(filename, key=None):
-        with open(filename, 'r') as f:
-            res = ujson.load(f)
-            if key:
-                res = res[key]
-            return res
-            
-    def save_json_file(srcfile, new_contents, backup=True):
-        try:
-            if backup:
-                shutil.copy2(srcfile, 'data/backups')
-            with open(srcfile, 'w', encoding='utf-8') as f:
-                ujson.dump(new_contents, f, indent=4)
-        except Exception as e:
-            print("Exception occured during save_json_file:",srcfile,"- Exception:",e)
-            return False
-            
-        return True
-        
-    def log(*msg):
+    def log(*msg, **fields):
+        # extra keyword fields are written alongside the message in log.jsonl
         msg = ' '.join(map(str, msg))
         print(msg)
-        now = datetime.datetime.now()
-        timestamp = now.strftime("%m/%d/%Y %H:%M:%S")
-        fmsg = f'[{timestamp}] {msg}'
-        with open('log.txt', 'a', encoding='utf-8') as f:
-            f.write(fmsg + '\n')
+        LOGGER.log(msg, **fields)
 
 class Markov():
-    def __init__(self):
-        self.__dict = dict()
+    def __init__(self, memory_budget=None, decay_interval=None, engine='table', metrics=None, gen_batch=128, provenance=False):
         self.__order = 10
+        # engine 'table' keeps exact order-10 counts; 'suffix' keeps the learned
+        # text with a suffix array and backs off to shorter contexts
+        if engine not in ('table', 'suffix'):
+            raise ValueError(f"Unknown model engine '{engine}'")
+        self.__engine = engine
+        # memory_budget (bytes) caps the snapshot plus overlays: overlays past
+        # a quarter of it force an early compaction, and compaction evicts the
+        # least recently used contexts to keep the snapshot within the rest.
+        # The suffix engine compacts once it has grown by a quarter since the
+        # last compaction, which ages out its oldest text to fit the rest
+        # (down to the newest chunk, a million characters or about 5 MB).
+        # decay_interval (seconds) halves every count on that schedule.
+        self.__memory_budget = memory_budget
+        self.__decay_interval = decay_interval
+        self.__OVERLAY_BUDGET_FRACTION = 0.25
+        self.__maintenance_stats = {
+            'compactions': 0,
+            'evicted_contexts': 0,
+            'decayed_contexts': 0,
+            'decays': 0,
+            'evicted_chars': 0,
+        }
+        # suffix engine size after the last compaction
+        self.__compacted_bytes = 0
+        self.__model = self.__new_model()
+        self.__snapshot_file = 'markov_dict.bin'
+        self.__suffix_file = 'markov_suffix.bin'
+        self.__legacy_snapshot_file = 'markov_dict.txt'
+        self.__journal = DeltaJournal('markov_journal')
         self.__OUTPUT_MAX = 200
         self.__MAX_GEN_ATTEMPTS = 20
-        self.__ignore_list = Utils.load_json_file('data/user_ignore_list.json', 'ignore_list')
-        self.__channel_ignore_list = Utils.load_json_file('data/channel_ignore_list.json', 'ignore_list')
-        self.__filter_list = Utils.load_json_file('data/filter.json', 'filter_list')
+        # requests for at least gen_batch candidates are drawn together by the
+        # vectorized sampler (table engine, needs numpy; 0 turns it off). Its
+        # numpy overhead per character only pays off from about 128 candidates
+        # (bench.py batch), so gen's own attempts never use it.
+        self.__gen_batch = gen_batch if gen_batch > 0 and engine == 'table' and BatchSampler is not None else None
+        self.__filters = ContentFilter()
+        # provenance keeps who taught the model what, so chat from users,
+        # channels and words added to the filters later can be unlearned
+        self.__provenance = None
+        if provenance:
+            if engine != 'table':
+                raise ValueError("Provenance needs the table engine: the suffix engine can't unlearn")
+            self.__provenance = ProvenanceLog(order=self.__order)
+        metrics = metrics if metrics is not None else Registry(enabled=False)
+        self.__gen_calls = metrics.counter('gen_total', 'Calls to Markov.gen')
+        self.__gen_unknown = metrics.counter('gen_unknown_context_total', 'Markov.gen calls whose context was never learned')
+        self.__gen_attempts = metrics.counter('gen_attempts_total', 'Generation attempts, including ones the filter rejected')
+        self.__gen_filtered = metrics.counter('gen_filtered_total', 'Generated messages rejected by the content filter')
+        self.__gen_seconds = metrics.histogram('gen_seconds', 'Time spent in Markov.gen')
+        self.__learned_chars = metrics.counter('learned_chars_total', 'Characters of chat learned')
 
-    def is_safe_to_learn(self, channel, name, msg):
-        if channel.lower() in self.__channel_ignore_list:
-            return False
-        if name.lower() in self.__ignore_list:
-            return False
-        if any([(filter.lower() in msg.lower()) for filter in self.__filter_list]):
-            return False
-            
-        return True
+    def get_order(self):
+        return self.__order
 
-    def learn_from_buffer(self, data):
-        for i in range(len(data) - self.__order):
-            key = data[i:i+self.__order]
-            char = data[i+self.__order]
-                
-            if not key in self.__dict:
-                self.__dict[key] = dict()
-            if not char in self.__dict[key]:
-                self.__dict[key][char] = 0
-            self.__dict[key][char] += 1
-        
+    def is_safe_to_learn(self, channel, name, msg, lowered=False):
+        return self.__filters.is_safe_to_learn(channel, name, msg, lowered)
+
+    def reload_filters(self, force=False):
+        return self.__filters.reload(force)
+
+    def learn_from_buffer(self, data, source=None):
+        # source is (channel, [(user, length), ...]) for the messages data
+        # ends with, kept when provenance is on
+        if len(data) > self.__order:
+            self.__model.learn(data)
+            self.__journal.record(data)
+            self.__learned_chars.inc(len(data) - self.__order)
+            if self.__provenance is not None and source is not None:
+                self.__provenance.record(source[0], data, source[1])
         return data[-self.__order:]
 
+    def unlearn_from_buffer(self, data):
+        removed = 0
+        if len(data) > self.__order:
+            removed = self.__model.unlearn(data)
+            self.__journal.record_unlearn(data)
+        return removed
+
+    def get_provenance(self):
+        return self.__provenance
+
+    def sync_provenance(self, model):
+        # unlearns, through model, chat from anything added to the ignore
+        # lists or the filters since the last call; returns the task or None
+        if self.__provenance is None:
+            return None
+        return self.__provenance.sync(model, self.__filters.ignored_users(), self.__filters.ignored_channels(), self.__filters.patterns())
+
     async def save_buffers(self):
-        async with aiofiles.open('markov_dict.txt', 'w') as f:
-            await f.write(ujson.dumps({'dict': self.__dict}))
-            await f.flush()
+        # appends only what was learned since the last call
+        await self.__journal.flush()
+        if self.__provenance is not None:
+            await self.__provenance.flush()
+
+    def save_buffers_sync(self):
+        self.__journal.flush_sync()
+        if self.__provenance is not None:
+            self.__provenance.flush_sync()
+
+    async def compact(self):
+        # fold the journal into a fresh snapshot; the frozen overlays are
+        # read-only, so learning carries on in a new overlay meanwhile
+        compaction = self.begin_compaction()
+        await self.save_buffers()
+        result = await asyncio.get_event_loop().run_in_executor(None, self.write_compaction, compaction)
+        self.finish_compaction(compaction, result)
+
+    def needs_compaction(self):
+        if self.__memory_budget is None:
+            return False
+        if self.__engine == 'suffix':
+            return self.__model.stats()['resident_bytes'] - self.__compacted_bytes > self.__memory_budget * self.__OVERLAY_BUDGET_FRACTION
+        return self.__model.overlay_bytes() > self.__memory_budget * self.__OVERLAY_BUDGET_FRACTION
+
+    def begin_compaction(self):
+        segment = self.__journal.rotate()
+        if self.__engine == 'suffix':
+            return segment, self.__model.view()
+        base = self.__model.get_base()
+        # a copy: gen keeps marking rows in the live bitmap, and every pass
+        # of the write has to see the same eviction groups
+        touched = bytes(self.__model.get_touched())
+        frozen = self.__model.freeze()
+        return segment, base, touched, frozen
+
+    def write_compaction(self, compaction):
+        # only reads the old base and the frozen overlays, so it is safe to run
+        # on any thread while learning continues
+        max_bytes = None
+        if self.__memory_budget is not None:
+            max_bytes = self.__memory_budget * (1 - self.__OVERLAY_BUDGET_FRACTION)
+        if self.__engine == 'suffix':
+            segment, view = compaction
+            return write_suffix_model(self.__suffix_file, self.__order, segment, view, max_bytes)
+        segment, base, touched, frozen = compaction
+        epoch = base.get_epoch() + 1 if base is not None else 1
+        decayed_at = base.get_decayed_at() if base is not None else 0
+        now = time.time()
+        decay = False
+        if self.__decay_interval is not None:
+            if decayed_at == 0:
+                decayed_at = now
+            elif now - decayed_at >= self.__decay_interval:
+                decay = True
+                decayed_at = now
+        result = write_snapshot(self.__snapshot_file, self.__order, segment, merge_layers(base, frozen, touched, decay), epoch, decayed_at, max_bytes)
+        result['decayed'] = decay
+        return result
+
+    def finish_compaction(self, compaction, result):
+        if self.__engine == 'suffix':
+            segment, view = compaction
+            self.__model.apply_compaction(view, result)
+            self.__journal.discard(segment)
+            self.__compacted_bytes = self.__model.stats()['resident_bytes']
+            self.__maintenance_stats['compactions'] += 1
+            self.__maintenance_stats['evicted_chars'] += result['evicted_chars']
+            return
+        segment, base, touched, frozen = compaction
+        old = self.__model.replace_base(Snapshot(self.__snapshot_file), frozen)
+        if old is not None:
+            old.close()
+        self.__journal.discard(segment)
+        self.__maintenance_stats['compactions'] += 1
+        self.__maintenance_stats['evicted_contexts'] += result['evicted']
+        self.__maintenance_stats['decayed_contexts'] += result['dropped']
+        self.__maintenance_stats['decays'] += 1 if result['decayed'] else 0
+        self.__maintenance_stats['last_compaction'] = result
 
     def load(self):
-        with open('markov_dict.txt', 'r') as f:
-            r = ujson.loads(f.read())
-            self.__dict = r['dict']
+        if self.__engine == 'suffix':
+            model = self.__new_model()
+            segment = model.load(self.__suffix_file) if os.path.exists(self.__suffix_file) else 0
+            self.__journal.replay(segment, lambda entry: self.__replay(model, entry))
+            model.index()
+            self.__model = model
+            # a model loaded over budget compacts as soon as it is checked
+            resident = model.stats()['resident_bytes']
+            if self.__memory_budget is not None:
+                resident = min(resident, self.__memory_budget * (1 - self.__OVERLAY_BUDGET_FRACTION))
+            self.__compacted_bytes = resident
+            return
+        if not os.path.exists(self.__snapshot_file):
+            if os.path.exists(self.__legacy_snapshot_file):
+                print(f"Converting {self.__legacy_snapshot_file} to {self.__snapshot_file}...")
+                convert_json_snapshot(self.__legacy_snapshot_file, self.__snapshot_file, self.__order)
+            else:
+                write_snapshot(self.__snapshot_file, self.__order, 0, merge_layers(None, []))
+        snapshot = Snapshot(self.__snapshot_file)
+        model = LayeredModel(self.__order, snapshot)
+        self.__journal.replay(snapshot.get_journal_segment(), lambda entry: self.__replay(model, entry))
+        self.__model = model
+
+    def stats(self):
+        stats = self.__model.stats()
+        stats.update(self.__maintenance_stats)
+        if self.__provenance is not None:
+            stats.update(self.__provenance.stats())
+        return stats
             
     def hasResponse(self, msg):
-        return msg[-self.__order:] in self.__dict
+        return msg[-self.__order:] in self.__model
         
     def getKey(self, msg):
         return msg[-self.__order:].replace("\n", "\\n")
@@ -96,36 +253,72 @@ class Markov():
         return msg[-self.__order:]
             
     def gen(self, inp):
+        t = time.perf_counter()
         attemptCount = 0
         inp = inp[-self.__order:]
+        self.__gen_calls.inc()
         
-        if not inp in self.__dict:
+        if not inp in self.__model:
+            self.__gen_unknown.inc()
             return None
             
+        prefix = inp if len(inp) > 0 and inp[-1] != '\n' else ''
         while attemptCount < self.__MAX_GEN_ATTEMPTS:
-            output = ""
-            if len(inp) > 0:
-                output = '' if inp[-1] == '\n' else inp
-                
-            for i in range(self.__OUTPUT_MAX):
-                #print('DEBUG:',inp,'-',self.__dict[inp])
-                mapping = self.__dict[inp]
-                char = random.choices(list(mapping.keys()), list(mapping.values()))[0]
-                output += char
-                if char == '\n':
-                    break
-                inp = inp[1:] + char
-            output = output.rstrip()
-            if any([(filter.lower() in output.lower()) for filter in self.__filter_list]):
+            self.__gen_attempts.inc()
+            output = self.__gen_one(inp, prefix)
+            if self.__filters.is_filtered(output):
+                self.__gen_filtered.inc()
                 attemptCount += 1
             else:
                 break
                 
-        
+        self.__gen_seconds.observe(time.perf_counter() - t)
         return output
+
+    def gen_candidates(self, inp, k):
+        # k candidates generated together, minus the ones the filter rejects;
+        # None when the context was never learned
+        inp = inp[-self.__order:]
+        if not inp in self.__model:
+            return None
+        return [output for output in self.__candidates(inp, k) if not self.__filters.is_filtered(output)]
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __candidates(self, inp, k):
+        prefix = inp if len(inp) > 0 and inp[-1] != '\n' else ''
+        if self.__gen_batch is not None and k >= self.__gen_batch:
+            outputs = self.__model.sample_batch(inp, k, self.__OUTPUT_MAX)
+            if outputs is not None:
+                return [(prefix + output).rstrip() for output in outputs]
+        return [self.__gen_one(inp, prefix) for _ in range(k)]
+
+    def __gen_one(self, inp, prefix):
+        output = prefix
+        ctx = inp
+        for i in range(self.__OUTPUT_MAX):
+            char, ctx = self.__model.step(ctx)
+            if char is None:
+                break
+            output += char
+            if char == '\n':
+                break
+        return output.rstrip()
+
+    def __replay(self, model, entry):
+        if 'learn' in entry:
+            model.learn(entry['learn'])
+        elif self.__engine == 'table':
+            model.unlearn(entry['unlearn'])
+
+    def __new_model(self):
+        if self.__engine == 'suffix':
+            return SuffixArrayModel(self.__order)
+        return LayeredModel(self.__order)
         
 class UserSettings():
-    def __init__(self, settings_file):
+    def __init__(self, store, translator=None):
         self.__MIN_MESSAGES_PER_POST = 14
         self.__MAX_MESSAGES_PER_POST = 200
         self.__default_post_settings = {
@@ -133,9 +326,9 @@ class UserSettings():
                 "post_max": 70,
                 "translate": []
             }
-        self.__settings_file = settings_file
-        self.__post_settings = Utils.load_json_file(settings_file)
-        self.__translator = Translator()
+        self.__store = store
+        self.__post_settings = store.load_settings()
+        self.__translator = translator or AsyncTranslator(GoogleTranslateBackend())
     
     def clamp_post_rate(self, rate):
         return max(self.__MIN_MESSAGES_PER_POST, min(rate, self.__MAX_MESSAGES_PER_POST))
@@ -143,7 +336,7 @@ class UserSettings():
     def get_post_settings(self, channel):
         if channel in self.__post_settings:
             return self.__post_settings[channel]
-        return self.__post_settings['default']
+        return self.__post_settings.get('default', self.__default_post_settings)
         
     def get_or_create_post_settings(self, channel):
         if not channel in self.__post_settings:
@@ -166,10 +359,12 @@ class UserSettings():
         post_settings = self.get_or_create_post_settings(channel)
         post_settings["post_min"] = min
         post_settings["post_max"] = max
+        self.__store.put_settings(channel, post_settings)
         
     def set_translation(self, channel, languages):
         post_settings = self.get_or_create_post_settings(channel)
         post_settings["translate"] = languages
+        self.__store.put_settings(channel, post_settings)
             
         return None
         
@@ -180,61 +375,164 @@ class UserSettings():
             if len(translations) > 0:
                 return random.choice(translations)
         
-    def translate_message(self, channel, msg):
+    async def translate_message(self, channel, msg):
         if channel in self.__post_settings:
             if 'translate' in self.__post_settings[channel]:
                 if not re.match("^!\w+", msg):
                     translate_lang = self.get_translate_lang(self.__post_settings[channel]['translate'])
                     if translate_lang:
-                        d = self.__translator.detect(msg)
-                        if d.lang != translate_lang:
-                            msg = self.__translator.translate(msg, translate_lang).text
+                        msg = await self.__translator.translate(msg, translate_lang)
         return msg
-        
-    def save(self):
-        return Utils.save_json_file(self.__settings_file, self.__post_settings)
+
+    def translation_stats(self):
+        return self.__translator.stats()
         
 class Bot(commands.Bot):
     
-    def __init__(self, in_markov):   
+    def __init__(self, in_markov, threaded=True, metrics=None, channels=None, roster=None, model=None, join_limiter=None, shard=0, store=None, pregen=None, ingest_policy=DROP_OLDEST, peers=None, process=0, processes=1, auth=None):   
         self.__MAX_CHANNEL_JOIN_LIMIT = 19
-        self.auth = Auth('auth.json')
+        # one Auth per process, shared with the shards and the token manager
+        # so a refreshed token is seen by all of them
+        self.auth = auth if auth is not None else Auth('auth.json')
         
-        self.__user_settings = UserSettings('data/channel_settings.json')
+        # channel settings and the channel list, shared by all shards
+        self.__store = store if store is not None else SettingsStore()
+        self.__user_settings = UserSettings(self.__store)
         
-        loaded_channels = Utils.load_json_file('data/channels.json', 'channels')
-        self.__channels = loaded_channels[:self.__MAX_CHANNEL_JOIN_LIMIT]
-        self.__channel_join_queue = loaded_channels[self.__MAX_CHANNEL_JOIN_LIMIT:]
+        # roster is every channel the bot belongs in, as kept in the store and
+        # shared by all shards; channels are the ones this connection
+        # handles. Shard 0 also flushes and compacts the model.
+        self.__roster = roster if roster is not None else self.__store.get_channels()
+        loaded_channels = channels if channels is not None else self.__roster
+        self.__shard = shard
+        # every shard's bot in shard order, this one included; a channel is
+        # joined and left by the shard that owns it
+        self.__peers = peers if peers is not None else [self]
+        # with several bot processes this one owns the channels
+        # owner_of(channel, shards, processes) gives it; the others are
+        # joined by their own process, which finds them in the store
+        self.__process = process
+        self.__processes = processes
+        # joins are rate limited per account, so shards share one limiter;
+        # every channel is joined by process_channel_joins once connected, so
+        # the limiter sees each JOIN; it is stamped when the server answers
+        self.__join_limiter = join_limiter if join_limiter is not None else JoinLimiter()
+        self.__unanswered_joins = set()
+        self.__channels = []
+        self.__channel_join_queue = list(loaded_channels)
         
-        self.__channels_to_learn_from = dict()
-        
-        to_join = loaded_channels[:self.__MAX_CHANNEL_JOIN_LIMIT]
         super().__init__(
             token=self.auth.get_irc_token(),
             nick=self.auth.get_user(),
-            prefix='!',
-            initial_channels=to_join
+            prefix='!'
         )
         
-        Utils.log(f"Joined {len(to_join)} of {len(loaded_channels)} loaded channels:",", ".join(to_join))
+        Utils.log(f"Queued {len(loaded_channels)} loaded channels to join", shard=shard)
         
-        self.__last_join_time = datetime.datetime.now().timestamp()
         self.__last_dict_save_time = datetime.datetime.now().timestamp()
-        self.__new_channel_added = False
+        self.__last_compaction_time = self.__last_dict_save_time
+        self.__JOURNAL_FLUSH_INTERVAL = 5
+        self.__COMPACTION_INTERVAL = 1800
+        self.__compaction_task = None
+        self.__FILTER_RELOAD_INTERVAL = 10
+        self.__last_filter_reload_time = self.__last_dict_save_time
+        self.__ROSTER_SYNC_INTERVAL = 10
+        self.__last_roster_sync_time = self.__last_dict_save_time
         self.__longest_username = self.get_longest_username()
         
         self.msg_data = dict()
         self.markov = in_markov
+        # every line is normalized once on arrival (see chat.py)
+        self.__preprocessor = MessagePreprocessor(self.auth.get_user(), in_markov)
+        # learning and generation run on a worker thread unless threaded=False;
+        # shards pass in the one model front they all share
+        if model is not None:
+            self.model = model
+        else:
+            self.model = ModelExecutor(in_markov) if threaded else InlineModel(in_markov)
+        
+        # optional PregenCache; candidates are prepared on the message before
+        # a post is due, so the post answers the context as of that message
+        self.__pregen = pregen
         
         self.__percent_chance_to_tag_user = 8
         self.__percent_chance_to_respond_to_tag = 1
+        # seconds to wait before posting, (min, max)
+        self.reply_delay = (3, 8)
+        self.mention_reply_delay = (3, 6)
+
+        self.metrics = metrics if metrics is not None else Registry(enabled=False)
+        self.__messages = self.metrics.counter('messages_total', 'Chat messages handled')
+        self.__message_seconds = self.metrics.histogram('chat_message_seconds', 'Time to handle a chat message, excluding the delay before replying')
+        self.__posts = self.metrics.counter('posts_total', 'Generated messages posted')
+        self.__save_seconds = self.metrics.histogram('journal_flush_seconds', 'Time to flush learned chat to the journal')
+        self.__compaction_seconds = self.metrics.histogram('compaction_seconds', 'Time to fold the journal into a new snapshot', (1, 5, 10, 30, 60, 120, 300, 600))
+        shard_label = {'shard': str(shard)}
+        self.__join_queue_length = self.metrics.gauge('join_queue_length', 'Channels waiting to be joined', shard_label)
+        self.__active_channels = self.metrics.gauge('active_channels', 'Channels that have sent chat since startup', shard_label)
+        self.__pending_learn_channels = self.metrics.gauge('pending_learn_channels', 'Channels with chat not yet learned', shard_label)
+        self.__ingest_queued_chars = self.metrics.gauge('ingest_queued_chars', 'Characters of chat waiting to be learned', shard_label)
+        self.__ingest_max_lag = self.metrics.gauge('ingest_max_lag_seconds', 'Age of the oldest chat waiting to be learned in any channel', shard_label)
+        self.__model_queue_depth = self.metrics.gauge('model_queue_depth', 'Calls waiting on the model worker')
+        self.metrics.add_collector(self.collect_metrics)
+        
+        # chat waits here to be learned, in a bounded queue per channel; a
+        # channel's pre-generated replies are redone once its chat is learned
+        on_learned = pregen.refresh if pregen is not None else None
+        self.__ingest = IngestQueue(self.model, order=in_markov.get_order(), policy=ingest_policy, metrics=self.metrics, on_learned=on_learned)
 
     def get_longest_username(self):
-        return max(len(x) for x in self.__channels+self.__channel_join_queue)
+        return max((len(x) for x in self.__channels+self.__channel_join_queue), default=0)
+
+    def get_shard(self):
+        return self.__shard
+
+    def get_pregen(self):
+        return self.__pregen
+
+    def owner(self, channel):
+        # the shard that joins channel, or None when another process does
+        process, shard = owner_of(channel, len(self.__peers), self.__processes)
+        return self.__peers[shard] if process == self.__process else None
+
+    def get_ingest(self):
+        return self.__ingest
+
+    def queue_join(self, channels):
+        # joined by process_channel_joins as the join limiter allows
+        for channel in channels:
+            if not channel in self.__channels and not channel in self.__channel_join_queue:
+                self.__channel_join_queue.append(channel)
+        self.__longest_username = self.get_longest_username()
+
+    def has_channel(self, channel):
+        return channel in self.__channels or channel in self.__channel_join_queue
+
+    async def part_channel(self, channel):
+        if channel in self.__roster:
+            self.__roster.remove(channel)
+            self.__store.remove_channel(channel)
+        if self.__pregen is not None:
+            self.__pregen.discard(channel)
+        self.__ingest.discard(channel)
+        if channel in self.__channel_join_queue:
+            self.__channel_join_queue.remove(channel)
+        self.__longest_username = self.get_longest_username()
+        if channel in self.__channels:
+            self.__channels.remove(channel)
+            Utils.log("*** Left channel", channel, event='part', channel=channel, shard=self.__shard)
+            await self._connection.send(f"PART #{channel}\r\n")
 
     async def event_ready(self):
         print('Connected!')
 
+    # the join limiter counts a join from the server's answer to it
+    async def event_channel_joined(self, channel):
+        self.__join_answered(channel.name)
+
+    async def event_channel_join_failure(self, channel):
+        self.__join_answered(channel)
+
     async def event_raw_data(self, data):
         #print(data)
         pass
@@ -244,95 +542,124 @@ class Bot(commands.Bot):
 
     async def send_message(self, channel, message):
         channel = self.get_channel(channel)
-        msg = self.markov.gen(message)
+        msg = await self.model.gen(message)
         if msg:
-            msg = self.__user_settings.translate_message(channel.name.lower(), msg)
-            Utils.log("Sending:", msg)
+            msg = await self.__user_settings.translate_message(channel.name.lower(), msg)
+            Utils.log("Sending:", msg, event='send', channel=channel.name.lower(), message=msg)
             await channel.send(msg)
 
-    async def handle_chat_message(self, message, channel):
+    async def handle_chat_message(self, record):
+        message = record.message
+        channel = record.channel
         if channel not in self.msg_data:
             self.msg_data[channel] = {
                 'msg_count': 0,
                 'msg_post_rate': random.randint(10, 18),
                 'last_user': '',
                 'reply_msg': '',
-                'datastream': '',
-                'msgstream': '',
+                # the last `order` characters of the channel's chat
+                'msgstream': RollingWindow(self.markov.get_order()),
+                # set while a post is being generated, so chat arriving
+                # meanwhile doesn't start another one
+                'posting': False,
             }
-            Utils.log(channel.ljust(self.__longest_username), ':', 'posting in',self.msg_data[channel]['msg_post_rate'])
+            Utils.log(channel.ljust(self.__longest_username), ':', 'posting in',self.msg_data[channel]['msg_post_rate'], event='new_channel', channel=channel)
             
         channel_data = self.msg_data[channel]
+        t = time.perf_counter()
+        reply = None
         
-        if f'@{self.auth.get_user().lower()}' in message.content.lower():
+        if record.mentioned:
             if random.randint(0,99) < self.__percent_chance_to_respond_to_tag:
-                msg = re.sub(f'\\s?@{self.auth.get_user().lower()}\\s?', '', message.content.lower())
-                new_msg = self.markov.gen(msg + '\n')
+                msg = self.__preprocessor.strip_mention(record)
+                new_msg = await self.model.gen(msg + '\n')
                 if new_msg:
                     new_msg = f"@{message.author.display_name} {new_msg}"
-                    Utils.log(f"{channel.ljust(self.__longest_username)}: ({channel_data['msg_post_rate']})[{markov.getKey(msg).rstrip()}][{message.author.display_name}] {new_msg}")
-                    await asyncio.sleep(random.randint(3, 6))
-                    await message.channel.send(new_msg)
-                    return
+                    Utils.log(f"{channel.ljust(self.__longest_username)}: ({channel_data['msg_post_rate']})[{self.markov.getKey(msg).rstrip()}][{message.author.display_name}] {new_msg}", event='mention_reply', channel=channel, user=message.author.display_name, key=self.markov.trimDataStream(msg), message=new_msg)
+                    reply = (new_msg, self.mention_reply_delay)
         
-        channel_data['msg_count'] += 1
-        channel_data['msgstream'] = self.markov.trimDataStream(channel_data['msgstream'] + message.content + "\n")
-        if self.markov.is_safe_to_learn(channel, message.author.name, message.content):
-            channel_data['datastream'] = channel_data['datastream'] + message.content + "\n"
-            self.__channels_to_learn_from[channel] = True
+        if reply is None:
+            prepared = channel_data['reply_msg']
+            channel_data['msg_count'] += 1
+            msgstream = channel_data['msgstream'].push_line(record.content)
+            if record.learnable:
+                await self.__ingest.put(channel, record.author, record.content + "\n")
             
-        if self.markov.hasResponse(channel_data['msgstream']):
-            channel_data['reply_msg'] = self.markov.trimDataStream(channel_data['msgstream'])
-            channel_data['last_user'] = message.author.display_name
+            if await self.model.has_response(msgstream):
+                channel_data['reply_msg'] = msgstream
+                channel_data['last_user'] = message.author.display_name
         
-        if channel_data['msg_count'] >= channel_data['msg_post_rate']:
-            msg = self.markov.gen(channel_data['reply_msg'])
-            if msg:
-                channel_data['msg_count'] = 0
-                channel_data['msg_post_rate'] = random.randint(self.__user_settings.get_post_min(channel), self.__user_settings.get_post_max(channel))
-                if random.randint(1, 100) <= self.__percent_chance_to_tag_user:
-                    msg = f"@{message.author.display_name} {msg}"
-                Utils.log(f"{channel.ljust(self.__longest_username)}: ({channel_data['msg_post_rate']})[{markov.getKey(channel_data['reply_msg']).rstrip()}] {msg}")
-                
-                msg = self.__user_settings.translate_message(channel, msg)
-                await asyncio.sleep(random.randint(3, 8))
-                await message.channel.send(msg)
+            if channel_data['msg_count'] >= channel_data['msg_post_rate'] and not channel_data['posting']:
+                # claimed before the first await; a failed gen leaves the
+                # count as it is, so the next message tries again
+                channel_data['posting'] = True
+                try:
+                    key = prepared
+                    msg = self.__pregen.take(channel, key) if self.__pregen is not None else None
+                    if msg is None:
+                        key = channel_data['reply_msg']
+                        msg = await self.model.gen(key)
+                    if msg:
+                        channel_data['msg_count'] = 0
+                        channel_data['msg_post_rate'] = random.randint(self.__user_settings.get_post_min(channel), self.__user_settings.get_post_max(channel))
+                        if random.randint(1, 100) <= self.__percent_chance_to_tag_user:
+                            msg = f"@{message.author.display_name} {msg}"
+                        Utils.log(f"{channel.ljust(self.__longest_username)}: ({channel_data['msg_post_rate']})[{self.markov.getKey(key).rstrip()}] {msg}", event='post', channel=channel, key=key, message=msg)
+                    
+                        msg = await self.__user_settings.translate_message(channel, msg)
+                        reply = (msg, self.reply_delay)
+                finally:
+                    channel_data['posting'] = False
+            
+            if reply is None and self.__pregen is not None and channel_data['reply_msg'] and channel_data['msg_count'] + 1 >= channel_data['msg_post_rate']:
+                self.__pregen.prepare(channel, channel_data['reply_msg'])
+
+        self.__messages.inc()
+        self.__message_seconds.observe(time.perf_counter() - t)
+        if reply is not None:
+            msg, delay = reply
+            await asyncio.sleep(random.randint(*delay))
+            await message.channel.send(msg)
+            self.__posts.inc()
 
     async def join_channel(self, channels):
-        new_channels = []
         for channel in channels:
             if not channel in self.__channels:
                 self.__channels.append(channel)
-                new_channels.append(channel)
+            if not channel in self.__roster:
+                self.__roster.append(channel)
+                self.__store.add_channel(channel)
 
         await self.join_channels(channels)
-        Utils.log("*** Joining channels:",', '.join(channels))
-        if self.__new_channel_added:
-            if Utils.save_json_file('data/channels.json', {"channels": self.__channels}):
-                self.__new_channel_added = False
-                return True
-            print("Error saving channels json")
-            return False
-            
+        Utils.log("*** Joining channels:",', '.join(channels), event='join', channels=list(channels), shard=self.__shard)
         return True
 
     async def handle_summon(self, message, args):
         author = message.author.name.lower()
-        if not author in self.__channels:
-            self.__channel_join_queue.append(author)
-            self.__new_channel_added = True
-            self.__longest_username = self.get_longest_username()
-            await message.channel.send(f"Joining your channel now, {message.author.display_name}!")
+        owner = self.owner(author)
+        if owner is None:
+            # the owning process joins it once it sees it in the store
+            if author in self.__roster:
+                return
+            self.__roster.append(author)
+            self.__store.add_channel(author)
+        elif owner.has_channel(author):
+            return
+        else:
+            owner.queue_join([author])
+        await message.channel.send(f"Joining your channel now, {message.author.display_name}!")
     
     async def handle_unsummon(self, message, args):
         author = message.author.name.lower()
-        if author in self.__channels:
-            self.__channels.remove(author)
-            self.__longest_username = self.get_longest_username()
-            if Utils.save_json_file('data/channels.json', {"channels": self.__channels}):
-                Utils.log("*** Left channel",message.author.display_name)
+        owner = self.owner(author)
+        if owner is None:
+            if author in self.__roster:
+                self.__roster.remove(author)
+                self.__store.remove_channel(author)
                 await message.channel.send(f"Alright, I'm out of there, {message.author.display_name}!")
-                await self._connection.send(f"PART #{author}\r\n")
+        elif author in self.__roster or owner.has_channel(author):
+            await owner.part_channel(author)
+            await message.channel.send(f"Alright, I'm out of there, {message.author.display_name}!")
     
     async def handle_msgrate(self, message, args):
         author = message.author.name.lower()
@@ -346,9 +673,8 @@ class Bot(commands.Bot):
             min_rate = self.__user_settings.clamp_post_rate(int(args[0]))
             max_rate = self.__user_settings.clamp_post_rate(int(args[1]))
             self.__user_settings.set_post_range(author, min_rate, max_rate)
-            if self.__user_settings.save():
-                Utils.log("*** Updated min/max for channel",message.author.display_name,"to",min_rate,max_rate)
-                msg_response = f"Min and max post settings updated. Thanks @{message.author.display_name}!"
+            Utils.log("*** Updated min/max for channel",message.author.display_name,"to",min_rate,max_rate)
+            msg_response = f"Min and max post settings updated. Thanks @{message.author.display_name}!"
         
         await message.channel.send(msg_response)
         
@@ -361,9 +687,8 @@ class Bot(commands.Bot):
         
         if len(args) == 1 and args[0].lower() == 'none':
             self.__user_settings.set_translation(author, [])
-            if self.__user_settings.save():
-                Utils.log("*** Updated translation for channel",message.author.display_name,"to",args)
-                msg_response = f"Translation cleared. Thanks @{message.author.display_name}!"
+            Utils.log("*** Updated translation for channel",message.author.display_name,"to",args)
+            msg_response = f"Translation cleared. Thanks @{message.author.display_name}!"
         elif len(args) > 0:
             for lang in args:
                 if not lang in LANGUAGES:
@@ -371,9 +696,8 @@ class Bot(commands.Bot):
                     await message.channel.send(msg_response)
                     return
             self.__user_settings.set_translation(author, args)
-            if self.__user_settings.save():
-                Utils.log("*** Updated translation for channel",message.author.display_name,"to",args)
-                msg_response = f"Translation settings updated. Thanks @{message.author.display_name}!"
+            Utils.log("*** Updated translation for channel",message.author.display_name,"to",args)
+            msg_response = f"Translation settings updated. Thanks @{message.author.display_name}!"
         elif not translate == []:
             msg_response = f"@{message.author.display_name}, I'm currently translating into these languages for you: {', '.join(translate)}. To change this, use `!translate <lang1> <lang2> ... <langN>`, or `!translate none` to clear. For example, `!translate es en` to translate half messages into spanish and half into english."
             
@@ -391,83 +715,288 @@ class Bot(commands.Bot):
         if command in commands:
             await commands[command](message, command_and_args[1:])
 
-    async def handle_self_chat(self, message, channel):
-        if f'@{self.auth.get_user().lower()}' in message.content.lower():
-            msg = re.sub(f'\\s?@{self.auth.get_user().lower()}\\s?', '', message.content.lower())
-            msg = self.markov.gen(msg + '\n')
+    async def handle_self_chat(self, record):
+        message = record.message
+        if record.mentioned:
+            msg = self.__preprocessor.strip_mention(record)
+            msg = await self.model.gen(msg + '\n')
             if msg:
                 msg = f"@{message.author.display_name} {msg}"
                 await message.channel.send(msg)
             return
         
-        msg = message.content.lower()
+        msg = record.lower
         if len(msg) > 0 and msg[0] == '!':
             command = msg.split()
             await self.handle_channel_command(message, command)
             # add to list, etc
 
     async def event_message(self, message):
-        if message.author and message.channel:
-            if message.author.name.lower() in ['funtoon', 'cynanbot', self.auth.get_user().lower()]:
-                return
-                
-            channel = message.channel.name.lower()
+        record = self.__preprocessor.process(message)
+        if record is None or record.from_bot:
+            return
             
-            if channel == self.auth.get_user().lower():
-                await self.handle_self_chat(message, channel)
-            else:
-                await self.handle_chat_message(message, channel)
+        if record.channel == self.__preprocessor.get_nick():
+            await self.handle_self_chat(record)
+        else:
+            await self.handle_chat_message(record)
                 
     async def process_channel_joins(self):
+        await self.wait_for_ready()
         while True:
-            ts = datetime.datetime.now().timestamp()
-            if ts - self.__last_join_time > 12:
-                if len(self.__channel_join_queue) > 0:
-                    self.__last_join_time = ts
-                    to_join = self.__channel_join_queue[:self.__MAX_CHANNEL_JOIN_LIMIT]
-                    self.__channel_join_queue = self.__channel_join_queue[self.__MAX_CHANNEL_JOIN_LIMIT:]
+            if len(self.__channel_join_queue) > 0:
+                count = await self.__join_limiter.acquire(min(len(self.__channel_join_queue), self.__MAX_CHANNEL_JOIN_LIMIT))
+                to_join = self.__channel_join_queue[:count]
+                self.__channel_join_queue = self.__channel_join_queue[count:]
+                self.__unanswered_joins.update(to_join)
+                try:
                     await self.join_channel(to_join)
-            await asyncio.sleep(1)
+                except Exception:
+                    for channel in to_join:
+                        self.__join_answered(channel)
+                    raise
+            else:
+                await asyncio.sleep(1)
             
     async def learn_new_data(self):
-        changes_made = False
+        # learning runs whenever chat arrives; every shard learns into the
+        # shared model and one looks after it
+        maintenance = asyncio.ensure_future(self.__maintenance_loop()) if self.__shard == 0 else None
+        try:
+            await self.__ingest.run()
+        finally:
+            if maintenance is not None:
+                maintenance.cancel()
+            
+    async def collect_metrics(self):
+        self.__join_queue_length.set(len(self.__channel_join_queue))
+        self.__active_channels.set(len(self.msg_data))
+        ingest = self.__ingest.stats()
+        self.__pending_learn_channels.set(ingest['waiting_channels'])
+        self.__ingest_queued_chars.set(ingest['queued_chars'])
+        self.__ingest_max_lag.set(ingest['max_lag'])
+        self.__model_queue_depth.set(self.model.queue_depth())
+        for key, value in LOGGER.stats().items():
+            self.metrics.gauge(f'log_records_{key}', f'Log records {key}').set(value)
+        for key, value in self.__store.stats().items():
+            self.metrics.gauge(f'settings_store_{key}', f'Settings store {key}').set(value)
+        if self.__pregen is not None:
+            stats = self.__pregen.stats()
+            self.metrics.gauge('pregen_hit_rate', 'Share of posts served from a pre-generated candidate').set(stats['hit_rate'])
+            self.metrics.gauge('pregen_cached', 'Pre-generated candidates waiting to be posted').set(stats['cached'])
+        for key, value in (await self.model.stats()).items():
+            if isinstance(value, (int, float)):
+                self.metrics.gauge(f'model_{key}', f'Model statistic {key}').set(value)
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __join_answered(self, channel):
+        # twitchio also rejoins on reconnect; only joins the limiter granted
+        # are reported to it
+        if channel in self.__unanswered_joins:
+            self.__unanswered_joins.discard(channel)
+            self.__join_limiter.sent(1)
+
+    async def __maintenance_loop(self):
         while True:
-            if len(self.__channels_to_learn_from) > 0:
-                for channel in self.__channels_to_learn_from:
-                    self.markov.learn_from_buffer(self.msg_data[channel]['datastream'])
-                    self.msg_data[channel]['datastream'] = self.markov.trimDataStream(self.msg_data[channel]['datastream'])
-                
-                changes_made = True
-                self.__channels_to_learn_from = dict()
+            await self.__maintain_model()
+            await asyncio.sleep(1)
+
+    async def __maintain_model(self):
+        # the journal flush is a no-op when no shard learned anything
+        ts = datetime.datetime.now().timestamp()
+        if ts - self.__last_dict_save_time > self.__JOURNAL_FLUSH_INTERVAL:
+            t = time.perf_counter()
+            await self.model.save_buffers()
+            self.__save_seconds.observe(time.perf_counter() - t)
+            self.__last_dict_save_time = datetime.datetime.now().timestamp()
+            
+        if ts - self.__last_compaction_time > self.__COMPACTION_INTERVAL or await self.model.needs_compaction():
+            if self.__compaction_task is None or self.__compaction_task.done():
+                self.__last_compaction_time = ts
+                self.__compaction_task = asyncio.ensure_future(self.__timed_compaction())
                 
-            ts = datetime.datetime.now().timestamp()
-            if (ts - self.__last_dict_save_time > 300) and changes_made:
-                await self.markov.save_buffers()
-                self.__last_dict_save_time = datetime.datetime.now().timestamp()
-                changes_made = False
+        if ts - self.__last_filter_reload_time > self.__FILTER_RELOAD_INTERVAL:
+            self.__last_filter_reload_time = ts
+            try:
+                if self.markov.reload_filters():
+                    Utils.log("*** Reloaded filter and ignore lists")
+                    # candidates were only checked against the old lists
+                    if self.__pregen is not None:
+                        self.__pregen.invalidate()
+                # also catches up on lists edited while the bot was down
+                self.markov.sync_provenance(self.model)
+            except (IOError, ValueError) as e:
+                print("Exception occured while reloading filters:", e)
                 
-            await asyncio.sleep(1)
+        if self.__processes > 1 and ts - self.__last_roster_sync_time > self.__ROSTER_SYNC_INTERVAL:
+            self.__last_roster_sync_time = ts
+            await self.__sync_roster()
+
+    async def __sync_roster(self):
+        # channels summoned, unsummoned or given settings through another
+        # process since the last look at the store
+        try:
+            added, removed = self.__store.reload()
+        except sqlite3.Error as e:
+            print("Exception occured while reading the channel list:", e)
+            return
+        for channel in added:
+            if not channel in self.__roster:
+                self.__roster.append(channel)
+            owner = self.owner(channel)
+            if owner is not None:
+                owner.queue_join([channel])
+        for channel in removed:
+            owner = self.owner(channel)
+            if owner is not None:
+                await owner.part_channel(channel)
+            elif channel in self.__roster:
+                self.__roster.remove(channel)
+
+    async def __timed_compaction(self):
+        t = time.perf_counter()
+        await self.model.compact()
+        self.__compaction_seconds.observe(time.perf_counter() - t)
+        # eviction and decay can change any context's counts
+        if self.__pregen is not None:
+            self.__pregen.invalidate()
             
 async def ainput(prompt: str = ''):
     with ThreadPoolExecutor(1, 'ainput') as executor:
         return (await asyncio.get_event_loop().run_in_executor(executor, input, prompt))
         
-async def input_thread(bot):
+async def input_thread(bots, tokens=None):
+    # channel-specific commands go to the shard that owns the channel
+    bot = bots[0]
     while True:
         inp = await ainput("(markov) >> ")
         if len(inp) > 0 and inp[0] == '/':
-            cmd, args = inp[1::].split(' ', 1)
+            cmd, _, args = inp[1::].partition(' ')
             if cmd.lower() == "join":
-                await bot.join_channel(args)
+                for channel in args.lower().split():
+                    owner = bot.owner(channel)
+                    if owner is None:
+                        print(f"{channel} belongs to another process")
+                    else:
+                        owner.queue_join([channel])
+            elif cmd.lower() == "reload":
+                bot.markov.reload_filters(force=True)
+                if bot.get_pregen() is not None:
+                    bot.get_pregen().invalidate()
+                print("Reloaded filter and ignore lists")
+            elif cmd.lower() == "stats":
+                print(await bot.model.stats(), "- queue depth:", bot.model.queue_depth())
+                if bot.get_pregen() is not None:
+                    print("Pre-generation:", bot.get_pregen().stats())
+            elif cmd.lower() == "lag":
+                # the channels whose chat has waited longest to be learned
+                for shard in bots:
+                    ingest = shard.get_ingest()
+                    for channel, lag in sorted(ingest.lags().items(), key=lambda item: -item[1])[:10]:
+                        print(channel, ingest.channel_stats(channel))
+                    print(f"Shard {shard.get_shard()}:", ingest.stats())
+            elif cmd.lower() == "unlearn":
+                scope, _, value = args.partition(' ')
+                provenance = bot.markov.get_provenance()
+                if provenance is None:
+                    print("Provenance is not recorded by this process; set ANIV_PROVENANCE=1 where the model runs")
+                elif scope.lower() in ('user', 'channel', 'pattern') and value:
+                    result = await provenance.unlearn(bot.model, **{scope.lower() + 's': [value]})
+                    print("Unlearned", result['messages'], "messages,", result['chars'], "characters")
+                else:
+                    print("Usage: /unlearn user|channel|pattern <value>")
+            elif cmd.lower() == "token":
+                if tokens is None:
+                    print("No refresh token configured in auth.json")
+                else:
+                    print(tokens.stats())
+            elif cmd.lower() == "metrics":
+                if bot.metrics.is_enabled():
+                    await bot.metrics.collect()
+                    print(bot.metrics.render(), end='')
+                else:
+                    print("Metrics are disabled")
         else:
             chan, res = inp.split(' ', 1)
-            await bot.send_message(chan, res + '\n')
+            owner = bot.owner(chan)
+            if owner is None:
+                print(f"{chan} belongs to another process")
+            else:
+                await owner.send_message(chan, res + '\n')
+
+def create_bots(markov, metrics, shards=1, join_rate=JOIN_RATE, join_burst=JOIN_BURST, model=None, pregen=False, ingest_policy=DROP_OLDEST, process=0, processes=1, auth=None):
+    # one connection per shard, each owning a stable slice of this process'
+    # channels; all of them share the model, the join rate limit, the
+    # credentials and the channel list. The join limit is per account, so
+    # processes split it.
+    auth = auth if auth is not None else Auth('auth.json')
+    store = SettingsStore()
+    roster = store.get_channels()
+    if model is None:
+        model = ModelExecutor(markov)
+    join_limiter = JoinLimiter(join_rate / processes, max(1, join_burst // processes))
+    pregen = PregenCache(model, metrics=metrics) if pregen else None
+    peers = []
+    peers.extend(Bot(markov, metrics=metrics, channels=channels, roster=roster, model=model, join_limiter=join_limiter, shard=i, store=store, pregen=pregen, ingest_policy=ingest_policy, peers=peers, process=process, processes=processes, auth=auth)
+        for i, channels in enumerate(shard_channels(roster, shards, process, processes)))
+    return peers
 
 if __name__ == '__main__':
     # make Ctrl-C actually kill the process
     signal.signal(signal.SIGINT, signal.SIG_DFL)
     
-    markov = Markov()
+    if len(sys.argv) > 2 and sys.argv[1] == 'train':
+        train(sys.argv[2:])
+        sys.exit(0)
+        
+    # ANIV_ENGINE is the model engine, 'table' or 'suffix'. ANIV_MEMORY_BUDGET
+    # (bytes) caps the model, compacting early to stay within it: the table
+    # engine evicts the least recently used contexts, the suffix engine ages
+    # out its oldest text. For the table engine, ANIV_DECAY_INTERVAL (seconds)
+    # halves every count at the first compaction after each interval.
+    # ANIV_GEN_BATCH=k draws requests for k or more candidates together with
+    # numpy (default 128, where it starts to win; 0 turns it off). They are
+    # set wherever the model runs: on the model service when there is one.
+    model_settings = {
+        'engine': os.environ.get('ANIV_ENGINE', 'table'),
+        'gen_batch': int(os.environ.get('ANIV_GEN_BATCH', '128')),
+        'memory_budget': int(os.environ['ANIV_MEMORY_BUDGET']) if os.environ.get('ANIV_MEMORY_BUDGET') else None,
+        'decay_interval': float(os.environ['ANIV_DECAY_INTERVAL']) if os.environ.get('ANIV_DECAY_INTERVAL') else None,
+    }
+        
+    # unlearning needs the exact counts the suffix engine doesn't keep
+    if os.environ.get('ANIV_PROVENANCE', '0') != '0' and model_settings['engine'] == 'suffix':
+        print("ANIV_PROVENANCE needs ANIV_ENGINE=table; the suffix engine can't unlearn")
+        sys.exit(1)
+        
+    # one process holds the model and serves every bot process that sets
+    # ANIV_MODEL_SOCKET to the same path
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        markov = Markov(**model_settings,
+            provenance=os.environ.get('ANIV_PROVENANCE', '0') != '0')
+        markov.load()
+        asyncio.get_event_loop().run_until_complete(serve(markov, *sys.argv[2:3]))
+        sys.exit(0)
+        
+    # bot processes share one model, so more than one needs the service
+    process = int(os.environ.get('ANIV_SHARD_INDEX', '0'))
+    processes = int(os.environ.get('ANIV_SHARD_COUNT', '1'))
+    if not 0 <= process < processes:
+        print(f"ANIV_SHARD_INDEX must be from 0 to {processes - 1}")
+        sys.exit(1)
+    if processes > 1 and not os.environ.get('ANIV_MODEL_SOCKET'):
+        print("ANIV_SHARD_COUNT > 1 needs ANIV_MODEL_SOCKET, so the processes share one model service")
+        sys.exit(1)
+        
+    # ANIV_METRICS_PORT serves the metrics on localhost; /metrics in the
+    # console works either way. ANIV_PROVENANCE=1 records who taught the model what,
+    # so chat from newly ignored users and filtered words is unlearned; with
+    # a model service it is set on the service instead.
+    metrics = Registry()
+    markov = Markov(**model_settings, metrics=metrics,
+        provenance=os.environ.get('ANIV_PROVENANCE', '0') != '0' and not os.environ.get('ANIV_MODEL_SOCKET'))
     
     while True:
         inp = input("(markov) >> ")
@@ -478,16 +1007,59 @@ if __name__ == '__main__':
                 break
             elif inp.lower() == "load":
                 markov.load()
+            elif inp.lower() == "stats":
+                print(markov.stats())
+            elif inp.lower() == "reload":
+                markov.reload_filters(force=True)
+            elif inp.lower().startswith("candidates "):
+                for candidate in markov.gen_candidates(inp.split(' ', 1)[1] + '\n', 10) or []:
+                    print(candidate)
+            elif inp.lower().startswith("train "):
+                train(inp.split()[1:])
+                markov.load()
             else:
                 print("Unknown command")
         else:
             print(markov.gen(inp + '\n'))
             
-    markov.load()
-    bot = Bot(markov)
+    # with a model service the local Markov only supplies the filters
+    model = None
+    if os.environ.get('ANIV_MODEL_SOCKET'):
+        model = ModelClient(os.environ['ANIV_MODEL_SOCKET'])
+    else:
+        markov.load()
+    # ANIV_SHARDS splits the channels over that many connections;
+    # ANIV_JOIN_RATE/ANIV_JOIN_BURST raise the join limit for verified bots;
+    # ANIV_PREGEN=1 generates replies ahead of time; ANIV_INGEST_POLICY
+    # (drop_oldest, drop_newest or block) is what a full channel queue does.
+    # ANIV_SHARD_COUNT bot processes split the channels between them, each
+    # started with its own ANIV_SHARD_INDEX from 0 to the count - 1
+    auth = Auth('auth.json')
+    bots = create_bots(markov, metrics,
+        int(os.environ.get('ANIV_SHARDS', '1')),
+        float(os.environ.get('ANIV_JOIN_RATE', JOIN_RATE)),
+        int(os.environ.get('ANIV_JOIN_BURST', JOIN_BURST)),
+        model,
+        os.environ.get('ANIV_PREGEN', '0') != '0',
+        os.environ.get('ANIV_INGEST_POLICY', DROP_OLDEST),
+        process, processes, auth)
     loop = asyncio.get_event_loop()
-    loop.create_task(input_thread(bot))
-    loop.create_task(bot.process_channel_joins())
-    loop.create_task(bot.learn_new_data())
-    bot.run()
+    if os.environ.get('ANIV_METRICS_PORT'):
+        loop.run_until_complete(MetricsServer(metrics, port=int(os.environ['ANIV_METRICS_PORT'])).start())
+    # the API access token is kept fresh in the background when auth.json
+    # has a refresh token; ANIV_OAUTH_URL points it at another endpoint
+    tokens = None
+    if auth.can_refresh():
+        tokens = TokenManager(auth, base_url=os.environ.get('ANIV_OAUTH_URL', TWITCH_OAUTH_URL), metrics=metrics)
+        loop.create_task(tokens.run())
+    loop.create_task(input_thread(bots, tokens))
+    for bot in bots:
+        loop.create_task(bot.process_channel_joins())
+        loop.create_task(bot.learn_new_data())
+    if len(bots) == 1:
+        bots[0].run()
+    else:
+        for bot in bots:
+            loop.create_task(bot.start())
+        loop.run_forever()
     print("Done")
@@ -1,10 +1,19 @@
+import os
 import json
-import requests
+import time
+import asyncio
+import threading
+import aiohttp
+from metrics import Registry
+
+TWITCH_OAUTH_URL = 'https://id.twitch.tv/oauth2'
 
 class Auth():
     def __init__(self, auth_file):
         self.__auth_file = auth_file
         self.__auth_json = {}
+        # tokens are saved from an executor thread
+        self.__lock = threading.Lock()
         self.__load_auth()
         
     def get_user(self):
@@ -20,7 +29,8 @@ class Auth():
         return self.__auth_json['irc_auth_token']
         
     def get_access_token(self):
-        return self.__auth_json['access_token']
+        # None until the first refresh when auth.json has no access token
+        return self.__auth_json.get('access_token')
         
     def get_refresh_token(self):
         return self.__auth_json['refresh_token']
@@ -28,31 +38,19 @@ class Auth():
     def get_funtoon_token(self):
         return self.__auth_json['funtoon_token']
 
-    def validate_access_token(self):
-        headers = {
-            'Authorization': f'OAuth {self.__auth.get_access_token()}'
-        }
+    def get_expires_at(self):
+        # unix time the access token expires, 0 if unknown
+        return self.__auth_json.get('expires_at', 0)
         
-        r = requests.get('https://id.twitch.tv/oauth2/validate', headers=headers)
-        j = json.loads(r.content)
-        return 'client_id' in j
+    def can_refresh(self):
+        return all(self.__auth_json.get(key) for key in ('client_id', 'client_secret', 'refresh_token'))
         
-    def refresh_access_token(self):
-        params = {
-            'grant_type': 'refresh_token',
-            'refresh_token': self.get_refresh_token(),
-            'client_id': self.get_client_id(),
-            'client_secret': self.get_client_secret()
-        }
-        
-        url = 'https://id.twitch.tv/oauth2/token'
-
-        r = requests.post(url, params=params)
-        j = json.loads(r.content)
-        new_access_token = j['access_token']
-        new_refresh_token = j['refresh_token']
-        self.__assign_new_access_token(new_access_token, new_refresh_token)
-        return new_access_token
+    def assign_tokens(self, access_token, refresh_token, expires_at):
+        with self.__lock:
+            self.__auth_json['access_token'] = access_token
+            self.__auth_json['refresh_token'] = refresh_token
+            self.__auth_json['expires_at'] = expires_at
+            self.__save_auth()
         
     ###########################################################################
     # Private helper methods
@@ -62,14 +60,153 @@ class Auth():
             with open(self.__auth_file, 'r') as f:
                 self.__auth_json = json.load(f)
         except IOError:
-            print(f"Unable to open auth file '{__auth_file}'")
+            print(f"Unable to open auth file '{self.__auth_file}'")
             
     def __save_auth(self):
-        with open(self.__auth_file, 'w') as f:
+        # a crash mid-write leaves the old file rather than a truncated one
+        tmp_file = self.__auth_file + '.tmp'
+        with open(tmp_file, 'w') as f:
             json.dump(self.__auth_json, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.__auth_file)
             
-    def __assign_new_access_token(self, new_access_token, new_refresh_token):
-        self.__auth_json['access_token'] = new_access_token
-        self.__auth_json['refresh_token'] = new_refresh_token
-        self.__save_auth()
-        
\ No newline at end of file
+class TokenManager():
+    # Keeps the API access token valid without blocking the event loop. All
+    # requests share one pooled HTTP session; run() validates the token every
+    # validate_interval (as Twitch asks apps to) and refreshes it
+    # refresh_margin seconds before it expires, so callers of
+    # get_access_token() rarely wait. Concurrent refreshes share one request.
+    # base_url points at the OAuth endpoint, or at a local stand-in such as
+    # fake_oauth.FakeOAuthServer.
+    def __init__(self, auth, base_url=TWITCH_OAUTH_URL, refresh_margin=300, validate_interval=3600, timeout=10.0, metrics=None):
+        self.__auth = auth
+        self.__base_url = base_url.rstrip('/')
+        self.__refresh_margin = refresh_margin
+        self.__validate_interval = validate_interval
+        self.__timeout = timeout
+        self.__RETRY_DELAY = 5
+        self.__MAX_RETRY_DELAY = 300
+        self.__session = None
+        self.__refresh_task = None
+        self.__stats = {
+            'validations': 0,
+            'invalid_tokens': 0,
+            'refreshes': 0,
+            'refresh_failures': 0,
+            'shared_refreshes': 0,
+        }
+        metrics = metrics if metrics is not None else Registry(enabled=False)
+        self.__refreshes = metrics.counter('oauth_refreshes_total', 'Access token refreshes')
+        self.__refresh_failures = metrics.counter('oauth_refresh_failures_total', 'Access token refreshes that failed')
+        self.__request_seconds = metrics.histogram('oauth_request_seconds', 'Time for a request to the OAuth endpoint')
+        
+    async def get_access_token(self):
+        # refreshes first if the token is missing or about to expire
+        if not self.__auth.get_access_token() or self.expires_in() <= self.__refresh_margin:
+            return await self.refresh()
+        return self.__auth.get_access_token()
+
+    def expires_in(self):
+        # seconds left on the access token; infinite if unknown
+        expires_at = self.__auth.get_expires_at()
+        if not expires_at:
+            return float('inf')
+        return expires_at - time.time()
+
+    async def validate(self):
+        # True if the endpoint accepts the token, noting when it expires; a
+        # missing token counts as expired
+        self.__stats['validations'] += 1
+        if not self.__auth.get_access_token():
+            self.__stats['invalid_tokens'] += 1
+            return False
+        headers = {'Authorization': f'OAuth {self.__auth.get_access_token()}'}
+        t = time.perf_counter()
+        try:
+            async with self.__get_session().get(f'{self.__base_url}/validate', headers=headers) as r:
+                if r.status == 401:
+                    self.__stats['invalid_tokens'] += 1
+                    return False
+                r.raise_for_status()
+                j = await r.json()
+        finally:
+            self.__request_seconds.observe(time.perf_counter() - t)
+        if 'expires_in' in j:
+            expires_at = int(time.time() + j['expires_in'])
+            if abs(expires_at - self.__auth.get_expires_at()) > 60:
+                await self.__save_tokens(self.__auth.get_access_token(), self.__auth.get_refresh_token(), expires_at)
+        return 'client_id' in j
+
+    async def refresh(self):
+        # callers arriving while a refresh is in flight wait for that one
+        if self.__refresh_task is None or self.__refresh_task.done():
+            self.__refresh_task = asyncio.ensure_future(self.__refresh())
+        else:
+            self.__stats['shared_refreshes'] += 1
+        # one caller giving up doesn't cancel the refresh for the others
+        return await asyncio.shield(self.__refresh_task)
+
+    async def run(self):
+        failures = 0
+        while True:
+            try:
+                if not await self.validate() or self.expires_in() <= self.__refresh_margin:
+                    await self.refresh()
+                failures = 0
+                wait = min(self.__validate_interval, self.expires_in() - self.__refresh_margin)
+            except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+                print("Exception occured while refreshing the access token:", e)
+                failures += 1
+                wait = min(self.__MAX_RETRY_DELAY, self.__RETRY_DELAY * 2 ** (failures - 1))
+            await asyncio.sleep(max(wait, 1))
+
+    def stats(self):
+        stats = dict(self.__stats)
+        stats['expires_in'] = self.expires_in()
+        stats['refresh_running'] = 1 if self.__refresh_task is not None and not self.__refresh_task.done() else 0
+        return stats
+
+    async def close(self):
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __get_session(self):
+        # created on first use so it binds to the running loop
+        if self.__session is None or self.__session.closed:
+            self.__session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.__timeout),
+                connector=aiohttp.TCPConnector(limit=4, keepalive_timeout=60))
+        return self.__session
+
+    async def __refresh(self):
+        # the secret goes in the form body rather than the URL
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': self.__auth.get_refresh_token(),
+            'client_id': self.__auth.get_client_id(),
+            'client_secret': self.__auth.get_client_secret(),
+        }
+        t = time.perf_counter()
+        try:
+            async with self.__get_session().post(f'{self.__base_url}/token', data=data) as r:
+                r.raise_for_status()
+                j = await r.json()
+            expires_at = int(time.time() + j['expires_in']) if 'expires_in' in j else 0
+            await self.__save_tokens(j['access_token'], j['refresh_token'], expires_at)
+        except Exception:
+            self.__stats['refresh_failures'] += 1
+            self.__refresh_failures.inc()
+            raise
+        finally:
+            self.__request_seconds.observe(time.perf_counter() - t)
+        self.__stats['refreshes'] += 1
+        self.__refreshes.inc()
+        return j['access_token']
+
+    async def __save_tokens(self, access_token, refresh_token, expires_at):
+        await asyncio.get_event_loop().run_in_executor(None, self.__auth.assign_tokens, access_token, refresh_token, expires_at)
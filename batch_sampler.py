@@ -0,0 +1,190 @@
+import random
+import numpy as np
+
+# Vectorized generation for LayeredModel: advances k candidate strings one
+# character per numpy step instead of one character per Python call.
+#
+# Contexts are compiled on first use into integer states laid out CSR-style:
+# each state owns a range of edges (next character, successor state) and the
+# edge weights are stored as one running total across all edges, so sampling
+# every candidate's next edge is a single searchsorted. A state is recompiled
+# when learning changes its counts; its old edges stay behind as garbage until
+# the graph is rebuilt.
+
+UNRESOLVED = -1
+
+def _grow(arr, n):
+    if n <= len(arr):
+        return arr
+    out = np.empty(max(n, 2 * len(arr)), dtype=arr.dtype)
+    out[:len(arr)] = arr
+    return out
+
+class BatchSampler():
+    def __init__(self, counts_fn, max_states=1 << 20):
+        # counts_fn(ctx) -> ({char: count} or None, base snapshot index or -1)
+        self.__counts_fn = counts_fn
+        self.__max_states = max_states
+        self.__rng = np.random.default_rng(random.getrandbits(64))
+        self.__reset()
+
+    def __len__(self):
+        return len(self.__contexts)
+
+    def invalidate(self, ctx):
+        # a negative edge count marks the state for recompiling
+        sid = self.__states.get(ctx)
+        if sid is not None and self.__count[sid] >= 0:
+            self.__live_edges -= int(self.__count[sid])
+            self.__count[sid] = -1
+
+    def stats(self):
+        return {
+            'batch_states': len(self.__contexts),
+            'batch_edges': self.__n_edges,
+            'batch_live_edges': self.__live_edges,
+            'batch_bytes': sum(a.nbytes for a in (self.__count, self.__base, self.__total, self.__base_idx, self.__visited, self.__chars, self.__cum, self.__next, self.__owner)),
+        }
+
+    def sample(self, ctx, k, max_len):
+        # Generates k strings from ctx, each ending after a newline, at a dead
+        # end or at max_len characters. Returns (strings, base indices of the
+        # states used), or None when ctx has no continuations.
+        if len(self.__contexts) >= self.__max_states or self.__n_edges > 2 * self.__live_edges + (1 << 20):
+            self.__reset()
+        sid = self.__state(ctx)
+        if self.__count[sid] <= 0:
+            return None
+
+        state = np.full(k, sid, dtype=np.int64)
+        out = np.zeros((k, max_len), dtype=np.uint32)
+        active = np.arange(k)
+        lengths = np.full(k, max_len, dtype=np.int64)
+        draws = self.__rng.random((max_len, k))
+        newline = ord('\n')
+        for step in range(max_len):
+            s = state[active]
+            count = self.__count[s]
+            if (count <= 0).any():
+                # stale states (-1) are recompiled; dead ends (0) stop, as
+                # step() would, after the character that led there
+                for stale_sid in set(s[count < 0].tolist()):
+                    self.__compile(stale_sid)
+                live = self.__count[s] > 0
+                ended = active[~live]
+                lengths[ended] = step
+                active = active[live]
+                if len(active) == 0:
+                    break
+                s = state[active]
+            self.__visited[s] = True
+
+            total = self.__total[s]
+            r = (draws[step, :len(s)] * total).astype(np.int64)
+            np.minimum(r, total - 1, out=r)
+            r += self.__base[s]
+            e = self.__cum[:self.__n_edges].searchsorted(r, side='right')
+            chars = self.__chars[e]
+            out[active, step] = chars
+
+            nxt = self.__next[e]
+            if (nxt == UNRESOLVED).any():
+                for edge in set(e[nxt == UNRESOLVED].tolist()):
+                    self.__resolve(edge)
+                nxt = self.__next[e]
+            state[active] = nxt
+            done = chars == newline
+            if done.any():
+                ended = active[done]
+                lengths[ended] = step + 1
+                active = active[~done]
+                if len(active) == 0:
+                    break
+
+        outputs = [self.__decode(out, row, length) for row, length in enumerate(lengths.tolist())]
+
+        visited = np.flatnonzero(self.__visited[:len(self.__contexts)])
+        self.__visited[visited] = False
+        base_idx = self.__base_idx[visited]
+        return outputs, base_idx[base_idx >= 0]
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __reset(self):
+        self.__states = dict()
+        self.__contexts = []
+        self.__count = np.zeros(1024, dtype=np.int32)
+        self.__base = np.zeros(1024, dtype=np.int64)
+        self.__total = np.zeros(1024, dtype=np.int64)
+        self.__base_idx = np.zeros(1024, dtype=np.int64)
+        self.__visited = np.zeros(1024, dtype=bool)
+        self.__chars = np.zeros(4096, dtype=np.uint32)
+        self.__cum = np.zeros(4096, dtype=np.int64)
+        self.__next = np.zeros(4096, dtype=np.int64)
+        self.__owner = np.zeros(4096, dtype=np.int64)
+        self.__n_edges = 0
+        self.__live_edges = 0
+        self.__running_total = 0
+
+    def __state(self, ctx):
+        sid = self.__states.get(ctx)
+        if sid is None:
+            sid = len(self.__contexts)
+            self.__states[ctx] = sid
+            self.__contexts.append(ctx)
+            if sid >= len(self.__count):
+                n = sid + 1
+                self.__count = _grow(self.__count, n)
+                self.__base = _grow(self.__base, n)
+                self.__total = _grow(self.__total, n)
+                self.__base_idx = _grow(self.__base_idx, n)
+                self.__visited = _grow(self.__visited, n)
+            self.__visited[sid] = False
+            self.__count[sid] = 0
+            self.__compile(sid)
+        elif self.__count[sid] < 0:
+            self.__compile(sid)
+        return sid
+
+    def __compile(self, sid):
+        mapping, idx = self.__counts_fn(self.__contexts[sid])
+        if self.__count[sid] > 0:
+            self.__live_edges -= int(self.__count[sid])
+        self.__base_idx[sid] = idx
+        if mapping is None:
+            self.__count[sid] = 0
+            self.__total[sid] = 0
+            return
+        n = len(mapping)
+        start = self.__n_edges
+        end = start + n
+        if end > len(self.__chars):
+            self.__chars = _grow(self.__chars, end)
+            self.__cum = _grow(self.__cum, end)
+            self.__next = _grow(self.__next, end)
+            self.__owner = _grow(self.__owner, end)
+        # appended after every existing edge, so the running total stays sorted
+        base = self.__running_total
+        running = base
+        cum = []
+        for count in mapping.values():
+            running += count
+            cum.append(running)
+        self.__chars[start:end] = [ord(char) for char in mapping]
+        self.__cum[start:end] = cum
+        self.__next[start:end] = UNRESOLVED
+        self.__owner[start:end] = sid
+        self.__count[sid] = n
+        self.__base[sid] = base
+        self.__total[sid] = running - base
+        self.__running_total = running
+        self.__n_edges = end
+        self.__live_edges += n
+
+    def __decode(self, out, row, length):
+        return out[row, :length].tobytes().decode('utf-32-le', 'surrogatepass')
+
+    def __resolve(self, edge):
+        sid = int(self.__owner[edge])
+        self.__next[edge] = self.__state(self.__contexts[sid][1:] + chr(self.__chars[edge]))
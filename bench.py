@@ -0,0 +1,1641 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import contextlib
+import subprocess
+import time
+import bisect
+import random
+import asyncio
+import collections
+from model import LayeredModel
+from suffix_model import SuffixArrayModel
+
+ORDER = 10
+
+def load_corpus(path=None, lines=20000):
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    rng = random.Random(1)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 8))) for _ in range(3000)]
+    weights = [1 / (i + 1) for i in range(len(words))]
+    out = []
+    for _ in range(lines):
+        out.append(' '.join(rng.choices(words, weights, k=rng.randint(2, 12))))
+    return '\n'.join(out) + '\n'
+
+def build_dict(data):
+    d = dict()
+    for i in range(len(data) - ORDER):
+        key = data[i:i+ORDER]
+        char = data[i+ORDER]
+        if not key in d:
+            d[key] = dict()
+        if not char in d[key]:
+            d[key][char] = 0
+        d[key][char] += 1
+    return d
+
+def start_contexts(data, n=200):
+    lines = [line for line in data.split('\n') if len(line) > ORDER]
+    return [line[:ORDER] for line in lines[:n]]
+
+def walk_dict(d, starts, chars):
+    # the pre-TransitionTable gen path
+    done = 0
+    while done < chars:
+        ctx = random.choice(starts)
+        while done < chars:
+            mapping = d.get(ctx)
+            if mapping is None:
+                break
+            char = random.choices(list(mapping.keys()), list(mapping.values()))[0]
+            done += 1
+            if char == '\n':
+                break
+            ctx = ctx[1:] + char
+
+def walk_counts(model, starts, chars):
+    # a dict rebuilt from the packed edges for every character
+    done = 0
+    while done < chars:
+        ctx = random.choice(starts)
+        while done < chars:
+            mapping = model.counts(ctx)
+            if mapping is None:
+                break
+            char = random.choices(list(mapping.keys()), list(mapping.values()))[0]
+            done += 1
+            if char == '\n':
+                break
+            ctx = ctx[1:] + char
+
+def walk_model(model, starts, chars):
+    done = 0
+    while done < chars:
+        ctx = random.choice(starts)
+        while done < chars:
+            char, ctx = model.step(ctx)
+            if char is None:
+                break
+            done += 1
+            if char == '\n':
+                break
+
+def bench_sampling(path=None, chars=200000):
+    from transitions import TransitionTable
+    from snapshot import Snapshot, merge_layers, write_snapshot
+
+    data = load_corpus(path)
+    starts = start_contexts(data)
+    d = build_dict(data)
+    model = LayeredModel(ORDER)
+    model.learn(data)
+    # every step rebuilds its table: the cold path
+    uncached = LayeredModel(ORDER, sampling_cache_bytes=0)
+    uncached.learn(data)
+    # the same counts compacted into a mapped snapshot, where a deployed
+    # model keeps most of them; then as deployed between compactions, the
+    # last tenth learned on top of a snapshot of the rest
+    work = tempfile.mkdtemp(prefix='aniv_sampling_')
+    split = data.rindex('\n', 0, len(data) * 9 // 10) + 1
+    snapshots = []
+    for name, text in (('all.bin', data), ('head.bin', data[:split])):
+        table = TransitionTable(ORDER)
+        table.learn(text)
+        write_snapshot(os.path.join(work, name), ORDER, 0, merge_layers(None, [table]))
+        del table
+        snapshots.append(Snapshot(os.path.join(work, name)))
+    layered = LayeredModel(ORDER, snapshots[1])
+    layered.learn(data[split - ORDER:])
+
+    results = {}
+    try:
+        for name, fn, target in (
+                ('dict + choices', walk_dict, d),
+                ('model + choices', walk_counts, model),
+                ('sampling table', walk_model, model),
+                ('no table cache', walk_model, uncached),
+                ('snapshot', walk_model, LayeredModel(ORDER, snapshots[0])),
+                ('snapshot + overlay', walk_model, layered)):
+            random.seed(0)
+            fn(target, starts, chars // 10)
+            t = time.perf_counter()
+            fn(target, starts, chars)
+            results[name] = chars / (time.perf_counter() - t)
+    finally:
+        for snapshot in snapshots:
+            snapshot.close()
+        shutil.rmtree(work, ignore_errors=True)
+
+    for name, rate in results.items():
+        print(f"{name.ljust(18)}: {rate:12.0f} chars/s")
+    stats = model.stats()
+    print(f"table cache: {stats['sampling_tables']} contexts in {stats['sampling_bytes'] / 1e6:.1f} MB; model {stats['overlay_bytes'] / 1e6:.1f} MB")
+    return results
+
+def bench_backoff(path=None, chars=50000):
+    # memory, reply coverage on held-out messages, and ingest and gen speed
+    # of the exact order-10 engines against the suffix array with backoff.
+    # Builds are timed without tracemalloc, which slows allocation-heavy
+    # code several times over, and measured for memory in a second build.
+    import tracemalloc
+
+    data = load_corpus(path)
+    lines = data.split('\n')
+    split = len(lines) * 9 // 10
+    train = '\n'.join(lines[:split]) + '\n'
+    held_out = [line for line in lines[split:] if len(line) > ORDER]
+    starts = start_contexts(train)
+
+    def build_suffix(text):
+        model = SuffixArrayModel(ORDER)
+        model.learn(text)
+        model.index()
+        return model
+
+    def build_table(text):
+        model = LayeredModel(ORDER)
+        model.learn(text)
+        return model
+
+    results = {}
+    for name, build in (('dict', build_dict), ('table', build_table), ('suffix', build_suffix)):
+        t = time.perf_counter()
+        model = build(train)
+        build_time = time.perf_counter() - t
+        del model
+        tracemalloc.start()
+        model = build(train)
+        resident = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # can the bot continue each held-out message from some point in it
+        replies = 0
+        for line in held_out:
+            ctx = line[:ORDER]
+            replies += 1 if ctx in model else 0
+        rate = 0.0
+        if name != 'dict':
+            random.seed(0)
+            t = time.perf_counter()
+            walk_model(model, starts, chars)
+            rate = chars / (time.perf_counter() - t)
+        results[name] = {
+            'build_seconds': build_time,
+            'ingest_chars_per_second': len(train) / build_time,
+            'resident_bytes': resident,
+            'reply_share': replies / max(len(held_out), 1),
+            'chars_per_second': rate,
+        }
+        print(f"{name.ljust(6)}: built in {build_time:6.2f}s ({len(train) / build_time:7.0f} chars/s), {resident / 1e6:8.1f} MB, replies to {results[name]['reply_share']:6.1%} of held-out contexts, {rate:9.0f} chars/s")
+    return results
+
+async def monitor_loop_lag(samples, interval=0.005):
+    loop = asyncio.get_event_loop()
+    while True:
+        t = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - t - interval)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def measure_lag(model, data, starts):
+    # event loop lag while a large learn batch and a burst of gens are
+    # processed; (seconds taken, lag samples)
+    async def run():
+        samples = []
+        monitor = asyncio.ensure_future(monitor_loop_lag(samples))
+        await asyncio.sleep(0.05)
+        t = time.perf_counter()
+        await model.learn_from_buffer(data)
+        await asyncio.gather(*(model.gen(start) for start in starts))
+        elapsed = time.perf_counter() - t
+        # let the sample spanning the tail of the work land
+        await asyncio.sleep(0.05)
+        monitor.cancel()
+        return elapsed, samples
+
+    return asyncio.run(run())
+
+def bench_lag(path=None):
+    from aniv import Markov
+    from executor import InlineModel, ModelExecutor
+
+    data = load_corpus(path)
+    starts = start_contexts(data)
+
+    results = {}
+    for name, front in (('inline', InlineModel), ('executor', ModelExecutor)):
+        model = front(Markov())
+        elapsed, samples = measure_lag(model, data, starts)
+        if name == 'executor':
+            model.shutdown()
+        results[name] = {
+            'seconds': elapsed,
+            'lag_p50_ms': percentile(samples, 50) * 1000,
+            'lag_p99_ms': percentile(samples, 99) * 1000,
+            'lag_max_ms': max(samples, default=0.0) * 1000,
+        }
+        print(f"{name.ljust(9)}: {elapsed:6.2f}s, loop lag p50 {results[name]['lag_p50_ms']:8.2f}ms p99 {results[name]['lag_p99_ms']:8.2f}ms max {results[name]['lag_max_ms']:8.2f}ms")
+    return results
+
+def check_compaction_touches(path=None):
+    # Generation marks snapshot rows used while a compaction with a memory
+    # budget is written; the snapshot written has to match its header, keep
+    # its contexts sorted and stay within the budget. Returns the failures.
+    from aniv import Markov
+    from snapshot import Snapshot, _layout
+
+    data = load_corpus(path, 5000)
+    failures = []
+    with bot_workdir():
+        markov = Markov()
+        markov.load()
+        markov.learn_from_buffer(data)
+        asyncio.run(markov.compact())
+        # three quarters of the budget are left for the snapshot, so half the
+        # current size makes the next compaction evict whole groups
+        budget = os.path.getsize('markov_dict.bin') // 2
+        # generating from contexts seen once touches the rows evicted first
+        snapshot = Snapshot('markov_dict.bin')
+        starts = [key.decode('utf-8', 'surrogatepass') for key, row, _ in snapshot.raw_items() if sum(count for _, count in row) == 1]
+        snapshot.close()
+        random.Random(0).shuffle(starts)
+        markov = Markov(memory_budget=budget)
+        markov.load()
+        markov.learn_from_buffer(data[:len(data) // 10])
+
+        async def run():
+            compaction = markov.begin_compaction()
+            await markov.save_buffers()
+            write = asyncio.get_event_loop().run_in_executor(None, markov.write_compaction, compaction)
+            gens = 0
+            while not write.done():
+                markov.gen(starts[gens % len(starts)])
+                gens += 1
+                await asyncio.sleep(0)
+            markov.finish_compaction(compaction, await write)
+            return gens
+
+        gens = asyncio.run(run())
+        snapshot = Snapshot('markov_dict.bin')
+        try:
+            keys = []
+            edges = 0
+            for key, row, _ in snapshot.raw_items():
+                keys.append(key)
+                edges += len(row)
+            expected = _layout(len(keys), edges, sum(len(key) for key in keys))[1]
+            ordered = all(a < b for a, b in zip(keys, keys[1:]))
+            print(f"compaction under a {budget / 1e6:.1f} MB budget with {gens} gens during the write: {len(keys)} contexts, {snapshot.nbytes()} bytes (layout {expected}), {'sorted' if ordered else 'out of order'}")
+            if snapshot.nbytes() != expected or not ordered:
+                failures.append('snapshot layout')
+            if snapshot.nbytes() > budget * 0.75:
+                failures.append('snapshot budget')
+        finally:
+            snapshot.close()
+    return failures
+
+def check_suffix_merge_compaction(path=None):
+    # A background run merge still in flight when a compaction takes its view
+    # finishes before the compaction does; afterwards every learned position
+    # has to be indexed exactly once. Returns the failures.
+    import threading
+    import suffix_model
+
+    release = threading.Event()
+    finished = threading.Event()
+    merge_runs = suffix_model.merge_runs
+
+    def held_merge(*args):
+        # only the background merges wait; inline ones run as usual
+        if threading.current_thread().name.startswith('suffix-merge'):
+            release.wait()
+            try:
+                return merge_runs(*args)
+            finally:
+                finished.set()
+        return merge_runs(*args)
+
+    lines = load_corpus(path).split('\n')
+    model = SuffixArrayModel(ORDER)
+    learned = 0
+    suffix_model.merge_runs = held_merge
+    try:
+        for i in range(0, len(lines), 50):
+            data = '\n'.join(lines[i:i + 50]) + '\n'
+            model.learn(data)
+            learned += len(data) if len(data) > ORDER else 0
+            if model.stats()['merging']:
+                break
+        view = model.view()
+        release.set()
+        finished.wait(30)
+        # the model's thread would install a finished merge on its next lookup
+        model.index()
+        work = tempfile.mkdtemp(prefix='aniv_check_')
+        try:
+            model.apply_compaction(view, suffix_model.write_suffix_model(os.path.join(work, 'markov_suffix.bin'), ORDER, 0, view))
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+        model.index()
+    finally:
+        suffix_model.merge_runs = merge_runs
+        release.set()
+    indexed = model.stats()['indexed_positions']
+    print(f"suffix compaction with a run merge in flight: {indexed} positions indexed for {learned} learned")
+    return ['suffix merge'] if indexed != learned else []
+
+def check_suffix_budget(path=None, budget=1 << 20):
+    # Suffix compactions under a memory budget age out the oldest text, write
+    # only what changed since the last one and reload to the same model;
+    # with small chunks whole ones go, with the default one is cut short.
+    # Returns the failures.
+    from suffix_model import write_suffix_model, CHUNK_CHARS
+
+    lines = load_corpus(path).split('\n')
+    step = len(lines) // 8 + 1
+    recent = '\n'.join(lines[-step:])
+    rng = random.Random(3)
+    contexts = [recent[j:j + ORDER] for j in (rng.randrange(len(recent) - ORDER) for _ in range(200))]
+    failures = []
+    for chunk_chars in (64 * 1024, CHUNK_CHARS):
+        model = SuffixArrayModel(ORDER, chunk_chars=chunk_chars)
+        work = tempfile.mkdtemp(prefix='aniv_check_')
+        target = os.path.join(work, 'markov_suffix.bin')
+        evicted = 0
+        try:
+            for i in range(0, len(lines), step):
+                model.learn('\n'.join(lines[i:i + step]) + '\n')
+                view = model.view()
+                result = write_suffix_model(target, ORDER, 0, view, budget)
+                model.apply_compaction(view, result)
+                evicted += result['evicted_chars']
+            stats = model.stats()
+            files = len(os.listdir(work))
+
+            # nothing learned since: nothing to write
+            view = model.view()
+            idle = write_suffix_model(target, ORDER, 0, view, budget)
+            model.apply_compaction(view, idle)
+
+            loaded = SuffixArrayModel(ORDER)
+            loaded.load(target)
+            mismatched = sum(1 for ctx in contexts if loaded.counts(ctx) != model.counts(ctx) or model.counts(ctx) is None)
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+        print(f"suffix budget, {chunk_chars}-char chunks: {stats['resident_bytes'] / 1e6:.2f} MB resident for a {budget / 1e6:.2f} MB budget, "
+              f"{evicted} chars aged out, {stats['saved_runs']} saved runs in {files} files, "
+              f"{idle['written_runs']} runs rewritten by an idle compaction, {mismatched} contexts differ after reload")
+        if evicted == 0 or stats['resident_bytes'] > budget:
+            failures.append('suffix budget')
+        if idle['written_runs'] or files != stats['text_chunks'] + stats['saved_runs'] + 1:
+            failures.append('suffix incremental compaction')
+        if mismatched or loaded.stats()['indexed_positions'] != model.stats()['indexed_positions']:
+            failures.append('suffix reload')
+    return failures
+
+def check_missing_access_token():
+    # An auth.json with a refresh token but no access token yet is treated
+    # as expired: run() refreshes it on its first pass instead of failing on
+    # every retry. Returns the failures.
+    from auth import Auth, TokenManager
+    from fake_oauth import FakeOAuthServer
+
+    work = tempfile.mkdtemp(prefix='aniv_check_')
+    auth_file = os.path.join(work, 'auth.json')
+    with open(auth_file, 'w') as f:
+        json.dump({'username': 'anivcheck', 'client_id': 'fakeclient', 'client_secret': 'fakesecret',
+            'irc_auth_token': 'oauth:check', 'refresh_token': 'refresh0'}, f)
+
+    async def run():
+        server = FakeOAuthServer()
+        url = await server.start()
+        auth = Auth(auth_file)
+        tokens = TokenManager(auth, base_url=url)
+        runner = asyncio.ensure_future(tokens.run())
+        t = time.perf_counter()
+        while auth.get_access_token() is None and time.perf_counter() - t < 5:
+            await asyncio.sleep(0.01)
+        token = await tokens.get_access_token()
+        runner.cancel()
+        await tokens.close()
+        await server.close()
+        return token == server.access_token, server.token_requests
+
+    try:
+        current, requests = asyncio.run(run())
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    print(f"auth.json without an access token: {requests} refresh request(s), token current: {current}")
+    return [] if current and requests == 1 else ['missing access token']
+
+def check_logger_records():
+    # A record the JSON encoder rejects is dropped and counted; the writer
+    # thread keeps going and the records around it are still written.
+    # Returns the failures.
+    from logger import BufferedLogger
+
+    work = tempfile.mkdtemp(prefix='aniv_check_')
+    try:
+        log = BufferedLogger(os.path.join(work, 'log.jsonl'))
+        log.log('before')
+        log.log('unserializable', value=object())
+        log.flush()
+        log.log('after')
+        log.flush()
+        log.close()
+        with open(os.path.join(work, 'log.jsonl'), 'r', encoding='utf-8') as f:
+            written = [json.loads(line)['msg'] for line in f]
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    stats = log.stats()
+    print(f"logger with unserializable records: wrote {written}, {stats['unserializable']} unserializable")
+    return ['logger'] if written != ['before', 'after'] or stats['unserializable'] != 1 else []
+
+def check_logger_rotation():
+    # An old log file gets its full rotate_interval from when it is opened,
+    # a rotation failing on the idle path is counted without stopping the
+    # writer, and closing and restarting registers the exit hook once.
+    # Returns the failures.
+    import atexit
+    from logger import BufferedLogger
+
+    work = tempfile.mkdtemp(prefix='aniv_check_')
+    path = os.path.join(work, 'log.jsonl')
+    registered = []
+    register = atexit.register
+    replace = os.replace
+    failures = []
+    try:
+        with open(path, 'w') as f:
+            f.write('{}\n')
+        os.utime(path, (time.time() - 7200, time.time() - 7200))
+        atexit.register = lambda fn: registered.append(fn)
+        log = BufferedLogger(path, rotate_interval=3600)
+        log.log('kept')
+        log.flush()
+        log.close()
+        log.log('restarted')
+        log.close()
+        kept = log.stats()['rotations'] == 0
+        hooks = len(registered)
+
+        def failing_replace(src, dst):
+            raise OSError('rotation refused')
+        log = BufferedLogger(path, rotate_interval=0.05, flush_interval=0.05)
+        log.log('before')
+        log.flush()
+        os.replace = failing_replace
+        time.sleep(0.3)
+        os.replace = replace
+        log.log('after')
+        # not flush(): it would wait forever on a writer that died
+        t = time.perf_counter()
+        while log.stats()['written'] < 2 and time.perf_counter() - t < 2:
+            time.sleep(0.01)
+        alive = log.stats()['written'] == 2
+        errors = log.stats()['errors']
+        log.close()
+    finally:
+        atexit.register = register
+        os.replace = replace
+        shutil.rmtree(work, ignore_errors=True)
+
+    print(f"logger rotation: old file kept on open: {kept}, exit hooks for two starts: {hooks}, "
+          f"idle rotation errors {errors} with the writer alive: {alive}")
+    if not kept:
+        failures.append('logger rotation age')
+    if hooks != 1:
+        failures.append('logger exit hook')
+    if not alive or errors == 0:
+        failures.append('logger idle rotation')
+    return failures
+
+def check_service_compaction(path=None):
+    # A client learns of a compaction the service finished with its next
+    # reply, and the bot's compaction path then drops pre-generated replies
+    # made from the old counts. Returns the failures.
+    from aniv import Markov, LOGGER
+    from pregen import PregenCache
+    from model_service import ModelService, ModelClient
+
+    data = load_corpus(path)
+    chunks = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+    context = next(line for line in data.split('\n') if len(line) > ORDER) + '\n'
+    with bot_workdir() as work:
+        async def run():
+            markov = Markov()
+            markov.load()
+            service = ModelService(markov, os.path.join(work, 'model.sock'))
+            await service.start()
+            client = ModelClient(os.path.join(work, 'model.sock'))
+            pregen = PregenCache(client)
+            try:
+                await client.learn_batch(chunks)
+                before = await client.needs_compaction()
+                pregen.prepare('#check', context)
+                await asyncio.sleep(0.5)
+                await service.compact()
+                await client.gen(context)
+                # what Bot.__maintain_model does with the answer
+                after = await client.needs_compaction()
+                if after:
+                    await client.compact()
+                    pregen.invalidate()
+                return before, after, await client.needs_compaction(), pregen.stats()
+            finally:
+                await client.close()
+                await service.close()
+
+        before, after, again, stats = asyncio.run(run())
+        LOGGER.close()
+    print(f"service compaction: needed before {before}, after {after}, after compact() {again}; pregen {stats['generated']} generated, {stats['wasted']} dropped")
+    return ['service compaction'] if before or not after or again or stats['cached'] or not stats['wasted'] else []
+
+def check_ingest_rounds():
+    # A batch the model fails on is lost on its own: the other channels'
+    # batches in the same round are still learned. Parting a channel drops
+    # its queue, including for a put() blocked on it. Returns the failures.
+    from ingest import IngestQueue, BLOCK
+
+    class FlakyModel():
+        def __init__(self):
+            self.learned = []
+
+        async def learn_from_buffer(self, data, source=None):
+            if source[0] == 'bad':
+                raise ValueError('model refused the batch')
+            self.learned.append(source[0])
+
+    async def run():
+        model = FlakyModel()
+        ingest = IngestQueue(model, linger=0)
+        for channel in ('first', 'bad', 'last'):
+            await ingest.put(channel, 'user', 'some chat to learn\n')
+        learner = asyncio.ensure_future(ingest.run())
+        t = time.perf_counter()
+        while ingest.stats()['queued_messages'] and time.perf_counter() - t < 2:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        learner.cancel()
+        failed = ingest.stats()['failed_batches']
+
+        blocking = IngestQueue(model, max_chars=30, policy=BLOCK)
+        await blocking.put('parted', 'user', 'x' * 25)
+        blocked = asyncio.ensure_future(blocking.put('parted', 'user', 'y' * 25))
+        await asyncio.sleep(0.05)
+        dropped = blocking.discard('parted')
+        put = await asyncio.wait_for(blocked, 2)
+        stats = blocking.stats()
+        parted = (dropped == 1 and put is False and blocking.channel_stats('parted') is None
+                  and stats['queued_messages'] == 0 and stats['queued_chars'] == 0 and stats['waiting_channels'] == 0)
+        return sorted(model.learned), failed, parted
+
+    learned, failed, parted = asyncio.run(run())
+    print(f"ingest round with a failing batch: learned {learned}, {failed} failed; parted channel queue dropped: {parted}")
+    failures = []
+    if learned != ['first', 'last'] or failed != 1:
+        failures.append('ingest failed batch')
+    if not parted:
+        failures.append('ingest part')
+    return failures
+
+def check_pregen_refresh():
+    # Candidates generated before a channel's chat is learned are
+    # regenerated once it is, and other channels' entries are left alone.
+    # Returns the failures.
+    from ingest import IngestQueue
+    from pregen import PregenCache
+
+    class CountingModel():
+        def __init__(self):
+            self.learned = 0
+
+        async def learn_from_buffer(self, data, source=None):
+            self.learned += 1
+
+        async def gen_batch(self, contexts):
+            return [f'after {self.learned} batches'] * len(contexts)
+
+    async def run():
+        model = CountingModel()
+        cache = PregenCache(model)
+        ingest = IngestQueue(model, linger=0, on_learned=cache.refresh)
+        cache.prepare('#learns', 'context')
+        cache.prepare('#quiet', 'context')
+        await asyncio.sleep(0.01)
+        await ingest.put('#learns', 'user', 'some chat to learn\n')
+        learner = asyncio.ensure_future(ingest.run())
+        t = time.perf_counter()
+        while ingest.stats()['learned_messages'] == 0 and time.perf_counter() - t < 2:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        learner.cancel()
+        return cache.take('#learns', 'context'), cache.take('#quiet', 'context'), cache.stats()
+
+    learns, quiet, stats = asyncio.run(run())
+    print(f"pregen after a learn: learning channel '{learns}', quiet channel '{quiet}', {stats['wasted']} wasted")
+    if learns != 'after 1 batches' or quiet != 'after 0 batches' or stats['wasted'] != 1:
+        return ['pregen refresh']
+    return []
+
+def check_translation():
+    # GoogleTranslateBackend against stand-ins for both googletrans APIs (4.x
+    # coroutines, 3.x blocking calls): a Spanish line has to come back in
+    # English, not as the untranslated fallback. Then a burst of distinct
+    # texts against a slow backend has to be turned away past the pending
+    # bound instead of queueing. Returns the failures.
+    import googletrans
+    from translate import AsyncTranslator, GoogleTranslateBackend, StubTranslateBackend
+
+    class Result():
+        def __init__(self, **fields):
+            self.__dict__.update(fields)
+
+    words = {'hola': 'hello', 'mundo': 'world'}
+
+    class AsyncClient():
+        async def detect(self, text):
+            await asyncio.sleep(0)
+            return Result(lang='es')
+
+        async def translate(self, text, dest='en', src='auto'):
+            await asyncio.sleep(0)
+            return Result(text=' '.join(words.get(word, word) for word in text.split()), src='es', dest=dest)
+
+    class BlockingClient():
+        def detect(self, text):
+            return Result(lang='es')
+
+        def translate(self, text, dest='en', src='auto'):
+            return Result(text=' '.join(words.get(word, word) for word in text.split()), src='es', dest=dest)
+
+    failures = []
+    translator_class = googletrans.Translator
+    try:
+        for name, client in (('coroutine', AsyncClient), ('blocking', BlockingClient)):
+            googletrans.Translator = client
+            translator = AsyncTranslator(GoogleTranslateBackend())
+            translated = asyncio.run(translator.translate('hola mundo', 'en'))
+            print(f"googletrans {name} API: 'hola mundo' -> {translated!r}")
+            if translated != 'hello world':
+                failures.append(f'translate ({name})')
+    finally:
+        googletrans.Translator = translator_class
+
+    translator = AsyncTranslator(StubTranslateBackend(delay=0.2), workers=2, max_pending=8)
+
+    async def burst():
+        return await asyncio.gather(*(translator.translate(f'message {i}', 'es') for i in range(40)))
+
+    translated = asyncio.run(burst())
+    stats = translator.stats()
+    print(f"40 distinct texts at once, 2 workers and 8 pending: {sum(t.startswith('[es]') for t in translated)} translated, {stats['rejected']} sent untranslated")
+    if stats['rejected'] != 30 or stats['pending'] != 0:
+        failures.append('translate bound')
+    return failures
+
+def bench_check(path=None, channels='20', messages='5000', max_lag_ms='50'):
+    # Asserts what the benches only report, exiting non-zero on a failure:
+    # with the model on its worker thread the event loop never stalls for
+    # max_lag_ms, and a channel gets at most one post per msg_post_rate
+    # messages (never fewer than 10) however the handlers interleave. Also
+    # runs the check_* regressions below.
+    from aniv import Markov
+    from executor import ModelExecutor
+
+    failures = []
+    # the replays run the bot in a throwaway directory; its log must go there
+    repo_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'log.jsonl')
+    repo_log_size = os.path.getsize(repo_log) if os.path.exists(repo_log) else None
+    data = load_corpus(path)
+    model = ModelExecutor(Markov())
+    _, samples = measure_lag(model, data, start_contexts(data))
+    model.shutdown()
+    worst = max(samples, default=0.0) * 1000
+    print(f"loop lag while learning and generating: max {worst:.2f}ms (limit {float(max_lag_ms):.0f}ms)")
+    if worst > float(max_lag_ms):
+        failures.append('loop lag')
+    failures.extend(check_compaction_touches(path))
+    failures.extend(check_suffix_merge_compaction(path))
+    failures.extend(check_suffix_budget(path))
+    failures.extend(check_missing_access_token())
+    failures.extend(check_logger_records())
+    failures.extend(check_logger_rotation())
+    failures.extend(check_service_compaction(path))
+    failures.extend(check_translation())
+    failures.extend(check_ingest_rounds())
+    failures.extend(check_pregen_refresh())
+
+    chat = replay_messages(path, int(channels), int(messages))
+    received = collections.Counter(channel for channel, _, _ in chat)
+    out = os.path.join(tempfile.mkdtemp(prefix='aniv_check_'), 'replay.json')
+    try:
+        for threaded in ('0', '1'):
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                results = bench_replay(path, channels, messages, '0', out, threaded)
+            over = {channel: posts for channel, posts in results['channel_posts'].items() if posts > received[channel] // 10}
+            print(f"{'threaded' if threaded != '0' else 'inline'} replay: {results['posts']} posts for {results['messages']} messages, {len(over)} channels over one post per 10 messages")
+            if over:
+                failures.append(f"posts ({'threaded' if threaded != '0' else 'inline'})")
+    finally:
+        shutil.rmtree(os.path.dirname(out), ignore_errors=True)
+    if (os.path.getsize(repo_log) if os.path.exists(repo_log) else None) != repo_log_size:
+        print(f"the replays wrote to {repo_log}")
+        failures.append('log')
+
+    if failures:
+        print("FAILED:", ', '.join(failures))
+        sys.exit(1)
+    print("OK")
+
+def bench_translate(delay='0.05', timeout='1.0', backend='stub'):
+    # bursts of repeated translations against the stub backend, or with
+    # backend=google a few real ones, which must come back translated
+    from translate import AsyncTranslator, StubTranslateBackend, GoogleTranslateBackend
+
+    if backend == 'google':
+        translator = AsyncTranslator(GoogleTranslateBackend(), timeout=float(timeout))
+        texts = [('hola, ¿cómo estás?', 'en'), ('good morning everyone', 'es'), ('danke schön', 'en')]
+
+        async def live():
+            return await asyncio.gather(*(translator.translate(text, dest) for text, dest in texts))
+
+        translated = asyncio.run(live())
+        for (text, dest), result in zip(texts, translated):
+            print(f"{text!r} -> {dest}: {result!r}")
+        print(translator.stats())
+        if any(result == text for (text, _), result in zip(texts, translated)):
+            print("FAILED: returned untranslated")
+            sys.exit(1)
+        return translator.stats()
+
+    backend = StubTranslateBackend(delay=float(delay))
+    translator = AsyncTranslator(backend, workers=4, timeout=float(timeout))
+    rng = random.Random(0)
+    texts = [f'message {i}' for i in range(200)]
+
+    async def run():
+        t = time.perf_counter()
+        for _ in range(40):
+            await asyncio.gather(*(translator.translate(rng.choice(texts), rng.choice(('es', 'de'))) for _ in range(50)))
+        return time.perf_counter() - t
+
+    elapsed = asyncio.run(run())
+    stats = translator.stats()
+    print(f"2000 translations in {elapsed:.2f}s: {stats}, backend detect/translate calls: {backend.detect_calls}/{backend.translate_calls}")
+    return stats
+
+class FakeChannel():
+    # stands in for twitchio's Channel; send() only records what was posted
+    def __init__(self, name):
+        self.name = name
+        self.sent = []
+
+    async def send(self, content):
+        self.sent.append(content)
+
+class FakeAuthor():
+    def __init__(self, name):
+        self.name = name
+        self.display_name = name
+
+class FakeMessage():
+    def __init__(self, channel, author, content):
+        self.channel = channel
+        self.author = author
+        self.content = content
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def replay_messages(path, channels, messages):
+    # (channel, user, message) triples from a chat log in any format the
+    # trainer reads, or synthetic chat spread over the given channel count
+    if path:
+        from trainer import parse_log_line
+        out = []
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for i, line in enumerate(f):
+                if len(out) >= messages:
+                    break
+                channel, user, message = parse_log_line(line)
+                if message:
+                    out.append((channel or f'chan{i % channels}', user or f'user{i % 97}', message))
+        return out
+    rng = random.Random(2)
+    lines = [line for line in load_corpus(lines=messages).split('\n') if line]
+    return [(f'chan{rng.randrange(channels)}', f'user{rng.randrange(500)}', line) for line in lines]
+
+def timed(fn, samples):
+    def wrapper(*args):
+        t = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            samples.append(time.perf_counter() - t)
+    return wrapper
+
+def timed_async(fn, samples):
+    async def wrapper(*args):
+        t = time.perf_counter()
+        try:
+            return await fn(*args)
+        finally:
+            samples.append(time.perf_counter() - t)
+    return wrapper
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+@contextlib.contextmanager
+def bot_workdir(channels=None):
+    # a throwaway working directory seeded like a deployment, since the bot
+    # reads and writes its files relative to the working directory
+    repo = os.path.dirname(os.path.abspath(__file__))
+    work = tempfile.mkdtemp(prefix='aniv_bench_')
+    cwd = os.getcwd()
+    try:
+        shutil.copytree(os.path.join(repo, 'data'), os.path.join(work, 'data'))
+        if os.path.exists(os.path.join(repo, 'profanity_wordlist.txt')):
+            shutil.copy(os.path.join(repo, 'profanity_wordlist.txt'), work)
+        with open(os.path.join(work, 'auth.json'), 'w') as f:
+            json.dump({'username': 'anivbench', 'irc_auth_token': 'oauth:bench'}, f)
+        if channels is not None:
+            with open(os.path.join(work, 'data', 'channels.json'), 'w') as f:
+                json.dump({'channels': channels}, f)
+        os.chdir(work)
+        yield work
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+
+def bench_replay(path=None, channels='20', messages='20000', rate='0', out='bench_replay.json', threaded='1', metrics='0', pregen='0'):
+    # Feeds chat through Bot.event_message the way twitchio dispatches it (one
+    # task per message) without a connection: channels and authors are fakes
+    # and posts are recorded instead of sent. rate is the offered load in
+    # messages per second, 0 for as fast as possible.
+    out = os.path.abspath(out)
+    chat = replay_messages(path, int(channels), int(messages))
+    rate = float(rate)
+
+    with bot_workdir():
+        from aniv import Markov, Bot, LOGGER
+        from metrics import Registry
+        from executor import InlineModel, ModelExecutor
+        from pregen import PregenCache
+        registry = Registry(enabled=metrics != '0')
+        markov = Markov(metrics=registry)
+        markov.load()
+        samples = {name: [] for name in ('gen', 'hasResponse', 'learn_from_buffer', 'save_buffers_sync')}
+        for name, values in samples.items():
+            setattr(markov, name, timed(getattr(markov, name), values))
+        model = ModelExecutor(markov) if threaded != '0' else InlineModel(markov)
+        cache = PregenCache(model, metrics=registry) if pregen != '0' else None
+        # generation the message path waits for, which pre-generation removes
+        samples['post_gen'] = []
+        model.gen = timed_async(model.gen, samples['post_gen'])
+        fake_channels = dict()
+
+        async def run():
+            # twitchio binds the bot to the running loop, so it is built here
+            bot = Bot(markov, metrics=registry, model=model, pregen=cache)
+            bot.reply_delay = (0, 0)
+            bot.mention_reply_delay = (0, 0)
+            lag = []
+            timeline = []
+            monitor = asyncio.ensure_future(monitor_loop_lag(lag))
+            learner = asyncio.ensure_future(bot.learn_new_data())
+            start_rss = rss_bytes()
+
+            async def sample_rss():
+                while True:
+                    timeline.append((time.perf_counter() - t, rss_bytes()))
+                    await asyncio.sleep(0.5)
+
+            t = time.perf_counter()
+            cpu = time.process_time()
+            sampler = asyncio.ensure_future(sample_rss())
+            tasks = []
+            for i, (channel, user, content) in enumerate(chat):
+                if channel not in fake_channels:
+                    fake_channels[channel] = FakeChannel(channel)
+                message = FakeMessage(fake_channels[channel], FakeAuthor(user), content)
+                tasks.append(asyncio.ensure_future(bot.event_message(message)))
+                if rate > 0:
+                    delay = t + (i + 1) / rate - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                elif i % 100 == 99:
+                    await asyncio.sleep(0)
+            await asyncio.gather(*tasks)
+            ingest_time = time.perf_counter() - t
+            # every thread's CPU time, learning on the worker included
+            ingest_cpu = time.process_time() - cpu
+            # one last pass of the learner, then the journal flush it batches
+            await asyncio.sleep(1.1)
+            await model.save_buffers()
+            elapsed = time.perf_counter() - t
+            for task in (monitor, learner, sampler):
+                task.cancel()
+            timeline.append((elapsed, rss_bytes()))
+            return ingest_time, ingest_cpu, elapsed, lag, start_rss, timeline
+
+        # the bot logs joins and every post; keep that out of the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            ingest_time, ingest_cpu, elapsed, lag, start_rss, timeline = asyncio.run(run())
+        if threaded != '0':
+            model.shutdown()
+        LOGGER.close()
+
+    def latency(values):
+        return {
+            'count': len(values),
+            'p50_ms': percentile(values, 50) * 1000,
+            'p90_ms': percentile(values, 90) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': max(values, default=0.0) * 1000,
+        }
+
+    results = {
+        'revision': git_revision(),
+        'source': path or 'synthetic',
+        'channels': len(fake_channels),
+        'messages': len(chat),
+        'offered_rate': rate,
+        'threaded': threaded != '0',
+        'metrics': registry.is_enabled(),
+        'ingest_seconds': ingest_time,
+        'messages_per_second': len(chat) / max(ingest_time, 1e-9),
+        'ingest_cpu_seconds': ingest_cpu,
+        'messages_per_cpu_second': len(chat) / max(ingest_cpu, 1e-9),
+        'posts': sum(len(c.sent) for c in fake_channels.values()),
+        'channel_posts': {name: len(c.sent) for name, c in fake_channels.items()},
+        'latency': {name: latency(values) for name, values in samples.items()},
+        'loop_lag': latency(lag),
+        'rss_start_bytes': start_rss,
+        'rss_end_bytes': timeline[-1][1],
+        'rss_timeline': timeline,
+        'model': markov.stats(),
+        'pregen': cache.stats() if cache is not None else None,
+    }
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    print(f"{results['messages']} messages over {results['channels']} channels in {ingest_time:.2f}s: {results['messages_per_second']:.0f} msgs/s, {results['messages_per_cpu_second']:.0f} msgs per CPU second, {results['posts']} posts")
+    for name, values in results['latency'].items():
+        print(f"  {name.ljust(17)}: n={values['count']:6d} p50 {values['p50_ms']:7.2f}ms p99 {values['p99_ms']:7.2f}ms max {values['max_ms']:7.2f}ms")
+    print(f"  loop lag         : p50 {results['loop_lag']['p50_ms']:7.2f}ms p99 {results['loop_lag']['p99_ms']:7.2f}ms max {results['loop_lag']['max_ms']:7.2f}ms")
+    print(f"  rss              : {start_rss / 1e6:.1f} MB -> {results['rss_end_bytes'] / 1e6:.1f} MB")
+    if results['pregen'] is not None:
+        p = results['pregen']
+        print(f"  pregen           : hit rate {p['hit_rate']:.1%}, {p['generated']} generated, {p['wasted']} wasted")
+    print(f"Wrote {out}")
+    return results
+
+def bench_preprocess(path=None, channels='20', messages='50000', rounds='5', out='bench_preprocess.json'):
+    # CPU the bot spends on each chat line before the model sees it: the
+    # handlers run one message at a time on one thread, with the model calls
+    # answering at once, so only normalizing, filtering, the rolling context
+    # and queueing for the learner are counted.
+    out = os.path.abspath(out)
+    chat = replay_messages(path, int(channels), int(messages))
+
+    class IdleModel():
+        async def has_response(self, msg):
+            return False
+
+        async def gen(self, msg):
+            return None
+
+    with bot_workdir():
+        from aniv import Markov, Bot, LOGGER
+        markov = Markov()
+        markov.load()
+        fake_channels = {channel: FakeChannel(channel) for channel, _, _ in chat}
+        authors = {user: FakeAuthor(user) for _, user, _ in chat}
+        feed = [FakeMessage(fake_channels[channel], authors[user], content) for channel, user, content in chat]
+
+        async def run():
+            # twitchio binds the bot to the running loop, so it is built here
+            bot = Bot(markov, model=IdleModel())
+            best = None
+            for _ in range(int(rounds)):
+                t = time.process_time()
+                for message in feed:
+                    await bot.event_message(message)
+                elapsed = time.process_time() - t
+                best = elapsed if best is None else min(best, elapsed)
+            return best
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            cpu = asyncio.run(run())
+        LOGGER.close()
+
+    results = {
+        'revision': git_revision(),
+        'source': path or 'synthetic',
+        'messages': len(feed),
+        'cpu_seconds': cpu,
+        'messages_per_cpu_second': len(feed) / max(cpu, 1e-9),
+        'us_per_message': cpu / max(len(feed), 1) * 1e6,
+    }
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"{results['messages']} messages: {results['messages_per_cpu_second']:.0f} msgs per CPU second ({results['us_per_message']:.1f}us each)")
+    print(f"Wrote {out}")
+    return results
+
+def bench_auth(callers='200', validations='100', delay='0.05', out='bench_auth.json'):
+    # TokenManager against a local fake OAuth endpoint: how many refresh
+    # requests a crowd of callers holding an expired token causes, how many
+    # connections repeated validations open, and the event loop lag meanwhile.
+    out = os.path.abspath(out)
+    from auth import Auth, TokenManager
+    from fake_oauth import FakeOAuthServer
+    work = tempfile.mkdtemp(prefix='aniv_bench_')
+    auth_file = os.path.join(work, 'auth.json')
+    with open(auth_file, 'w') as f:
+        json.dump({'username': 'anivbench', 'client_id': 'fakeclient', 'client_secret': 'fakesecret',
+            'irc_auth_token': 'oauth:bench', 'access_token': 'access0', 'refresh_token': 'refresh0',
+            'expires_at': int(time.time()) - 1}, f)
+
+    async def run():
+        server = FakeOAuthServer(delay=float(delay))
+        url = await server.start()
+        auth = Auth(auth_file)
+        tokens = TokenManager(auth, base_url=url)
+        lag = []
+        monitor = asyncio.ensure_future(monitor_loop_lag(lag))
+        results = {}
+
+        t = time.perf_counter()
+        got = await asyncio.gather(*(tokens.get_access_token() for _ in range(int(callers))))
+        results['refresh'] = {
+            'callers': int(callers),
+            'seconds': time.perf_counter() - t,
+            'token_requests': server.token_requests,
+            'distinct_tokens': len(set(got)),
+        }
+
+        t = time.perf_counter()
+        valid = 0
+        for _ in range(int(validations)):
+            valid += await tokens.validate()
+        results['validate'] = {
+            'requests': int(validations),
+            'valid': valid,
+            'seconds': time.perf_counter() - t,
+            'connections': len(server.connections),
+        }
+
+        # a revoked token is replaced on the next pass of run()
+        server.revoke()
+        runner = asyncio.ensure_future(tokens.run())
+        t = time.perf_counter()
+        while not await tokens.validate() and time.perf_counter() - t < 10:
+            await asyncio.sleep(0.01)
+        results['revoked_recovery_seconds'] = time.perf_counter() - t
+        runner.cancel()
+
+        with open(auth_file, 'r') as f:
+            saved = json.load(f)
+        results['saved_token_current'] = saved['access_token'] == server.access_token and saved['refresh_token'] == server.refresh_token
+        results['stats'] = tokens.stats()
+        results['loop_lag_p99_ms'] = percentile(lag, 99) * 1000
+        results['loop_lag_max_ms'] = max(lag, default=0.0) * 1000
+        monitor.cancel()
+        await tokens.close()
+        await server.close()
+        return results
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    results['revision'] = git_revision()
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=4)
+    r = results['refresh']
+    v = results['validate']
+    print(f"{r['callers']} callers with an expired token: {r['token_requests']} refresh request(s), {r['distinct_tokens']} distinct token(s), {r['seconds'] * 1000:.0f}ms")
+    print(f"{v['requests']} validations over {v['connections']} connection(s) in {v['seconds']:.2f}s")
+    print(f"revoked token replaced in {results['revoked_recovery_seconds'] * 1000:.0f}ms; saved tokens current: {results['saved_token_current']}")
+    print(f"loop lag p99 {results['loop_lag_p99_ms']:.2f}ms max {results['loop_lag_max_ms']:.2f}ms")
+    print(f"Wrote {out}")
+    return results
+
+def bench_shards(channels='200', shards='4', messages='20000', join_rate='2', join_burst='20', out='bench_shards.json'):
+    # Runs sharded bots over real twitchio connections to a local fake IRC
+    # server: how long joining every channel takes, the most joins seen in
+    # any 10 second window (failing if that is over join_burst), chat
+    # throughput across the shards, and whether !summon / !unsummon in the
+    # bot's own channel reach the shard that owns the summoner's channel.
+    import aiohttp
+    import twitchio.websocket
+    from fake_irc import FakeIRCServer
+    from metrics import Registry
+    from sharding import shard_of
+
+    out = os.path.abspath(out)
+    names = [f'chan{i}' for i in range(int(channels))]
+    chat = replay_messages(None, len(names), int(messages))
+    # the bot's own channel, where summons are typed
+    home = 'anivbench'
+
+    with bot_workdir(names + [home]):
+        from aniv import Markov, LOGGER, create_bots
+        registry = Registry()
+        markov = Markov(metrics=registry)
+        markov.load()
+
+        async def run():
+            server = FakeIRCServer()
+            twitchio.websocket.HOST = await server.start()
+            bots = create_bots(markov, registry, int(shards), float(join_rate), int(join_burst))
+            tasks = []
+            for bot in bots:
+                bot.reply_delay = (0, 0)
+                bot.mention_reply_delay = (0, 0)
+                # twitchio checks the token over HTTPS unless it already knows
+                # the nick, and otherwise only opens its session while doing so
+                bot._http.nick = home
+                bot._http.session = aiohttp.ClientSession()
+                tasks.append(asyncio.ensure_future(bot.start()))
+                tasks.append(asyncio.ensure_future(bot.process_channel_joins()))
+                tasks.append(asyncio.ensure_future(bot.learn_new_data()))
+
+            t = time.perf_counter()
+            while len(server.joined_channels()) < len(names) + 1 and time.perf_counter() - t < 900:
+                await asyncio.sleep(0.1)
+            join_time = time.perf_counter() - t
+            joined = len(server.joined_channels())
+            times = sorted(ts for ts, _, _ in server.joins)
+            # joins in any 10 second window [x, x + 10)
+            peak = max((bisect.bisect_left(times, x + 10) - i for i, x in enumerate(times)), default=0)
+
+            handled = registry.counter('messages_total', 'Chat messages handled')
+            before = handled.value
+            t = time.perf_counter()
+            for i, (channel, user, content) in enumerate(chat):
+                await server.say(channel, user, content)
+                if i % 100 == 99:
+                    await asyncio.sleep(0)
+            while handled.value - before < len(chat) and time.perf_counter() - t < 300:
+                await asyncio.sleep(0.05)
+            ingest_time = time.perf_counter() - t
+
+            # a viewer whose channel belongs to a different shard than home,
+            # when there is more than one
+            viewers = (f'viewer{i}' for i in range(1000))
+            viewer = next(v for v in viewers if len(bots) == 1 or shard_of(v, len(bots)) != shard_of(home, len(bots)))
+            owner = bots[shard_of(viewer, len(bots))]
+            await server.say(home, viewer, '!summon')
+            t = time.perf_counter()
+            while viewer not in server.joined_channels() and time.perf_counter() - t < 30:
+                await asyncio.sleep(0.05)
+            summoned = viewer in server.joined_channels() and owner.has_channel(viewer)
+            await server.say(home, viewer, '!unsummon')
+            t = time.perf_counter()
+            while viewer in server.joined_channels() and time.perf_counter() - t < 30:
+                await asyncio.sleep(0.05)
+            unsummoned = viewer not in server.joined_channels() and not owner.has_channel(viewer)
+
+            for bot in bots:
+                await bot.close()
+            for task in tasks:
+                task.cancel()
+            await server.close()
+            return {
+                'channels': len(names) + 1,
+                'joined': joined,
+                'shards': len(bots),
+                'join_seconds': join_time,
+                'peak_joins_per_10s': peak,
+                'messages': len(chat),
+                'handled': handled.value - before,
+                'ingest_seconds': ingest_time,
+                'messages_per_second': (handled.value - before) / max(ingest_time, 1e-9),
+                'posts': len(server.sent),
+                'channels_per_shard': [len(bot.msg_data) for bot in bots],
+                'summon_joined_on_owner': summoned,
+                'unsummon_parted_on_owner': unsummoned,
+            }
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = asyncio.run(run())
+        LOGGER.close()
+
+    results['revision'] = git_revision()
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"joined {results['joined']}/{results['channels']} channels over {results['shards']} shards in {results['join_seconds']:.1f}s (peak {results['peak_joins_per_10s']} joins per 10s)")
+    print(f"handled {results['handled']}/{results['messages']} messages in {results['ingest_seconds']:.2f}s: {results['messages_per_second']:.0f} msgs/s, {results['posts']} posts, channels per shard {results['channels_per_shard']}")
+    print(f"summon joined on the owning shard: {results['summon_joined_on_owner']}, unsummon parted: {results['unsummon_parted_on_owner']}")
+    print(f"Wrote {out}")
+    # the fake server stamps joins on arrival, as Twitch counts them
+    if results['peak_joins_per_10s'] > int(join_burst):
+        print(f"FAILED: {results['peak_joins_per_10s']} joins in a 10s window, limit {join_burst}")
+        sys.exit(1)
+    return results
+
+def bench_service(requests='5000', batch='64', out='bench_service.json'):
+    # Generation through the model service against the in-process worker
+    # thread: one request at a time, many concurrent requests (coalesced by
+    # the client into batch frames) and explicit gen_batch calls.
+    from aniv import Markov, LOGGER
+    from executor import ModelExecutor
+    from model_service import ModelClient
+
+    out = os.path.abspath(out)
+    requests = int(requests)
+    batch = int(batch)
+    data = load_corpus()
+    lines = [line + '\n' for line in data.split('\n') if len(line) > 10]
+    rng = random.Random(3)
+    inputs = [rng.choice(lines) for _ in range(requests)]
+    chunks = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+
+    async def measure(model):
+        results = dict()
+        t = time.perf_counter()
+        for inp in inputs:
+            await model.gen(inp)
+        results['sequential'] = requests / (time.perf_counter() - t)
+        t = time.perf_counter()
+        await asyncio.gather(*(model.gen(inp) for inp in inputs))
+        results['concurrent'] = requests / (time.perf_counter() - t)
+        t = time.perf_counter()
+        for i in range(0, requests, batch):
+            await model.gen_batch(inputs[i:i + batch])
+        results['batched'] = requests / (time.perf_counter() - t)
+        return results
+
+    with bot_workdir() as work:
+        sock = os.path.join(work, 'model.sock')
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aniv.py'), 'serve', sock],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            async def run():
+                t = time.perf_counter()
+                while not os.path.exists(sock):
+                    if server.poll() is not None or time.perf_counter() - t > 60:
+                        raise RuntimeError("Model service did not start")
+                    await asyncio.sleep(0.05)
+                client = ModelClient(sock)
+                await client.learn_batch(chunks)
+                results = {'service': await measure(client)}
+                await client.close()
+
+                markov = Markov()
+                markov.load()
+                executor = ModelExecutor(markov)
+                await executor.learn_batch(chunks)
+                results['executor'] = await measure(executor)
+                executor.shutdown()
+                return results
+
+            results = asyncio.run(run())
+        finally:
+            server.terminate()
+            server.wait()
+        LOGGER.close()
+
+    results.update({'requests': requests, 'batch': batch, 'revision': git_revision()})
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=4)
+    for name in ('executor', 'service'):
+        r = results[name]
+        print(f"{name:>8}: sequential {r['sequential']:.0f} req/s, concurrent {r['concurrent']:.0f} req/s, batches of {batch} {r['batched']:.0f} req/s")
+    print(f"Wrote {out}")
+    return results
+
+def bench_settings(channels='2000', commands='2000', out='bench_settings.json'):
+    # A burst of !msgrate-style updates against a populated channel list:
+    # time spent on the event loop per command and until everything is on
+    # disk, rewriting the JSON files versus the SQLite store.
+    out = os.path.abspath(out)
+    channels = int(channels)
+    commands = int(commands)
+    names = [f'chan{i}' for i in range(channels)]
+    rng = random.Random(4)
+    updates = [(rng.choice(names), rng.randint(14, 60)) for _ in range(commands)]
+
+    with bot_workdir(names):
+        from aniv import UserSettings, LOGGER
+        from store import SettingsStore
+
+        def save_json_file(path, contents):
+            # what each update cost before the store: back up the old file,
+            # then rewrite the whole thing
+            shutil.copy2(path, 'data/backups')
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(contents, f, indent=4)
+
+        settings = {'default': {'post_min': 30, 'post_max': 70, 'translate': []}}
+        for name in names:
+            settings[name] = {'post_min': 30, 'post_max': 70, 'translate': ['en']}
+        with open('data/channel_settings.json', 'w') as f:
+            json.dump(settings, f)
+        os.makedirs('data/backups', exist_ok=True)
+
+        results = dict()
+        t = time.perf_counter()
+        for channel, rate in updates:
+            settings[channel]['post_min'] = rate
+            settings[channel]['post_max'] = rate + 20
+            save_json_file('data/channel_settings.json', settings)
+        elapsed = time.perf_counter() - t
+        results['json'] = {'loop_ms_per_command': elapsed / commands * 1000, 'seconds_to_disk': elapsed}
+
+        async def run():
+            store = SettingsStore()
+            user_settings = UserSettings(store, translator=object())
+            samples = []
+            t = time.perf_counter()
+            for i, (channel, rate) in enumerate(updates):
+                s = time.perf_counter()
+                user_settings.set_post_range(channel, rate, rate + 20)
+                samples.append(time.perf_counter() - s)
+                if i % 50 == 49:
+                    await asyncio.sleep(0)
+            await store.flush()
+            elapsed = time.perf_counter() - t
+            stats = store.stats()
+            store.close()
+            return {
+                'loop_ms_per_command': sum(samples) / commands * 1000,
+                'seconds_to_disk': elapsed,
+                'commits': stats['commits'],
+                'rows_written': stats['rows_written'],
+                'coalesced': stats['coalesced'],
+            }
+
+        results['store'] = asyncio.run(run())
+        LOGGER.close()
+
+    results.update({'channels': channels, 'commands': commands, 'revision': git_revision()})
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=4)
+    for name in ('json', 'store'):
+        r = results[name]
+        print(f"{name:>6}: {r['loop_ms_per_command']:.3f}ms on the loop per command, {r['seconds_to_disk']:.2f}s until on disk")
+    print(f"store: {results['store']['commits']} commits, {results['store']['rows_written']} rows written, {results['store']['coalesced']} updates coalesced")
+    print(f"Wrote {out}")
+    return results
+
+def bench_batch(path=None, calls='300', gate='128', out='bench_batch.json'):
+    # Markov.gen_candidates with the candidates drawn one at a time versus
+    # all together by the numpy sampler, for a range of request sizes. The
+    # sampler is only used from gate candidates up (Markov's default
+    # gen_batch), so it has to win from there; exits non-zero if it doesn't.
+    out = os.path.abspath(out)
+    calls = int(calls)
+    gate = int(gate)
+    data = load_corpus(path)
+    lines = [line + '\n' for line in data.split('\n') if len(line) > 10]
+    rng = random.Random(5)
+    inputs = [rng.choice(lines) for _ in range(calls)]
+
+    results = {'calls': calls, 'gate': gate, 'runs': []}
+    with bot_workdir():
+        from aniv import Markov, LOGGER
+        for k in (4, 16, 64, 128, 256):
+            for name, gen_batch in (('scalar', 0), ('batch', 2)):
+                markov = Markov(gen_batch=gen_batch)
+                for i in range(0, len(data), 4096):
+                    markov.learn_from_buffer(data[max(0, i - ORDER):i + 4096])
+                random.seed(0)
+                # the first pass meets every context cold; the second reuses
+                # the sampling tables and compiled states it left behind
+                for phase in ('cold', 'warm'):
+                    t = time.perf_counter()
+                    candidates = sum(len(markov.gen_candidates(inp, k) or []) for inp in inputs)
+                    elapsed = time.perf_counter() - t
+                    run = {
+                        'k': k,
+                        'sampler': name,
+                        'phase': phase,
+                        'ms_per_call': elapsed / calls * 1000,
+                        'candidates_per_second': candidates / elapsed,
+                    }
+                    results['runs'].append(run)
+                    print(f"{k:3d} candidates {name:>6} {phase}: {run['ms_per_call']:7.2f}ms per call, {run['candidates_per_second']:8.0f} candidates/s")
+        LOGGER.close()
+
+    results['revision'] = git_revision()
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"Wrote {out}")
+    times = {(run['k'], run['sampler'], run['phase']): run['ms_per_call'] for run in results['runs']}
+    losing = sorted({k for k, name, phase in times if k >= gate and times[k, 'batch', phase] >= times[k, 'scalar', phase]})
+    if losing:
+        print(f"FAILED: the sampler is slower than one at a time for {losing} candidates, at or above the {gate} gate")
+        sys.exit(1)
+    return results
+
+def bench_unlearn(path=None, channels='20', messages='50000', out='bench_unlearn.json'):
+    # Learns replayed chat with and without provenance, then unlearns the
+    # busiest user, one channel and one mid-frequency word through a
+    # ModelExecutor while gen keeps being called, as it would be by chat.
+    out = os.path.abspath(out)
+    chat = replay_messages(path, int(channels), int(messages))
+    users = collections.Counter(user for _, user, _ in chat)
+    words = [word for word, _ in collections.Counter(word for _, _, message in chat for word in message.split()).most_common(300)]
+    scopes = [
+        ('user', {'users': [users.most_common(1)[0][0]]}),
+        ('channel', {'channels': [chat[0][0]]}),
+        ('pattern', {'patterns': [words[-1]]}),
+    ]
+    starts = [message[:ORDER] for _, _, message in chat[:200] if len(message) > ORDER]
+
+    def buffers():
+        # per channel, the way Bot.learn_new_data hands chat to the model
+        streams = dict()
+        for i, (channel, user, message) in enumerate(chat):
+            stream = streams.setdefault(channel, ['', []])
+            stream[0] += message + '\n'
+            stream[1].append((user, len(message) + 1))
+            if i % 200 == 199 or i == len(chat) - 1:
+                for name, (data, authors) in streams.items():
+                    if authors:
+                        yield data, (name, authors)
+                    streams[name] = [data[-ORDER:], []]
+
+    results = {'messages': len(chat), 'scopes': []}
+    with bot_workdir():
+        from aniv import Markov, LOGGER
+        from executor import ModelExecutor
+
+        for provenance in (False, True):
+            markov = Markov(provenance=provenance)
+            raw = 0
+            t = time.perf_counter()
+            for data, source in buffers():
+                markov.learn_from_buffer(data, source)
+                raw += len(data.encode('utf-8'))
+            markov.save_buffers_sync()
+            elapsed = time.perf_counter() - t
+            results['provenance' if provenance else 'plain'] = {'learn_seconds': elapsed, 'learned_bytes': raw}
+        stats = markov.stats()
+        results['provenance']['stored_bytes'] = stats['provenance_bytes']
+        results['provenance']['chunks'] = stats['provenance_chunks']
+
+        async def run():
+            model = ModelExecutor(markov)
+            for name, scope in scopes:
+                latencies = []
+                job = asyncio.ensure_future(markov.get_provenance().unlearn(model, **scope))
+                t = time.perf_counter()
+                while not job.done():
+                    await timed_async(model.gen, latencies)(random.choice(starts))
+                elapsed = time.perf_counter() - t
+                result = job.result()
+                results['scopes'].append({
+                    'scope': name,
+                    'value': list(scope.values())[0][0],
+                    'seconds': elapsed,
+                    'messages': result['messages'],
+                    'chars': result['chars'],
+                    'gens_meanwhile': len(latencies),
+                    'gen_p50_ms': percentile(latencies, 50) * 1000,
+                    'gen_p99_ms': percentile(latencies, 99) * 1000,
+                })
+            model.shutdown()
+
+        asyncio.run(run())
+        LOGGER.close()
+
+    results['revision'] = git_revision()
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=4)
+    plain = results['plain']
+    prov = results['provenance']
+    print(f"learn: {plain['learn_seconds']:.2f}s plain, {prov['learn_seconds']:.2f}s with provenance")
+    print(f"provenance: {prov['stored_bytes']} bytes in {prov['chunks']} chunks for {prov['learned_bytes']} bytes learned ({prov['stored_bytes'] / prov['learned_bytes']:.0%})")
+    for r in results['scopes']:
+        print(f"unlearn {r['scope']:>7} {r['value']!r}: {r['messages']} messages in {r['seconds']:.2f}s, {r['gens_meanwhile']} gens meanwhile, p50 {r['gen_p50_ms']:.2f}ms p99 {r['gen_p99_ms']:.2f}ms")
+    print(f"Wrote {out}")
+    return results
+
+def bench_ingest(path=None, quiet='20', quiet_rate='10', raid_rate='4000', seconds='5', out='bench_ingest.json'):
+    # One channel raided at raid_rate messages per second while quiet
+    # channels chat at quiet_rate each, fed through IngestQueue into a
+    # threaded model under every full-queue policy: how long quiet chat
+    # waits to be learned, how far the raided channel falls behind, and how
+    # much chat is queued or dropped.
+    from ingest import IngestQueue, POLICIES
+    out = os.path.abspath(out)
+    quiet = int(quiet)
+    quiet_rate = float(quiet_rate)
+    raid_rate = float(raid_rate)
+    seconds = float(seconds)
+    lines = [line + '\n' for line in load_corpus(path).split('\n') if line]
+    rng = random.Random(6)
+    schedule = [(i / raid_rate, 'raid') for i in range(int(raid_rate * seconds))]
+    for c in range(quiet):
+        schedule += [(i / quiet_rate + rng.random() / quiet_rate, f'quiet{c}') for i in range(int(quiet_rate * seconds))]
+    schedule.sort()
+
+    results = {'quiet_channels': quiet, 'quiet_rate': quiet_rate, 'raid_rate': raid_rate, 'seconds': seconds, 'runs': []}
+    with bot_workdir():
+        from aniv import Markov, LOGGER
+        from executor import ModelExecutor
+        for policy in POLICIES:
+            model = ModelExecutor(Markov())
+            ingest = IngestQueue(model, policy=policy)
+
+            async def run():
+                learner = asyncio.ensure_future(ingest.run())
+                quiet_lags = []
+                raid_lags = []
+                peak = 0
+
+                async def sample():
+                    nonlocal peak
+                    while True:
+                        lags = ingest.lags()
+                        quiet_lags.extend(lag for channel, lag in lags.items() if channel != 'raid')
+                        raid_lags.append(lags.get('raid', 0.0))
+                        peak = max(peak, ingest.stats()['queued_chars'])
+                        await asyncio.sleep(0.05)
+
+                sampler = asyncio.ensure_future(sample())
+                t = time.perf_counter()
+                for i, (at, channel) in enumerate(schedule):
+                    delay = t + at - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    await ingest.put(channel, f'user{i % 500}', lines[i % len(lines)])
+                fed = time.perf_counter() - t
+                while ingest.stats()['queued_messages'] > 0:
+                    await asyncio.sleep(0.05)
+                drained = time.perf_counter() - t
+                sampler.cancel()
+                learner.cancel()
+                return fed, drained, quiet_lags, raid_lags, peak
+
+            fed, drained, quiet_lags, raid_lags, peak = asyncio.run(run())
+            model.shutdown()
+            stats = ingest.stats()
+            run = {
+                'policy': policy,
+                'feed_seconds': fed,
+                'drain_seconds': drained,
+                'quiet_lag_p50_ms': percentile(quiet_lags, 50) * 1000,
+                'quiet_lag_p99_ms': percentile(quiet_lags, 99) * 1000,
+                'raid_lag_max_ms': max(raid_lags, default=0.0) * 1000,
+                'peak_queued_chars': peak,
+                'learned_messages': stats['learned_messages'],
+                'dropped_messages': stats['dropped_messages'],
+                'rounds': stats['rounds'],
+            }
+            results['runs'].append(run)
+            print(f"{policy:>11}: fed in {fed:.2f}s, drained at {drained:.2f}s; quiet lag p50 {run['quiet_lag_p50_ms']:.0f}ms p99 {run['quiet_lag_p99_ms']:.0f}ms; raid lag max {run['raid_lag_max_ms']:.0f}ms; peak {peak} chars queued; {run['learned_messages']} learned, {run['dropped_messages']} dropped")
+        LOGGER.close()
+
+    results['revision'] = git_revision()
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"Wrote {out}")
+    return results
+
+if __name__ == '__main__':
+    benches = {
+        'sampling': bench_sampling,
+        'backoff': bench_backoff,
+        'lag': bench_lag,
+        'check': bench_check,
+        'translate': bench_translate,
+        'replay': bench_replay,
+        'preprocess': bench_preprocess,
+        'shards': bench_shards,
+        'service': bench_service,
+        'settings': bench_settings,
+        'batch': bench_batch,
+        'unlearn': bench_unlearn,
+        'ingest': bench_ingest,
+        'auth': bench_auth,
+    }
+    if len(sys.argv) < 2 or sys.argv[1] not in benches:
+        print("Usage: bench.py <" + '|'.join(benches) + "> [args]")
+        sys.exit(1)
+    benches[sys.argv[1]](*sys.argv[2:])
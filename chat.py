@@ -0,0 +1,65 @@
+import re
+
+# accounts whose chat is never answered or learned from, besides the bot's own
+IGNORED_BOTS = ('funtoon', 'cynanbot')
+
+class ChatMessage():
+    # One chat line as the handlers see it, worked out once on arrival.
+    # message is twitchio's object, kept for replying; channel and author are
+    # lowercased names, lower the lowercased content.
+    __slots__ = ('message', 'channel', 'author', 'content', 'lower', 'mentioned', 'from_bot', 'learnable')
+
+class MessagePreprocessor():
+    # Normalizes every line in one pass, with the bot's nick, its @mention
+    # pattern and the ignored accounts fixed up front instead of rebuilt per
+    # message.
+    def __init__(self, nick, markov, ignored_bots=IGNORED_BOTS):
+        self.__nick = nick.lower()
+        self.__mention = '@' + self.__nick
+        self.__mention_pattern = re.compile(r'\s?@' + re.escape(self.__nick) + r'\s?')
+        self.__bots = frozenset(ignored_bots) | {self.__nick}
+        self.__markov = markov
+
+    def get_nick(self):
+        return self.__nick
+
+    def process(self, message):
+        # None for lines without an author or channel (notices, the bot's own
+        # echoes)
+        author = message.author
+        channel = message.channel
+        if not author or not channel:
+            return None
+        record = ChatMessage()
+        record.message = message
+        record.channel = channel.name.lower()
+        record.author = author.name.lower()
+        record.content = message.content
+        record.lower = message.content.lower()
+        record.mentioned = self.__mention in record.lower
+        record.from_bot = record.author in self.__bots
+        # chat in the bot's own channel is commands, never learned
+        record.learnable = not record.from_bot and record.channel != self.__nick and \
+            self.__markov.is_safe_to_learn(record.channel, record.author, record.lower, lowered=True)
+        return record
+
+    def strip_mention(self, record):
+        return self.__mention_pattern.sub('', record.lower)
+
+class RollingWindow():
+    # The last `size` characters of a channel's chat, updated without
+    # building a string any longer than twice the window.
+    __slots__ = ('size', 'text')
+
+    def __init__(self, size):
+        self.size = size
+        self.text = ''
+
+    def push_line(self, line):
+        # same as keeping (text + line + '\n')[-size:]
+        size = self.size
+        if len(line) >= size - 1:
+            self.text = line[len(line) - size + 1:] + '\n'
+        else:
+            self.text = (self.text + line + '\n')[-size:]
+        return self.text
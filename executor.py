@@ -0,0 +1,121 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+def _map(fn, items):
+    return [fn(item) for item in items]
+
+def _learn_all(markov, buffers, sources):
+    if sources is None:
+        return _map(markov.learn_from_buffer, buffers)
+    return [markov.learn_from_buffer(data, source) for data, source in zip(buffers, sources)]
+
+class InlineModel():
+    # Async front for a Markov that runs every call directly on the event loop.
+    def __init__(self, markov):
+        self.__markov = markov
+
+    def get_markov(self):
+        return self.__markov
+
+    def queue_depth(self):
+        return 0
+
+    async def learn_from_buffer(self, data, source=None):
+        return self.__markov.learn_from_buffer(data, source)
+
+    async def gen(self, inp):
+        return self.__markov.gen(inp)
+
+    async def has_response(self, msg):
+        return self.__markov.hasResponse(msg)
+
+    async def learn_batch(self, buffers, sources=None):
+        return _learn_all(self.__markov, buffers, sources)
+
+    async def unlearn_batch(self, buffers):
+        return _map(self.__markov.unlearn_from_buffer, buffers)
+
+    async def gen_batch(self, inputs):
+        return _map(self.__markov.gen, inputs)
+
+    async def has_response_batch(self, msgs):
+        return _map(self.__markov.hasResponse, msgs)
+
+    async def stats(self):
+        return self.__markov.stats()
+
+    async def needs_compaction(self):
+        return self.__markov.needs_compaction()
+
+    async def save_buffers(self):
+        await self.__markov.save_buffers()
+
+    async def compact(self):
+        await self.__markov.compact()
+
+class ModelExecutor():
+    # Async front for a Markov that owns it from a single worker thread. Every
+    # call that reads or mutates the model is serialized onto that thread, so
+    # the event loop only waits on futures while learning and generation run.
+    def __init__(self, markov):
+        self.__markov = markov
+        self.__worker = ThreadPoolExecutor(1, 'markov')
+        self.__queue_depth = 0
+
+    def get_markov(self):
+        return self.__markov
+
+    def queue_depth(self):
+        return self.__queue_depth
+
+    async def learn_from_buffer(self, data, source=None):
+        return await self.__submit(self.__markov.learn_from_buffer, data, source)
+
+    async def gen(self, inp):
+        return await self.__submit(self.__markov.gen, inp)
+
+    async def has_response(self, msg):
+        return await self.__submit(self.__markov.hasResponse, msg)
+
+    # one trip to the worker for the whole batch
+    async def learn_batch(self, buffers, sources=None):
+        return await self.__submit(_learn_all, self.__markov, buffers, sources)
+
+    async def unlearn_batch(self, buffers):
+        return await self.__submit(_map, self.__markov.unlearn_from_buffer, buffers)
+
+    async def gen_batch(self, inputs):
+        return await self.__submit(_map, self.__markov.gen, inputs)
+
+    async def has_response_batch(self, msgs):
+        return await self.__submit(_map, self.__markov.hasResponse, msgs)
+
+    async def stats(self):
+        return await self.__submit(self.__markov.stats)
+
+    async def needs_compaction(self):
+        return await self.__submit(self.__markov.needs_compaction)
+
+    async def save_buffers(self):
+        await self.__submit(self.__markov.save_buffers_sync)
+
+    async def compact(self):
+        compaction = await self.__submit(self.__markov.begin_compaction)
+        await self.__submit(self.__markov.save_buffers_sync)
+        # the snapshot write only touches frozen data, so keep it off the
+        # worker and let learning continue
+        result = await asyncio.get_event_loop().run_in_executor(None, self.__markov.write_compaction, compaction)
+        await self.__submit(self.__markov.finish_compaction, compaction, result)
+
+    def shutdown(self):
+        self.__worker.shutdown(wait=True)
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    async def __submit(self, fn, *args):
+        self.__queue_depth += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.__worker, fn, *args)
+        finally:
+            self.__queue_depth -= 1
@@ -0,0 +1,120 @@
+import time
+import uuid
+from aiohttp import web, WSMsgType
+
+class FakeIRCServer():
+    # Just enough of Twitch's IRC-over-websocket chat server to run bots
+    # against locally: it acknowledges capabilities and logins, confirms
+    # JOINs (recording when each arrived, to check join rate limits), records
+    # what the bots post and lets tests inject chat into channels.
+    def __init__(self, host='127.0.0.1', port=0):
+        self.__host = host
+        self.__port = port
+        self.__runner = None
+        self.__clients = dict()
+        self.__next_user_id = 1000
+        self.joins = []
+        self.sent = []
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/', self.__handle)
+        self.__runner = web.AppRunner(app)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, self.__host, self.__port)
+        await site.start()
+        port = self.__runner.addresses[0][1]
+        return f'ws://{self.__host}:{port}'
+
+    async def close(self):
+        for ws in list(self.__clients):
+            await ws.close()
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+    def joined_channels(self):
+        channels = set()
+        for client in self.__clients.values():
+            channels |= client['channels']
+        return channels
+
+    async def say(self, channel, user, text):
+        # delivers a chat message to every connection joined to the channel
+        channel = channel.lower()
+        self.__next_user_id += 1
+        tags = ';'.join([
+            'badge-info=', 'badges=', 'color=', f'display-name={user}', 'emotes=',
+            'first-msg=0', 'flags=', f'id={uuid.uuid4()}', 'mod=0', 'room-id=1',
+            'subscriber=0', f'tmi-sent-ts={int(time.time() * 1000)}', 'turbo=0',
+            f'user-id={self.__next_user_id}', 'user-type=',
+        ])
+        line = f'@{tags} :{user}!{user}@{user}.tmi.twitch.tv PRIVMSG #{channel} :{text}'
+        delivered = 0
+        for ws, client in list(self.__clients.items()):
+            if channel in client['channels']:
+                await ws.send_str(line)
+                delivered += 1
+        return delivered
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    async def __handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client = {'nick': 'justinfan', 'channels': set()}
+        self.__clients[ws] = client
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                for line in msg.data.split('\r\n'):
+                    if line:
+                        await self.__command(ws, client, line)
+        finally:
+            del self.__clients[ws]
+        return ws
+
+    async def __command(self, ws, client, line):
+        cmd, _, arg = line.partition(' ')
+        cmd = cmd.upper()
+        nick = client['nick']
+        if cmd == 'CAP':
+            await ws.send_str(f':tmi.twitch.tv CAP * ACK :{arg.partition(":")[2]}')
+        elif cmd == 'NICK':
+            nick = arg.strip().lower()
+            client['nick'] = nick
+            welcome = [
+                f':tmi.twitch.tv 001 {nick} :Welcome, GLHF!',
+                f':tmi.twitch.tv 002 {nick} :Your host is tmi.twitch.tv',
+                f':tmi.twitch.tv 003 {nick} :This server is rather new',
+                f':tmi.twitch.tv 004 {nick} :-',
+                f':tmi.twitch.tv 375 {nick} :-',
+                f':tmi.twitch.tv 372 {nick} :You are in a maze of twisty passages, all alike.',
+                f':tmi.twitch.tv 376 {nick} :>',
+            ]
+            await ws.send_str('\r\n'.join(welcome))
+        elif cmd == 'JOIN':
+            for channel in arg.split(','):
+                channel = channel.strip().lstrip('#').lower()
+                if not channel:
+                    continue
+                self.joins.append((time.monotonic(), nick, channel))
+                client['channels'].add(channel)
+                await ws.send_str('\r\n'.join([
+                    f':{nick}!{nick}@{nick}.tmi.twitch.tv JOIN #{channel}',
+                    f':{nick}.tmi.twitch.tv 353 {nick} = #{channel} :{nick}',
+                    f':{nick}.tmi.twitch.tv 366 {nick} #{channel} :End of /NAMES list',
+                    f'@emote-only=0;followers-only=-1;r9k=0;room-id=1;slow=0;subs-only=0 :tmi.twitch.tv ROOMSTATE #{channel}',
+                    f'@badge-info=;badges=;color=;display-name={nick};emote-sets=0;mod=0;subscriber=0;user-type= :tmi.twitch.tv USERSTATE #{channel}',
+                ]))
+        elif cmd == 'PART':
+            channel = arg.strip().lstrip('#').lower()
+            client['channels'].discard(channel)
+            await ws.send_str(f':{nick}!{nick}@{nick}.tmi.twitch.tv PART #{channel}')
+        elif cmd == 'PING':
+            await ws.send_str(f'PONG {arg}')
+        elif cmd == 'PRIVMSG':
+            channel, _, text = arg.partition(' :')
+            self.sent.append((time.monotonic(), channel.lstrip('#').lower(), text))
@@ -0,0 +1,81 @@
+import uuid
+import asyncio
+from aiohttp import web
+
+class FakeOAuthServer():
+    # Local stand-in for Twitch's OAuth endpoint, enough for TokenManager:
+    # /token trades a refresh token for new tokens (rotating the refresh
+    # token, as Twitch does) and /validate checks an access token. delay
+    # slows every response; counts and connections record what was asked.
+    def __init__(self, client_id='fakeclient', client_secret='fakesecret', refresh_token='refresh0', access_token='access0', expires_in=14400, delay=0.0, host='127.0.0.1', port=0):
+        self.__host = host
+        self.__port = port
+        self.__runner = None
+        self.__client_id = client_id
+        self.__client_secret = client_secret
+        self.refresh_token = refresh_token
+        self.access_token = access_token
+        self.expires_in = expires_in
+        self.delay = delay
+        self.token_requests = 0
+        self.validate_requests = 0
+        # remote (host, port) pairs seen, one per client connection
+        self.connections = set()
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/token', self.__token)
+        app.router.add_get('/validate', self.__validate)
+        self.__runner = web.AppRunner(app)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, self.__host, self.__port)
+        await site.start()
+        port = self.__runner.addresses[0][1]
+        return f'http://{self.__host}:{port}'
+
+    async def close(self):
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+    def revoke(self):
+        # the current access token stops validating, as after a password change
+        self.access_token = None
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    async def __token(self, request):
+        self.token_requests += 1
+        self.connections.add(request.transport.get_extra_info('peername'))
+        form = await request.post()
+        await asyncio.sleep(self.delay)
+        if form.get('grant_type') != 'refresh_token' or form.get('client_id') != self.__client_id \
+                or form.get('client_secret') != self.__client_secret:
+            return web.json_response({'status': 400, 'message': 'invalid client'}, status=400)
+        if form.get('refresh_token') != self.refresh_token:
+            return web.json_response({'status': 400, 'message': 'Invalid refresh token'}, status=400)
+        self.access_token = uuid.uuid4().hex
+        self.refresh_token = uuid.uuid4().hex
+        return web.json_response({
+            'access_token': self.access_token,
+            'refresh_token': self.refresh_token,
+            'expires_in': self.expires_in,
+            'scope': [],
+            'token_type': 'bearer',
+        })
+
+    async def __validate(self, request):
+        self.validate_requests += 1
+        self.connections.add(request.transport.get_extra_info('peername'))
+        await asyncio.sleep(self.delay)
+        header = request.headers.get('Authorization', '')
+        if self.access_token is None or header != f'OAuth {self.access_token}':
+            return web.json_response({'status': 401, 'message': 'invalid access token'}, status=401)
+        return web.json_response({
+            'client_id': self.__client_id,
+            'login': 'anivbench',
+            'scopes': [],
+            'user_id': '1',
+            'expires_in': self.expires_in,
+        })
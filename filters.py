@@ -0,0 +1,177 @@
+import os
+import ujson
+from collections import deque
+
+class PatternMatcher():
+    # Aho-Corasick automaton over lowercased patterns, so every pattern is
+    # checked in one pass over the text.
+    def __init__(self, patterns):
+        self.__goto = [dict()]
+        self.__fail = [0]
+        self.__out = [None]
+        self.__patterns = set()
+        for pattern in patterns:
+            if pattern:
+                self.__add(pattern.lower())
+        self.__build_failure_links()
+
+    def __len__(self):
+        return len(self.__patterns)
+
+    def patterns(self):
+        return frozenset(self.__patterns)
+
+    def search(self, text, lowered=False):
+        goto = self.__goto
+        fail = self.__fail
+        out = self.__out
+        state = 0
+        for ch in text if lowered else text.lower():
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state] is not None:
+                return True
+        return False
+
+    def find_all(self, text):
+        goto = self.__goto
+        fail = self.__fail
+        out = self.__out
+        found = set()
+        state = 0
+        for ch in text.lower():
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state] is not None:
+                found.update(out[state])
+        return found
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __add(self, pattern):
+        if pattern in self.__patterns:
+            return
+        self.__patterns.add(pattern)
+        state = 0
+        for ch in pattern:
+            nxt = self.__goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.__goto)
+                self.__goto.append(dict())
+                self.__fail.append(0)
+                self.__out.append(None)
+                self.__goto[state][ch] = nxt
+            state = nxt
+        self.__out[state] = (pattern,)
+
+    def __build_failure_links(self):
+        queue = deque(self.__goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.__goto[state].items():
+                queue.append(nxt)
+                f = self.__fail[state]
+                while f and ch not in self.__goto[f]:
+                    f = self.__fail[f]
+                self.__fail[nxt] = self.__goto[f].get(ch, 0)
+                # a state matches if any of its suffixes do; merging the
+                # outputs up front lets search() stop at the first hit
+                inherited = self.__out[self.__fail[nxt]]
+                if inherited is not None:
+                    own = self.__out[nxt] or ()
+                    self.__out[nxt] = own + inherited
+
+class ContentFilter():
+    def __init__(self,
+            filter_file='data/filter.json',
+            wordlist_files=('profanity_wordlist.txt',),
+            user_ignore_file='data/user_ignore_list.json',
+            channel_ignore_file='data/channel_ignore_list.json'):
+        self.__filter_file = filter_file
+        self.__wordlist_files = wordlist_files
+        self.__user_ignore_file = user_ignore_file
+        self.__channel_ignore_file = channel_ignore_file
+        self.__mtimes = None
+        self.__matcher = PatternMatcher([])
+        self.__ignored_users = frozenset()
+        self.__ignored_channels = frozenset()
+        self.reload(force=True)
+
+    def is_ignored_user(self, name):
+        return name.lower() in self.__ignored_users
+
+    def is_ignored_channel(self, channel):
+        return channel.lower() in self.__ignored_channels
+
+    def is_filtered(self, msg):
+        return self.__matcher.search(msg)
+
+    def is_safe_to_learn(self, channel, name, msg, lowered=False):
+        # lowered: channel, name and msg are already lowercase
+        if lowered:
+            if channel in self.__ignored_channels or name in self.__ignored_users:
+                return False
+            return not self.__matcher.search(msg, lowered=True)
+        if self.is_ignored_channel(channel):
+            return False
+        if self.is_ignored_user(name):
+            return False
+        if self.is_filtered(msg):
+            return False
+            
+        return True
+
+    def find_filtered(self, msg):
+        return self.__matcher.find_all(msg)
+
+    def pattern_count(self):
+        return len(self.__matcher)
+
+    def ignored_users(self):
+        return self.__ignored_users
+
+    def ignored_channels(self):
+        return self.__ignored_channels
+
+    def patterns(self):
+        return self.__matcher.patterns()
+
+    def reload(self, force=False):
+        mtimes = self.__current_mtimes()
+        if not force and mtimes == self.__mtimes:
+            return False
+
+        patterns = list(self.__load_json_list(self.__filter_file, 'filter_list'))
+        for wordlist in self.__wordlist_files:
+            if os.path.exists(wordlist):
+                with open(wordlist, 'r', encoding='utf-8') as f:
+                    patterns.extend(line.strip() for line in f if line.strip())
+
+        # build everything before swapping so callers never see a partial set
+        matcher = PatternMatcher(patterns)
+        users = frozenset(x.lower() for x in self.__load_json_list(self.__user_ignore_file, 'ignore_list'))
+        channels = frozenset(x.lower() for x in self.__load_json_list(self.__channel_ignore_file, 'ignore_list'))
+        self.__matcher = matcher
+        self.__ignored_users = users
+        self.__ignored_channels = channels
+        self.__mtimes = mtimes
+        return True
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __current_mtimes(self):
+        mtimes = []
+        for path in (self.__filter_file, self.__user_ignore_file, self.__channel_ignore_file, *self.__wordlist_files):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def __load_json_list(self, filename, key):
+        with open(filename, 'r') as f:
+            return ujson.load(f)[key]
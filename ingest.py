@@ -0,0 +1,254 @@
+import time
+import asyncio
+from collections import deque
+from metrics import Registry, SIZE_BUCKETS
+
+# what happens to chat arriving for a channel whose queue is full
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+class IngestQueue():
+    # Chat waiting to be learned, in one bounded queue per channel. The
+    # learner sleeps until chat arrives, lingers briefly so a batch can fill,
+    # then learns in rounds: each round takes up to batch_chars from every
+    # waiting channel in turn, so a raid in one channel can't hold the others
+    # back, up to round_chars a round. A channel holds at most max_chars; past that,
+    # drop_oldest discards its oldest chat, drop_newest the arriving message,
+    # and block makes put() wait until the learner has made room. on_learned,
+    # if given, is called with the channel after each batch it learns.
+    def __init__(self, model, order=10, max_chars=64 * 1024, batch_chars=4096, round_chars=64 * 1024, linger=0.25, policy=DROP_OLDEST, metrics=None, on_learned=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown ingest policy '{policy}'")
+        self.__model = model
+        self.__order = order
+        self.__max_chars = max_chars
+        self.__batch_chars = batch_chars
+        self.__round_chars = round_chars
+        self.__linger = linger
+        self.__policy = policy
+        self.__on_learned = on_learned
+        self.__channels = dict()
+        # channels with chat queued, in the order they get their next batch
+        self.__ready = deque()
+        self.__arrived = None
+        self.__full = None
+        self.__space = None
+        self.__stats = {
+            'queued_messages': 0,
+            'queued_chars': 0,
+            'dropped_messages': 0,
+            'learned_messages': 0,
+            'learned_chars': 0,
+            'rounds': 0,
+            'failed_batches': 0,
+        }
+        metrics = metrics if metrics is not None else Registry(enabled=False)
+        self.__dropped = metrics.counter('ingest_dropped_total', 'Chat messages dropped because their channel queue was full')
+        self.__lag = metrics.histogram('ingest_lag_seconds', 'Time from the oldest message in a batch arriving to it being learned', (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+        self.__batch_size = metrics.histogram('learn_batch_chars', 'Characters per channel buffer handed to the model', SIZE_BUCKETS)
+        self.__round_channels = metrics.histogram('learn_batch_channels', 'Channels with new chat per learning pass', (1, 2, 5, 10, 20, 50, 100, 200))
+        self.__round_seconds = metrics.histogram('learn_seconds', 'Time to learn one round of channel buffers')
+
+    async def put(self, channel, user, text):
+        # returns False when the message was dropped
+        state = self.__channels.get(channel)
+        if state is None:
+            state = self.__channels[channel] = {'queue': deque(), 'chars': 0, 'carry': '', 'gap': False, 'waiting': False, 'dropped': 0, 'learned': 0, 'lag': 0.0}
+        if state['chars'] > 0 and state['chars'] + len(text) > self.__max_chars:
+            if self.__policy == DROP_NEWEST:
+                # whatever comes next doesn't follow on from what is queued
+                state['gap'] = True
+                self.__drop(state, 1)
+                return False
+            elif self.__policy == BLOCK:
+                while state['chars'] > 0 and state['chars'] + len(text) > self.__max_chars:
+                    await self.__wait_for_space()
+                # the channel was parted while this waited
+                if self.__channels.get(channel) is not state:
+                    return False
+            else:
+                dropped = 0
+                while state['chars'] > 0 and state['chars'] + len(text) > self.__max_chars:
+                    old, _, _, _ = state['queue'].popleft()
+                    state['chars'] -= len(old)
+                    self.__stats['queued_messages'] -= 1
+                    self.__stats['queued_chars'] -= len(old)
+                    dropped += 1
+                # the oldest message left no longer follows what was learned
+                state['carry'] = ''
+                self.__drop(state, dropped)
+        state['queue'].append((text, user, time.monotonic(), state['gap']))
+        state['gap'] = False
+        state['chars'] += len(text)
+        self.__stats['queued_messages'] += 1
+        self.__stats['queued_chars'] += len(text)
+        if not state['waiting']:
+            state['waiting'] = True
+            self.__ready.append(channel)
+        self.__events()[0].set()
+        if state['chars'] >= self.__batch_chars:
+            self.__events()[1].set()
+        return True
+
+    def discard(self, channel):
+        # drops a parted channel's unlearned chat and its queue; returns the
+        # number of messages dropped
+        state = self.__channels.pop(channel, None)
+        if state is None:
+            return 0
+        if state['waiting']:
+            self.__ready.remove(channel)
+        dropped = len(state['queue'])
+        self.__stats['queued_messages'] -= dropped
+        self.__stats['queued_chars'] -= state['chars']
+        state['queue'].clear()
+        state['chars'] = 0
+        # a put() blocked on this channel gives up
+        if self.__space is not None:
+            self.__space.set()
+        return dropped
+
+    def lag(self, channel):
+        # seconds the channel's oldest unlearned message has been waiting
+        state = self.__channels.get(channel)
+        if state is None or not state['queue']:
+            return 0.0
+        return time.monotonic() - state['queue'][0][2]
+
+    def lags(self):
+        return {channel: self.lag(channel) for channel in self.__ready}
+
+    def channel_stats(self, channel):
+        state = self.__channels.get(channel)
+        if state is None:
+            return None
+        return {
+            'queued_messages': len(state['queue']),
+            'queued_chars': state['chars'],
+            'dropped_messages': state['dropped'],
+            'learned_messages': state['learned'],
+            'lag': self.lag(channel),
+            'last_learned_lag': state['lag'],
+        }
+
+    def stats(self):
+        stats = dict(self.__stats)
+        stats['waiting_channels'] = len(self.__ready)
+        stats['max_lag'] = max(self.lags().values(), default=0.0)
+        return stats
+
+    async def run(self):
+        arrived, full = self.__events()
+        while True:
+            await arrived.wait()
+            if not full.is_set():
+                try:
+                    await asyncio.wait_for(full.wait(), self.__linger)
+                except asyncio.TimeoutError:
+                    pass
+            arrived.clear()
+            full.clear()
+            await self.__learn_round()
+            if self.__ready:
+                arrived.set()
+                # a backlog is learned without lingering
+                if any(self.__channels[channel]['chars'] >= self.__batch_chars for channel in self.__ready):
+                    full.set()
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __events(self):
+        # created on first use so they bind to the running loop
+        if self.__arrived is None:
+            self.__arrived = asyncio.Event()
+            self.__full = asyncio.Event()
+            self.__space = asyncio.Event()
+        return self.__arrived, self.__full
+
+    async def __wait_for_space(self):
+        self.__events()
+        self.__space.clear()
+        await self.__space.wait()
+
+    def __drop(self, state, count):
+        state['dropped'] += count
+        self.__stats['dropped_messages'] += count
+        self.__dropped.inc(count)
+
+    def __take_batch(self, channel, buffers, sources, arrivals):
+        # up to batch_chars of the channel's oldest chat (at least one
+        # message), split wherever dropped chat left a gap
+        state = self.__channels[channel]
+        queue = state['queue']
+        taken = 0
+        oldest = queue[0][2]
+        parts = []
+        authors = []
+        while queue and (taken == 0 or taken + len(queue[0][0]) <= self.__batch_chars):
+            text, user, _, gap = queue[0]
+            if gap and parts:
+                break
+            if gap:
+                state['carry'] = ''
+            queue.popleft()
+            parts.append(text)
+            authors.append((user, len(text)))
+            taken += len(text)
+        data = state['carry'] + ''.join(parts)
+        state['carry'] = data[-self.__order:]
+        state['chars'] -= taken
+        state['learned'] += len(authors)
+        self.__stats['queued_messages'] -= len(authors)
+        self.__stats['queued_chars'] -= taken
+        self.__stats['learned_messages'] += len(authors)
+        self.__stats['learned_chars'] += taken
+        self.__batch_size.observe(len(data))
+        buffers.append(data)
+        sources.append((channel, authors))
+        arrivals.append((state, oldest))
+        return len(data)
+
+    async def __learn_round(self):
+        buffers = []
+        sources = []
+        arrivals = []
+        total = 0
+        served = set()
+        # one batch per channel per round, the channel going to the back of
+        # the line if it still has chat queued
+        while self.__ready and total < self.__round_chars and self.__ready[0] not in served:
+            channel = self.__ready.popleft()
+            served.add(channel)
+            state = self.__channels[channel]
+            if state['queue']:
+                total += self.__take_batch(channel, buffers, sources, arrivals)
+            if state['queue']:
+                self.__ready.append(channel)
+            else:
+                state['waiting'] = False
+        if not buffers:
+            return
+        self.__round_channels.observe(len(buffers))
+        self.__stats['rounds'] += 1
+        t = time.perf_counter()
+        # one model call per batch, so generation queued behind learning
+        # waits for a batch at most rather than the whole round; a batch that
+        # fails is lost on its own
+        for data, source in zip(buffers, sources):
+            try:
+                await self.__model.learn_from_buffer(data, source)
+            except Exception as e:
+                print("Exception occured while learning:", e)
+                self.__stats['failed_batches'] += 1
+                continue
+            if self.__on_learned is not None:
+                self.__on_learned(source[0])
+        self.__round_seconds.observe(time.perf_counter() - t)
+        now = time.monotonic()
+        for state, oldest in arrivals:
+            state['lag'] = now - oldest
+            self.__lag.observe(now - oldest)
+        self.__space.set()
@@ -0,0 +1,97 @@
+import os
+import re
+import ujson
+import aiofiles
+
+class DeltaJournal():
+    # Write-ahead log of learned buffers. Each buffer fully determines the count
+    # deltas learn_from_buffer applied (or unlearn_from_buffer took away), so
+    # replaying the buffers on top of the last snapshot restores the model. The journal is split into numbered
+    # segments so a snapshot can record which segments it already contains.
+    def __init__(self, prefix='markov_journal'):
+        self.__prefix = prefix
+        self.__segment = self.__last_segment() + 1
+        self.__pending = []
+        self.__sealed = []
+
+    def get_segment(self):
+        return self.__segment
+
+    def record(self, data):
+        self.__pending.append(ujson.dumps({'learn': data}) + '\n')
+
+    def record_unlearn(self, data):
+        self.__pending.append(ujson.dumps({'unlearn': data}) + '\n')
+
+    def has_pending(self):
+        return len(self.__pending) > 0 or len(self.__sealed) > 0
+
+    def rotate(self):
+        # close the current segment; entries recorded so far stay in it
+        closed = self.__segment
+        if self.__pending:
+            self.__sealed.append((closed, self.__pending))
+            self.__pending = []
+        self.__segment += 1
+        return closed
+
+    async def flush(self):
+        for segment, lines in self.__take_batches():
+            async with aiofiles.open(self.__segment_path(segment), 'a', encoding='utf-8') as f:
+                await f.write(''.join(lines))
+                await f.flush()
+
+    def flush_sync(self):
+        for segment, lines in self.__take_batches():
+            with open(self.__segment_path(segment), 'a', encoding='utf-8') as f:
+                f.write(''.join(lines))
+
+    def replay(self, after, fn):
+        last = after
+        for segment, path in self.__segments():
+            if segment <= after:
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = ujson.loads(line)
+                    except ValueError:
+                        # torn write from a crash mid-append
+                        continue
+                    fn(entry)
+            last = segment
+        # never append to a segment that may end in a torn line
+        self.__segment = max(self.__segment, last + 1)
+
+    def discard(self, upto):
+        for segment, path in self.__segments():
+            if segment <= upto:
+                os.remove(path)
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __take_batches(self):
+        batches = self.__sealed
+        if self.__pending:
+            batches.append((self.__segment, self.__pending))
+        self.__sealed = []
+        self.__pending = []
+        return batches
+
+    def __segment_path(self, segment):
+        return f'{self.__prefix}.{segment}.txt'
+
+    def __segments(self):
+        directory, name = os.path.split(self.__prefix)
+        pattern = re.compile(re.escape(name) + r'\.(\d+)\.txt$')
+        found = []
+        for f in os.listdir(directory or '.'):
+            m = pattern.match(f)
+            if m:
+                found.append((int(m.group(1)), os.path.join(directory, f)))
+        return sorted(found)
+
+    def __last_segment(self):
+        segments = self.__segments()
+        return segments[-1][0] if segments else 0
@@ -0,0 +1,182 @@
+import os
+import time
+import queue
+import atexit
+import datetime
+import threading
+import ujson
+
+# backup file names carry a timestamp in this format, which sorts lexically
+# in time order
+BACKUP_STAMP = '%Y%m%d-%H%M%S'
+
+def prune_backups(directory, prefix, ext, keep, exclude=None):
+    # removes all but the newest keep files named prefix + BACKUP_STAMP... + ext
+    old = sorted(name for name in os.listdir(directory) if name.startswith(prefix) and name.endswith(ext) and name != exclude)
+    for name in old[:max(0, len(old) - keep)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+
+class BufferedLogger():
+    # Queues records and writes them as JSON lines from a background thread,
+    # so logging never does file I/O on the caller's thread. The queue is
+    # bounded: under overload new records are dropped and counted rather than
+    # blocking the event loop. The file rotates by size and by age.
+    def __init__(self, path='log.jsonl', max_bytes=16 * 1024 * 1024, rotate_interval=24 * 60 * 60, backups=10, queue_size=10000, flush_interval=1.0):
+        # resolved by the first record after construction or close(), not
+        # at import time; a chdir while the writer runs cannot move the log
+        self.__relative_path = path
+        self.__path = None
+        self.__max_bytes = max_bytes
+        self.__rotate_interval = rotate_interval
+        self.__backups = backups
+        self.__flush_interval = flush_interval
+        self.__queue = queue.Queue(queue_size)
+        self.__BATCH_SIZE = 512
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__exit_registered = False
+        self.__file = None
+        self.__opened_at = 0
+        self.__stats = {
+            'written': 0,
+            'dropped': 0,
+            'rotations': 0,
+            'errors': 0,
+            'unserializable': 0,
+        }
+
+    def log(self, msg, level='info', **fields):
+        if self.__thread is None:
+            self.__start()
+        try:
+            self.__queue.put_nowait((time.time(), level, msg, fields))
+            return True
+        except queue.Full:
+            with self.__lock:
+                self.__stats['dropped'] += 1
+            return False
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+        stats['queued'] = self.__queue.qsize()
+        return stats
+
+    def flush(self):
+        # blocks until everything queued so far has been written
+        if self.__thread is not None:
+            self.__queue.join()
+
+    def close(self):
+        if self.__thread is None:
+            return
+        self.__queue.put(None)
+        self.__thread.join()
+        self.__thread = None
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __start(self):
+        with self.__lock:
+            if self.__thread is not None:
+                return
+            self.__path = os.path.abspath(self.__relative_path)
+            self.__thread = threading.Thread(target=self.__run, name='logger', daemon=True)
+            self.__thread.start()
+            # close() also runs on restart after a close(); register it once
+            if not self.__exit_registered:
+                self.__exit_registered = True
+                atexit.register(self.close)
+
+    def __run(self):
+        while True:
+            batch = []
+            try:
+                batch.append(self.__queue.get(timeout=self.__flush_interval))
+                while len(batch) < self.__BATCH_SIZE:
+                    batch.append(self.__queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = None in batch
+            records = [r for r in batch if r is not None]
+            if records:
+                self.__write(records)
+            elif self.__file is not None and self.__due_for_rotation():
+                try:
+                    self.__rotate()
+                except (IOError, OSError) as e:
+                    print("Exception occured while rotating log:", e)
+                    with self.__lock:
+                        self.__stats['errors'] += 1
+            for _ in batch:
+                self.__queue.task_done()
+            if stop:
+                if self.__file is not None:
+                    self.__file.close()
+                    self.__file = None
+                return
+
+    def __write(self, records):
+        lines = []
+        for ts, level, msg, fields in records:
+            entry = {
+                'ts': datetime.datetime.fromtimestamp(ts).isoformat(timespec='milliseconds'),
+                'level': level,
+                'msg': msg,
+            }
+            entry.update(fields)
+            # a record that cannot be serialized is dropped on its own; the
+            # rest of the batch and the writer thread carry on
+            try:
+                lines.append(ujson.dumps(entry, ensure_ascii=False))
+            except (TypeError, ValueError, OverflowError) as e:
+                print("Exception occured while serializing log record:", e)
+                with self.__lock:
+                    self.__stats['unserializable'] += 1
+                    self.__stats['dropped'] += 1
+        if not lines:
+            return
+        try:
+            if self.__file is None:
+                self.__open()
+            elif self.__due_for_rotation():
+                self.__rotate()
+            self.__file.write('\n'.join(lines) + '\n')
+            self.__file.flush()
+            with self.__lock:
+                self.__stats['written'] += len(lines)
+        except (IOError, OSError) as e:
+            print("Exception occured while writing log:", e)
+            with self.__lock:
+                self.__stats['errors'] += 1
+                self.__stats['dropped'] += len(lines)
+
+    def __open(self):
+        # the age limit counts from when this process opened the file
+        self.__file = open(self.__path, 'a', encoding='utf-8')
+        self.__opened_at = time.time()
+
+    def __due_for_rotation(self):
+        if self.__max_bytes is not None and self.__file.tell() >= self.__max_bytes:
+            return True
+        return self.__rotate_interval is not None and time.time() - self.__opened_at >= self.__rotate_interval and self.__file.tell() > 0
+
+    def __rotate(self):
+        self.__file.close()
+        self.__file = None
+        base, ext = os.path.splitext(self.__path)
+        stamp = datetime.datetime.now().strftime(BACKUP_STAMP)
+        n = 0
+        rotated = f'{base}.{stamp}-{n:03d}{ext}'
+        while os.path.exists(rotated):
+            n += 1
+            rotated = f'{base}.{stamp}-{n:03d}{ext}'
+        os.replace(self.__path, rotated)
+        with self.__lock:
+            self.__stats['rotations'] += 1
+        prune_backups(os.path.dirname(os.path.abspath(self.__path)), os.path.basename(base) + '.', ext, self.__backups, os.path.basename(self.__path))
+        self.__open()
@@ -0,0 +1,222 @@
+import asyncio
+from bisect import bisect_left
+
+# In-process counters, gauges and histograms with Prometheus text exposition.
+# Recording is a couple of attribute updates, so metrics are always collected;
+# the HTTP endpoint is optional. A disabled Registry hands out no-op metrics.
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20)
+
+def _label_text(labels, extra=None):
+    pairs = list(labels.items()) if labels else []
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+def _format(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+class Counter():
+    TYPE = 'counter'
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return [f'{self.name}{_label_text(self.labels)} {_format(self.value)}']
+
+class Gauge():
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def render(self):
+        return [f'{self.name}{_label_text(self.labels)} {_format(self.value)}']
+
+class Histogram():
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.__buckets = tuple(buckets)
+        # the last slot catches everything above the largest bucket
+        self.__counts = [0] * (len(self.__buckets) + 1)
+        self.__sum = 0
+        self.__count = 0
+
+    def observe(self, value):
+        self.__counts[bisect_left(self.__buckets, value)] += 1
+        self.__sum += value
+        self.__count += 1
+
+    def get_count(self):
+        return self.__count
+
+    def get_sum(self):
+        return self.__sum
+
+    def render(self):
+        lines = []
+        total = 0
+        for bound, count in zip(self.__buckets + (float('inf'),), self.__counts):
+            total += count
+            lines.append(f'{self.name}_bucket{_label_text(self.labels, ("le", _format(bound)))} {total}')
+        lines.append(f'{self.name}_sum{_label_text(self.labels)} {_format(self.__sum)}')
+        lines.append(f'{self.name}_count{_label_text(self.labels)} {self.__count}')
+        return lines
+
+class _NullMetric():
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def render(self):
+        return []
+
+_NULL_METRIC = _NullMetric()
+
+class Registry():
+    def __init__(self, enabled=True, prefix='aniv_'):
+        self.__enabled = enabled
+        self.__prefix = prefix
+        self.__metrics = dict()
+        self.__collectors = []
+
+    def is_enabled(self):
+        return self.__enabled
+
+    # labels is an optional dict; each distinct set is its own series
+    def counter(self, name, help, labels=None):
+        return self.__get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=None):
+        return self.__get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS, labels=None):
+        return self.__get(Histogram, name, help, labels, buckets)
+
+    def add_collector(self, fn):
+        # coroutine function awaited before every render, for gauges that
+        # have to be read from elsewhere (e.g. the model's worker thread)
+        self.__collectors.append(fn)
+
+    async def collect(self):
+        for fn in self.__collectors:
+            try:
+                await fn()
+            except Exception as e:
+                print("Exception occured while collecting metrics:", e)
+
+    def render(self):
+        lines = []
+        described = set()
+        for metric in sorted(self.__metrics.values(), key=lambda m: m.name):
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f'# HELP {metric.name} {metric.help}')
+                lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __get(self, cls, name, help, labels, *args):
+        if not self.__enabled:
+            return _NULL_METRIC
+        name = self.__prefix + name
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        metric = self.__metrics.get(key)
+        if metric is None:
+            for other in self.__metrics.values():
+                if other.name == name and not isinstance(other, cls):
+                    raise ValueError(f"Metric '{name}' is already registered as a {type(other).__name__}")
+            metric = cls(name, help, labels, *args)
+            self.__metrics[key] = metric
+        return metric
+
+class MetricsServer():
+    # Serves GET /metrics in the Prometheus text format. Intended to listen on
+    # localhost only; anything else gets a 404.
+    def __init__(self, registry, host='127.0.0.1', port=9108):
+        self.__registry = registry
+        self.__host = host
+        self.__port = port
+        self.__server = None
+        self.__REQUEST_TIMEOUT = 5
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self.__handle, self.__host, self.__port)
+        return self.__server.sockets[0].getsockname()
+
+    async def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    async def __handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), self.__REQUEST_TIMEOUT)
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.__REQUEST_TIMEOUT)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                await self.__registry.collect()
+                status = '200 OK'
+                body = self.__registry.render().encode('utf-8')
+            else:
+                status = '404 Not Found'
+                body = b'Not Found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: close\r\n\r\n'.encode('ascii') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,281 @@
+import sys
+import random
+from array import array
+from bisect import bisect_right
+from itertools import accumulate, islice
+from transitions import TransitionTable
+try:
+    # numpy is optional; without it only the scalar step() path exists
+    from batch_sampler import BatchSampler
+except ImportError:
+    BatchSampler = None
+
+class LayeredModel():
+    # Transition counts split across a read-only mmapped Snapshot and the
+    # TransitionTables learned on top of it. The newest table takes new counts;
+    # older ones are frozen while a compaction folds them into the next snapshot.
+    def __init__(self, order, base=None, sampling_cache_bytes=4 * 1024 * 1024):
+        self.__order = order
+        self.__base = base
+        self.__overlays = [TransitionTable(order)]
+        # one bit per base context, set when gen uses it, so compaction can
+        # stamp it with the current epoch for least-recently-used eviction
+        self.__touched = self.__new_touched(base)
+        # lazily built (next chars, packed cumulative weights, size in bytes)
+        # per context the overlays hold, dropped whenever learning touches
+        # that context; contexts only the snapshot holds are sampled from the
+        # map directly and never cached. A context with a single successor,
+        # most of them at order 10, keeps just that character. Bounded by
+        # bytes; the older half goes when it is full.
+        self.__sampling_tables = dict()
+        self.__sampling_bytes = 0
+        self.__SAMPLING_CACHE_BYTES = sampling_cache_bytes
+        self.__TUPLE_BYTES = sys.getsizeof((None,) * 3)
+        # overlays that unlearn subtracted from; while any is live a context
+        # can be present with no positive counts left, so membership has to
+        # look at the counts. Snapshots never keep such contexts.
+        self.__unlearned = []
+        # compiled on the first sample_batch call
+        self.__sampler = None
+
+    def __contains__(self, ctx):
+        if self.__unlearned:
+            return self.__counts(ctx)[0] is not None
+        for table in self.__overlays:
+            if table.lookup(ctx) >= 0:
+                return True
+        return self.__base is not None and self.__base.lookup(ctx) >= 0
+
+    def get_base(self):
+        return self.__base
+
+    def get_touched(self):
+        return self.__touched
+
+    def overlay_bytes(self):
+        return sum(t.nbytes() for t in self.__overlays)
+
+    def learn(self, data):
+        self.__overlays[0].learn(data)
+        # a second pass over the contexts only when something caches them
+        sampler = self.__sampler
+        if not self.__sampling_tables and sampler is None:
+            return
+        order = self.__order
+        invalidate = self.__sampling_tables.pop
+        freed = 0
+        for i in range(len(data) - order):
+            key = data[i:i+order]
+            cached = invalidate(key, None)
+            if cached is not None:
+                freed += self.__entry_bytes(key, cached)
+            if sampler is not None:
+                sampler.invalidate(key)
+        self.__sampling_bytes -= freed
+
+    def unlearn(self, data):
+        # takes away what learn(data) added, never below zero: decay and
+        # eviction may already have taken some of it. Returns the number of
+        # transitions subtracted.
+        order = self.__order
+        table = self.__overlays[0]
+        invalidate = self.__sampling_tables.pop
+        sampler = self.__sampler
+        removed = 0
+        for i in range(len(data) - order):
+            key = data[i:i+order]
+            char = data[i+order]
+            if self.__count(key, char) > 0:
+                table.add(key, char, -1)
+                cached = invalidate(key, None)
+                if cached is not None:
+                    self.__sampling_bytes -= self.__entry_bytes(key, cached)
+                if sampler is not None:
+                    sampler.invalidate(key)
+                removed += 1
+        if removed and not any(t is table for t in self.__unlearned):
+            self.__unlearned.append(table)
+        return removed
+
+    def counts(self, ctx):
+        return self.__counts(ctx)[0]
+
+    def step(self, ctx):
+        # returns (next char, next context), or (None, None) at a dead end
+        table = self.__sampling_tables.get(ctx)
+        if table is None:
+            for overlay in self.__overlays:
+                if overlay.lookup(ctx) >= 0:
+                    break
+            else:
+                return self.__step_base(ctx)
+            table = self.__build_sampling_table(ctx)
+            if table is None:
+                return None, None
+        if table.__class__ is str:
+            return table, ctx[1:] + table
+        chars, cum, _ = table
+        char = chars[bisect_right(cum, random.random() * cum[-1])]
+        return char, ctx[1:] + char
+
+    def sample_batch(self, ctx, k, max_len):
+        # k continuations of ctx generated together, each up to max_len
+        # characters and ending after a newline or at a dead end; None when
+        # ctx is unknown. Needs numpy.
+        if self.__sampler is None:
+            self.__sampler = BatchSampler(self.__counts)
+        result = self.__sampler.sample(ctx, k, max_len)
+        if result is None:
+            return None
+        outputs, used = result
+        touched = self.__touched
+        for idx in used.tolist():
+            touched[idx >> 3] |= 1 << (idx & 7)
+        return outputs
+
+    def freeze(self):
+        # start a fresh overlay and hand back the ones that are now read-only
+        self.__overlays.insert(0, TransitionTable(self.__order))
+        return self.__overlays[1:]
+
+    def replace_base(self, base, folded):
+        # the new base already contains the folded overlays; cached sampling
+        # tables are dropped since they point at the old base's indices
+        old = self.__base
+        self.__base = base
+        self.__touched = self.__new_touched(base)
+        self.__sampling_tables.clear()
+        self.__sampling_bytes = 0
+        self.__sampler = None
+        self.__overlays = [t for t in self.__overlays if not any(t is f for f in folded)]
+        self.__unlearned = [t for t in self.__unlearned if not any(t is f for f in folded)]
+        return old
+
+    def stats(self):
+        overlay_contexts = sum(len(t) for t in self.__overlays)
+        overlay_bytes = self.overlay_bytes()
+        sampling_bytes = self.__sampling_bytes + sys.getsizeof(self.__sampling_tables)
+        stats = {
+            'snapshot_contexts': len(self.__base) if self.__base is not None else 0,
+            'snapshot_bytes': self.__base.nbytes() if self.__base is not None else 0,
+            'overlay_contexts': overlay_contexts,
+            'overlay_bytes': overlay_bytes,
+            'overlay_bytes_per_context': overlay_bytes / overlay_contexts if overlay_contexts else 0.0,
+            'sampling_tables': len(self.__sampling_tables),
+            'sampling_bytes': sampling_bytes,
+            'resident_bytes': overlay_bytes + len(self.__touched) + sampling_bytes,
+        }
+        if self.__sampler is not None:
+            stats.update(self.__sampler.stats())
+            stats['resident_bytes'] += stats['batch_bytes']
+        return stats
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __new_touched(self, base):
+        return bytearray((len(base) + 7) // 8 if base is not None else 0)
+
+    def __counts(self, ctx):
+        mapping = None
+        idx = -1
+        if self.__base is not None:
+            idx = self.__base.lookup(ctx)
+            if idx >= 0:
+                mapping = dict(self.__base.edges(idx))
+        for table in self.__overlays:
+            cid = table.lookup(ctx)
+            if cid >= 0:
+                if mapping is None:
+                    mapping = dict()
+                for char, count in table.edges(cid):
+                    mapping[char] = mapping.get(char, 0) + count
+        if mapping is None:
+            return None, idx
+        mapping = {char: count for char, count in mapping.items() if count > 0}
+        return mapping or None, idx
+
+    def __count(self, ctx, char):
+        count = 0
+        if self.__base is not None:
+            idx = self.__base.lookup(ctx)
+            if idx >= 0:
+                count += dict(self.__base.edges(idx)).get(char, 0)
+        for table in self.__overlays:
+            cid = table.lookup(ctx)
+            if cid >= 0:
+                count += dict(table.edges(cid)).get(char, 0)
+        return count
+
+    def __step_base(self, ctx):
+        # a context no overlay holds: one bisect over the snapshot's mapped
+        # running totals, nothing built or cached
+        base = self.__base
+        if base is None:
+            return None, None
+        idx = base.lookup(ctx)
+        if idx < 0:
+            return None, None
+        self.__touched[idx >> 3] |= 1 << (idx & 7)
+        char = chr(base.sample(idx, random.random()))
+        return char, ctx[1:] + char
+
+    def __build_sampling_table(self, ctx):
+        # the layers hand over next-character codes and running totals
+        # directly, so a context only one layer holds, the common case, needs
+        # no dict and no per-edge tuples
+        codes = None
+        idx = -1
+        if self.__base is not None:
+            idx = self.__base.lookup(ctx)
+            if idx >= 0:
+                codes, cum = self.__base.cumulative(idx)
+        for table in self.__overlays:
+            cid = table.lookup(ctx)
+            if cid >= 0:
+                if codes is None:
+                    codes, cum = table.cumulative(cid)
+                else:
+                    # held by more than one layer: sum the counts
+                    mapping = self.__counts(ctx)[0] or {}
+                    codes = [ord(char) for char in mapping]
+                    cum = list(accumulate(mapping.values()))
+                    break
+        if not codes:
+            return None
+        if len(codes) == 1:
+            table = chr(codes[0])
+        else:
+            chars = ''.join(map(chr, codes))
+            cum = array('I', cum)
+            table = (chars, cum, sys.getsizeof(chars) + sys.getsizeof(cum) + self.__TUPLE_BYTES)
+        # the cache is cleared whenever the base changes, so marking the
+        # context used when its table is built is enough for eviction
+        if idx >= 0:
+            self.__touched[idx >> 3] |= 1 << (idx & 7)
+        size = sys.getsizeof(ctx)
+        if table.__class__ is not str:
+            size += table[2]
+        if self.__sampling_bytes + size + sys.getsizeof(self.__sampling_tables) > self.__SAMPLING_CACHE_BYTES:
+            if size > self.__SAMPLING_CACHE_BYTES:
+                return table
+            self.__evict_sampling_tables()
+        self.__sampling_tables[ctx] = table
+        self.__sampling_bytes += size
+        return table
+
+    def __entry_bytes(self, ctx, table):
+        # one-character strings are shared by the interpreter
+        size = sys.getsizeof(ctx)
+        if table.__class__ is not str:
+            size += table[2]
+        return size
+
+    def __evict_sampling_tables(self):
+        # drops the older half in one go, dicts keeping insertion order; the
+        # rest is copied so the dict's own allocation shrinks with it
+        tables = self.__sampling_tables
+        half = (len(tables) + 1) // 2
+        for ctx, table in islice(tables.items(), half):
+            self.__sampling_bytes -= self.__entry_bytes(ctx, table)
+        self.__sampling_tables = dict(islice(tables.items(), half, None))
@@ -0,0 +1,375 @@
+import os
+import time
+import struct
+import asyncio
+import ujson
+from executor import ModelExecutor
+
+# One resident Markov served over a Unix socket to any number of bot
+# processes. Every frame is a fixed header followed by a payload:
+#   request   <I payload length> <I request id> <B opcode>
+#   response  <I payload length> <I request id> <B status> <I compactions>
+# Requests on a connection may be pipelined; responses carry the request id
+# and can come back in any order. Every response also carries the number of
+# compactions the service has finished, so clients learn of one with the next
+# reply and can drop what they derived from the old counts. learn, gen and has_response payloads are
+# batches of strings, so one frame can carry many calls. A sourced learn
+# sends each buffer followed by its JSON-encoded (channel, authors) source.
+
+SOCKET_PATH = 'aniv_model.sock'
+HEADER = struct.Struct('<IIB')
+RESPONSE_HEADER = struct.Struct('<IIBI')
+MAX_FRAME = 64 * 1024 * 1024
+
+OP_LEARN = 1
+OP_GEN = 2
+OP_HAS_RESPONSE = 3
+OP_STATS = 4
+OP_SAVE = 5
+OP_LEARN_SOURCED = 6
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+_COUNT = struct.Struct('<I')
+_LENGTH = struct.Struct('<i')
+
+def encode_strings(items):
+    # count, then a length (-1 for None) and utf-8 bytes per item
+    parts = [_COUNT.pack(len(items))]
+    for item in items:
+        if item is None:
+            parts.append(_LENGTH.pack(-1))
+        else:
+            data = item.encode('utf-8', 'surrogatepass')
+            parts.append(_LENGTH.pack(len(data)))
+            parts.append(data)
+    return b''.join(parts)
+
+def decode_strings(payload):
+    count, = _COUNT.unpack_from(payload, 0)
+    pos = _COUNT.size
+    items = []
+    for _ in range(count):
+        length, = _LENGTH.unpack_from(payload, pos)
+        pos += _LENGTH.size
+        if length < 0:
+            items.append(None)
+        else:
+            items.append(payload[pos:pos + length].decode('utf-8', 'surrogatepass'))
+            pos += length
+    return items
+
+def encode_bools(items):
+    return _COUNT.pack(len(items)) + bytes(1 if item else 0 for item in items)
+
+def decode_bools(payload):
+    count, = _COUNT.unpack_from(payload, 0)
+    return [b != 0 for b in payload[_COUNT.size:_COUNT.size + count]]
+
+class ModelService():
+    def __init__(self, markov, path=SOCKET_PATH):
+        self.__markov = markov
+        self.__model = ModelExecutor(markov)
+        self.__path = path
+        self.__server = None
+        self.__writers = set()
+        self.__JOURNAL_FLUSH_INTERVAL = 5
+        self.__COMPACTION_INTERVAL = 1800
+        self.__FILTER_RELOAD_INTERVAL = 10
+        self.__compaction_task = None
+        self.__stats = {
+            'connections': 0,
+            'requests': 0,
+            'items': 0,
+            'errors': 0,
+            'compactions': 0,
+        }
+
+    def get_model(self):
+        return self.__model
+
+    def stats(self):
+        return dict(self.__stats)
+
+    async def start(self):
+        # a socket file left behind by a dead service would block the bind
+        if os.path.exists(self.__path):
+            os.remove(self.__path)
+        self.__server = await asyncio.start_unix_server(self.__handle, self.__path)
+
+    async def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            # server.close() leaves accepted connections open
+            for writer in list(self.__writers):
+                writer.close()
+            await self.__server.wait_closed()
+            self.__server = None
+        if os.path.exists(self.__path):
+            os.remove(self.__path)
+        await self.__model.save_buffers()
+        self.__model.shutdown()
+
+    async def compact(self):
+        await self.__model.compact()
+        self.__stats['compactions'] += 1
+
+    async def maintain(self):
+        # the service owns the journal and compaction; clients never do
+        last_save = last_compaction = last_reload = time.time()
+        while True:
+            await asyncio.sleep(1)
+            ts = time.time()
+            if ts - last_save > self.__JOURNAL_FLUSH_INTERVAL:
+                await self.__model.save_buffers()
+                last_save = ts
+            if ts - last_compaction > self.__COMPACTION_INTERVAL or await self.__model.needs_compaction():
+                if self.__compaction_task is None or self.__compaction_task.done():
+                    last_compaction = ts
+                    self.__compaction_task = asyncio.ensure_future(self.compact())
+            if ts - last_reload > self.__FILTER_RELOAD_INTERVAL:
+                last_reload = ts
+                try:
+                    self.__markov.reload_filters()
+                    self.__markov.sync_provenance(self.__model)
+                except (IOError, ValueError) as e:
+                    print("Exception occured while reloading filters:", e)
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    async def __handle(self, reader, writer):
+        self.__stats['connections'] += 1
+        self.__writers.add(writer)
+        tasks = set()
+        try:
+            while True:
+                length, request_id, op = HEADER.unpack(await reader.readexactly(HEADER.size))
+                if length > MAX_FRAME:
+                    print("Model service dropped a client sending a", length, "byte frame")
+                    break
+                payload = await reader.readexactly(length)
+                task = asyncio.ensure_future(self.__respond(writer, request_id, op, payload))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self.__stats['connections'] -= 1
+            self.__writers.discard(writer)
+            writer.close()
+
+    async def __respond(self, writer, request_id, op, payload):
+        self.__stats['requests'] += 1
+        try:
+            status = STATUS_OK
+            body = await self.__dispatch(op, payload)
+        except Exception as e:
+            self.__stats['errors'] += 1
+            status = STATUS_ERROR
+            body = f'{type(e).__name__}: {e}'.encode('utf-8')
+        if not writer.is_closing():
+            writer.write(RESPONSE_HEADER.pack(len(body), request_id, status, self.__stats['compactions']) + body)
+            await writer.drain()
+
+    async def __dispatch(self, op, payload):
+        if op == OP_LEARN:
+            items = decode_strings(payload)
+            self.__stats['items'] += len(items)
+            return encode_strings(await self.__model.learn_batch(items))
+        elif op == OP_LEARN_SOURCED:
+            items = decode_strings(payload)
+            self.__stats['items'] += len(items) // 2
+            sources = [ujson.loads(source) for source in items[1::2]]
+            return encode_strings(await self.__model.learn_batch(items[0::2], sources))
+        elif op == OP_GEN:
+            items = decode_strings(payload)
+            self.__stats['items'] += len(items)
+            return encode_strings(await self.__model.gen_batch(items))
+        elif op == OP_HAS_RESPONSE:
+            items = decode_strings(payload)
+            self.__stats['items'] += len(items)
+            return encode_bools(await self.__model.has_response_batch(items))
+        elif op == OP_STATS:
+            stats = await self.__model.stats()
+            stats['service'] = self.stats()
+            stats['queue_depth'] = self.__model.queue_depth()
+            return ujson.dumps(stats).encode('utf-8')
+        elif op == OP_SAVE:
+            await self.__model.save_buffers()
+            return b''
+        raise ValueError(f"Unknown opcode {op}")
+
+class ModelClient():
+    # Same interface as ModelExecutor, backed by a ModelService. One
+    # connection is kept open and reused; calls made in the same event loop
+    # iteration are coalesced into one batched frame per operation, and any
+    # number of frames can be in flight at once.
+    def __init__(self, path=SOCKET_PATH):
+        self.__path = path
+        self.__reader = None
+        self.__writer = None
+        self.__read_task = None
+        self.__connect_lock = None
+        self.__next_id = 0
+        self.__in_flight = dict()
+        self.__queued = dict()
+        self.__flush_scheduled = False
+        # compactions the service reported with its latest response, and the
+        # count as of the last compact() call
+        self.__compactions = 0
+        self.__seen_compactions = 0
+
+    def get_markov(self):
+        return None
+
+    def queue_depth(self):
+        return len(self.__in_flight) + sum(len(q) for q in self.__queued.values())
+
+    async def learn_from_buffer(self, data, source=None):
+        if source is None:
+            return await self.__coalesced(OP_LEARN, data)
+        return await self.__coalesced(OP_LEARN_SOURCED, (data, source))
+
+    async def gen(self, inp):
+        return await self.__coalesced(OP_GEN, inp)
+
+    async def has_response(self, msg):
+        return await self.__coalesced(OP_HAS_RESPONSE, msg)
+
+    async def learn_batch(self, buffers, sources=None):
+        if sources is None:
+            return decode_strings(await self.__request(OP_LEARN, encode_strings(buffers)))
+        return decode_strings(await self.__request(OP_LEARN_SOURCED, self.__encode_sourced(zip(buffers, sources))))
+
+    async def gen_batch(self, inputs):
+        return decode_strings(await self.__request(OP_GEN, encode_strings(inputs)))
+
+    async def has_response_batch(self, msgs):
+        return decode_bools(await self.__request(OP_HAS_RESPONSE, encode_strings(msgs)))
+
+    async def stats(self):
+        return ujson.loads(await self.__request(OP_STATS, b''))
+
+    # the service schedules its own compactions; a compaction it finished
+    # since the last compact() call counts as needed, so the bot's usual
+    # compaction path drops what it derived from the old counts
+    async def needs_compaction(self):
+        return self.__compactions != self.__seen_compactions
+
+    async def compact(self):
+        self.__seen_compactions = self.__compactions
+
+    async def save_buffers(self):
+        await self.__request(OP_SAVE, b'')
+
+    async def close(self):
+        if self.__writer is not None:
+            self.__writer.close()
+        if self.__read_task is not None:
+            self.__read_task.cancel()
+        self.__fail_in_flight(ConnectionError("Model client closed"))
+        self.__reader = self.__writer = self.__read_task = None
+
+    def shutdown(self):
+        if self.__writer is not None:
+            self.__writer.close()
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    async def __connect(self):
+        if self.__connect_lock is None:
+            self.__connect_lock = asyncio.Lock()
+        async with self.__connect_lock:
+            if self.__writer is None or self.__writer.is_closing():
+                self.__reader, self.__writer = await asyncio.open_unix_connection(self.__path)
+                self.__read_task = asyncio.ensure_future(self.__read_responses(self.__reader))
+
+    async def __request(self, op, payload):
+        if self.__writer is None or self.__writer.is_closing():
+            await self.__connect()
+        self.__next_id = (self.__next_id + 1) & 0xffffffff
+        request_id = self.__next_id
+        future = asyncio.get_event_loop().create_future()
+        self.__in_flight[request_id] = future
+        try:
+            self.__writer.write(HEADER.pack(len(payload), request_id, op) + payload)
+            await self.__writer.drain()
+        except ConnectionError:
+            self.__in_flight.pop(request_id, None)
+            raise
+        return await future
+
+    async def __coalesced(self, op, item):
+        future = asyncio.get_event_loop().create_future()
+        self.__queued.setdefault(op, []).append((item, future))
+        if not self.__flush_scheduled:
+            # runs after every call already scheduled this iteration has queued
+            self.__flush_scheduled = True
+            asyncio.ensure_future(self.__send_queued())
+        return await future
+
+    async def __send_queued(self):
+        self.__flush_scheduled = False
+        queued = self.__queued
+        self.__queued = dict()
+        await asyncio.gather(*(self.__send_batch(op, batch) for op, batch in queued.items()))
+
+    async def __send_batch(self, op, batch):
+        items = [item for item, _ in batch]
+        try:
+            if op == OP_LEARN_SOURCED:
+                payload = await self.__request(op, self.__encode_sourced(items))
+            else:
+                payload = await self.__request(op, encode_strings(items))
+            results = decode_bools(payload) if op == OP_HAS_RESPONSE else decode_strings(payload)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def __read_responses(self, reader):
+        try:
+            while True:
+                length, request_id, status, compactions = RESPONSE_HEADER.unpack(await reader.readexactly(RESPONSE_HEADER.size))
+                payload = await reader.readexactly(length)
+                self.__compactions = compactions
+                future = self.__in_flight.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if status == STATUS_OK:
+                    future.set_result(payload)
+                else:
+                    future.set_exception(RuntimeError(payload.decode('utf-8', 'replace')))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            # the next request reconnects
+            self.__fail_in_flight(ConnectionError(f"Lost connection to the model service: {e}"))
+            if self.__writer is not None:
+                self.__writer.close()
+
+    def __encode_sourced(self, items):
+        return encode_strings([part for data, source in items for part in (data, ujson.dumps(source))])
+
+    def __fail_in_flight(self, error):
+        in_flight = self.__in_flight
+        self.__in_flight = dict()
+        for future in in_flight.values():
+            if not future.done():
+                future.set_exception(error)
+
+async def serve(markov, path=SOCKET_PATH):
+    service = ModelService(markov, path)
+    await service.start()
+    print(f"Serving the model on {path}")
+    try:
+        await service.maintain()
+    finally:
+        await service.close()
@@ -0,0 +1,118 @@
+import time
+import asyncio
+from metrics import Registry
+
+class PregenCache():
+    # Replies generated ahead of time, per channel, for the context the
+    # channel would reply to next. The bot asks for candidates on the message
+    # before a post is due, so posting is a lookup instead of a generation
+    # (and its filter retries) on the message path. Candidates only count for
+    # the exact context they were generated from, expire after max_age, and
+    # are dropped when the filters or the model's counts change wholesale
+    # (filter reload, compaction); everything generated but never posted is
+    # counted as wasted. When a channel's own chat is learned its candidates
+    # are regenerated, so a post reflects that chat once it has been learned.
+    def __init__(self, model, size=1, max_age=60, metrics=None):
+        self.__model = model
+        self.__size = size
+        self.__max_age = max_age
+        self.__entries = dict()
+        metrics = metrics if metrics is not None else Registry(enabled=False)
+        self.__hits = metrics.counter('pregen_hits_total', 'Posts served from a pre-generated candidate')
+        self.__misses = metrics.counter('pregen_misses_total', 'Posts that had to be generated on the message path')
+        self.__generated = metrics.counter('pregen_generated_total', 'Candidate replies generated ahead of time')
+        self.__wasted = metrics.counter('pregen_wasted_total', 'Pre-generated candidates discarded without being posted')
+        self.__stats = {
+            'hits': 0,
+            'misses': 0,
+            'generated': 0,
+            'wasted': 0,
+        }
+
+    def prepare(self, channel, context):
+        # called whenever the channel's reply context may have changed
+        entry = self.__entries.get(channel)
+        if entry is None:
+            entry = self.__entries[channel] = {'context': None, 'candidates': [], 'created': 0, 'task': None, 'filling': None}
+        if entry['context'] != context or self.__expired(entry):
+            self.__drop(entry)
+            entry['context'] = context
+            entry['created'] = time.monotonic()
+        # a fill still running for an older context is left to finish as waste
+        if len(entry['candidates']) < self.__size and (entry['task'] is None or entry['task'].done() or entry['filling'] != entry['created']):
+            entry['filling'] = entry['created']
+            entry['task'] = asyncio.ensure_future(self.__fill(entry, context, entry['created']))
+
+    def take(self, channel, context):
+        entry = self.__entries.get(channel)
+        if entry is not None and entry['context'] == context and entry['candidates'] and not self.__expired(entry):
+            self.__count('hits', self.__hits)
+            return entry['candidates'].pop()
+        self.__count('misses', self.__misses)
+        return None
+
+    def refresh(self, channel):
+        # called after the channel's chat is learned; an entry with nothing
+        # cached or being generated has nothing stale to replace
+        entry = self.__entries.get(channel)
+        if entry is None or entry['context'] is None:
+            return
+        if not entry['candidates'] and (entry['task'] is None or entry['task'].done()):
+            return
+        context = entry['context']
+        self.__drop(entry)
+        self.prepare(channel, context)
+
+    def invalidate(self, channel=None):
+        entries = self.__entries.values() if channel is None else [self.__entries[channel]] if channel in self.__entries else []
+        for entry in entries:
+            self.__drop(entry)
+
+    def discard(self, channel):
+        entry = self.__entries.pop(channel, None)
+        if entry is not None:
+            self.__drop(entry)
+
+    def stats(self):
+        stats = dict(self.__stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['channels'] = len(self.__entries)
+        stats['cached'] = sum(len(entry['candidates']) for entry in self.__entries.values())
+        return stats
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __count(self, key, counter, amount=1):
+        self.__stats[key] += amount
+        counter.inc(amount)
+
+    def __expired(self, entry):
+        return time.monotonic() - entry['created'] > self.__max_age
+
+    def __drop(self, entry):
+        # an in-flight fill notices the new generation and discards its result
+        if entry['candidates']:
+            self.__count('wasted', self.__wasted, len(entry['candidates']))
+        entry['candidates'] = []
+        entry['context'] = None
+        entry['created'] = 0
+
+    async def __fill(self, entry, context, created):
+        missing = self.__size - len(entry['candidates'])
+        try:
+            # one trip to the model for every missing candidate
+            outputs = await self.__model.gen_batch([context] * missing)
+        except Exception as e:
+            print("Exception occured while pre-generating replies:", e)
+            return
+        outputs = [output for output in outputs if output]
+        self.__count('generated', self.__generated, len(outputs))
+        if entry['context'] != context or entry['created'] != created:
+            self.__count('wasted', self.__wasted, len(outputs))
+            return
+        keep = outputs[:self.__size - len(entry['candidates'])]
+        entry['candidates'].extend(keep)
+        if len(keep) < len(outputs):
+            self.__count('wasted', self.__wasted, len(outputs) - len(keep))
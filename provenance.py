@@ -0,0 +1,297 @@
+import os
+import re
+import zlib
+import struct
+import asyncio
+import threading
+import ujson
+from concurrent.futures import ThreadPoolExecutor
+from filters import PatternMatcher
+
+# Chunk files are a sequence of frames, one per flush:
+#   <I names length> <I body length>
+#   names  utf-8 JSON {"users": [...], "channels": [...]}, left uncompressed so
+#          an unlearn scoped to users or channels skips frames without
+#          inflating them
+#   body   zlib-compressed JSON list of buffers, each
+#          [channel index, text, lead-in length, [[user index, length], ...]]
+# text is exactly what learn_from_buffer was given: a lead-in carried over
+# from the channel's previous buffer, then one run of characters per message.
+FRAME = struct.Struct('<II')
+
+class ProvenanceLog():
+    # Which channel and user taught the model each transition. Every learned
+    # buffer is kept with its authors in compressed chunk files, so the
+    # transitions a user, a channel or a filtered word contributed can be
+    # found and subtracted again later. A transition belongs to the message
+    # its next character is in; unlearning a message subtracts exactly the
+    # transitions learning it added, and removes it from the log.
+    def __init__(self, directory='data/provenance', order=10, chunk_bytes=4 * 1024 * 1024, unlearn_batch=256):
+        os.makedirs(directory, exist_ok=True)
+        self.__directory = directory
+        self.__order = order
+        self.__chunk_bytes = chunk_bytes
+        self.__UNLEARN_BATCH = unlearn_batch
+        self.__state_file = os.path.join(directory, 'state.json')
+        self.__chunk = self.__last_chunk() + 1
+        self.__pending = []
+        # record runs on the model's thread, flushes on either thread
+        self.__pending_lock = threading.Lock()
+        self.__write_lock = threading.Lock()
+        self.__worker = ThreadPoolExecutor(1, 'provenance')
+        self.__unlearn_lock = None
+        self.__sync_task = None
+        self.__applied = self.__load_state()
+        self.__stats = {
+            'provenance_buffers': 0,
+            'unlearn_jobs': 0,
+            'unlearned_messages': 0,
+            'unlearned_chars': 0,
+        }
+
+    def record(self, channel, data, authors):
+        # authors: (user, length) of each message making up the end of data
+        lead = len(data) - sum(length for _, length in authors)
+        if lead < 0 or len(data) <= self.__order:
+            return
+        with self.__pending_lock:
+            self.__pending.append((channel, data, lead, authors))
+        self.__stats['provenance_buffers'] += 1
+
+    async def flush(self):
+        await asyncio.get_event_loop().run_in_executor(self.__worker, self.flush_sync)
+
+    def flush_sync(self):
+        with self.__write_lock:
+            self.__write_pending()
+
+    def stats(self):
+        stats = dict(self.__stats)
+        chunks = self.__chunks()
+        stats['provenance_chunks'] = len(chunks)
+        stats['provenance_bytes'] = sum(os.path.getsize(path) for _, path in chunks)
+        stats['unlearn_running'] = 1 if self.__unlearn_lock is not None and self.__unlearn_lock.locked() else 0
+        return stats
+
+    def sync(self, model, users, channels, patterns):
+        # starts unlearning whatever was added to the ignore lists and the
+        # filters since the last sync; the very first sync only takes note
+        current = {'users': set(users), 'channels': set(channels), 'patterns': set(patterns)}
+        if self.__applied is None:
+            self.__save_state(current)
+            return None
+        if self.__sync_task is not None and not self.__sync_task.done():
+            return None
+        added = {key: current[key] - self.__applied[key] for key in current}
+        if not any(added.values()):
+            # entries taken off a list are forgotten, so adding them back
+            # unlearns whatever was learned from them in between
+            if current != self.__applied:
+                self.__save_state(current)
+            return None
+        self.__sync_task = asyncio.ensure_future(self.__sync(model, added, current))
+        return self.__sync_task
+
+    async def unlearn(self, model, users=(), channels=(), patterns=()):
+        # subtracts everything the given users and channels taught the model,
+        # and every message containing one of the patterns. Runs a chunk at a
+        # time, with the model calls going through the same front as chat, so
+        # the bot carries on meanwhile.
+        users = frozenset(user.lower() for user in users)
+        channels = frozenset(channel.lower() for channel in channels)
+        matcher = PatternMatcher(patterns) if patterns else None
+        if self.__unlearn_lock is None:
+            self.__unlearn_lock = asyncio.Lock()
+        loop = asyncio.get_event_loop()
+        messages = 0
+        chars = 0
+        async with self.__unlearn_lock:
+            # chat learned from here on goes into a new chunk
+            last = await loop.run_in_executor(self.__worker, self.__seal)
+            for chunk, path in self.__chunks():
+                if chunk > last:
+                    break
+                result = await loop.run_in_executor(self.__worker, self.__scan, path, users, channels, matcher)
+                if result is None:
+                    continue
+                removed, frames, count = result
+                for i in range(0, len(removed), self.__UNLEARN_BATCH):
+                    await model.unlearn_batch(removed[i:i + self.__UNLEARN_BATCH])
+                # the subtractions are in the journal before the chunk forgets
+                # them, so a crash in between can't leave them unapplied
+                await model.save_buffers()
+                await loop.run_in_executor(self.__worker, self.__rewrite, path, frames)
+                messages += count
+                chars += sum(len(text) for text in removed)
+            self.__stats['unlearn_jobs'] += 1
+            self.__stats['unlearned_messages'] += messages
+            self.__stats['unlearned_chars'] += chars
+        return {'messages': messages, 'chars': chars}
+
+    def close(self):
+        self.flush_sync()
+        self.__worker.shutdown(wait=True)
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    async def __sync(self, model, added, current):
+        try:
+            result = await self.unlearn(model, added['users'], added['channels'], added['patterns'])
+        except Exception as e:
+            print("Exception occured while unlearning:", e)
+            return None
+        self.__save_state(current)
+        print(f"Unlearned {result['messages']} messages for {len(added['users'])} users, {len(added['channels'])} channels and {len(added['patterns'])} filter patterns")
+        return result
+
+    def __write_pending(self):
+        with self.__pending_lock:
+            buffers = self.__pending
+            self.__pending = []
+        if not buffers:
+            return
+        path = self.__chunk_path(self.__chunk)
+        with open(path, 'ab') as f:
+            f.write(self.__encode(buffers))
+            size = f.tell()
+        if size >= self.__chunk_bytes:
+            self.__chunk += 1
+
+    def __seal(self):
+        with self.__write_lock:
+            self.__write_pending()
+            closed = self.__chunk
+            self.__chunk += 1
+            return closed
+
+    def __encode(self, buffers):
+        users = dict()
+        channels = dict()
+        rows = []
+        for channel, text, lead, authors in buffers:
+            c = channels.setdefault(channel, len(channels))
+            rows.append([c, text, lead, [[users.setdefault(user, len(users)), length] for user, length in authors]])
+        names = ujson.dumps({'users': list(users), 'channels': list(channels)}).encode('utf-8')
+        body = zlib.compress(ujson.dumps(rows).encode('utf-8'))
+        return FRAME.pack(len(names), len(body)) + names + body
+
+    def __decode(self, names, body):
+        users = names['users']
+        channels = names['channels']
+        return [(channels[c], text, lead, [(users[u], length) for u, length in authors])
+            for c, text, lead, authors in ujson.loads(zlib.decompress(body))]
+
+    def __read_frames(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        frames = []
+        pos = 0
+        while pos + FRAME.size <= len(data):
+            names_len, body_len = FRAME.unpack_from(data, pos)
+            start = pos + FRAME.size
+            end = start + names_len + body_len
+            if end > len(data):
+                # torn write from a crash mid-append
+                break
+            frames.append((ujson.loads(data[start:start + names_len]), data[start + names_len:end]))
+            pos = end
+        return frames
+
+    def __scan(self, path, users, channels, matcher):
+        # (texts to unlearn, the chunk's frames without them, message count),
+        # or None when nothing in the chunk matches
+        frames = []
+        removed = []
+        count = 0
+        for names, body in self.__read_frames(path):
+            if matcher is None and users.isdisjoint(names['users']) and channels.isdisjoint(names['channels']):
+                frames.append((names, body))
+                continue
+            kept = []
+            before = len(removed)
+            for buffer in self.__decode(names, body):
+                count += self.__split(buffer, users, channels, matcher, removed, kept)
+            if len(removed) == before:
+                frames.append((names, body))
+            elif kept:
+                frames.append(kept)
+        if not removed:
+            return None
+        return removed, frames, count
+
+    def __split(self, buffer, users, channels, matcher, removed, kept):
+        # consecutive messages are grouped into runs to unlearn or keep; each
+        # run takes the `order` characters before it as its lead-in
+        channel, text, lead, authors = buffer
+        runs = []
+        pos = lead
+        for user, length in authors:
+            end = pos + length
+            drop = channel in channels or user in users or (matcher is not None and matcher.search(text[pos:end]))
+            if runs and runs[-1][2] == drop:
+                runs[-1][1] = end
+                runs[-1][3].append((user, length))
+            else:
+                runs.append([pos, end, drop, [(user, length)]])
+            pos = end
+        if not any(drop for _, _, drop, _ in runs):
+            kept.append(buffer)
+            return 0
+        count = 0
+        for start, end, drop, members in runs:
+            first = max(0, start - self.__order)
+            if drop:
+                removed.append(text[first:end])
+                count += len(members)
+            else:
+                kept.append((channel, text[first:end], start - first, members))
+        return count
+
+    def __rewrite(self, path, frames):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for frame in frames:
+                if isinstance(frame, list):
+                    f.write(self.__encode(frame))
+                else:
+                    names, body = frame
+                    names = ujson.dumps(names).encode('utf-8')
+                    f.write(FRAME.pack(len(names), len(body)) + names + body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if os.path.getsize(path) == 0:
+            os.remove(path)
+
+    def __load_state(self):
+        # the ignore lists and patterns already unlearned; None before the
+        # first sync
+        if not os.path.exists(self.__state_file):
+            return None
+        with open(self.__state_file, 'r', encoding='utf-8') as f:
+            state = ujson.load(f)
+        return {key: set(state[key]) for key in ('users', 'channels', 'patterns')}
+
+    def __save_state(self, state):
+        tmp_path = self.__state_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            ujson.dump({key: sorted(values) for key, values in state.items()}, f)
+        os.replace(tmp_path, self.__state_file)
+        self.__applied = state
+
+    def __chunk_path(self, chunk):
+        return os.path.join(self.__directory, f'chunk.{chunk}.bin')
+
+    def __chunks(self):
+        pattern = re.compile(r'chunk\.(\d+)\.bin$')
+        found = []
+        for f in os.listdir(self.__directory):
+            m = pattern.match(f)
+            if m:
+                found.append((int(m.group(1)), os.path.join(self.__directory, f)))
+        return sorted(found)
+
+    def __last_chunk(self):
+        chunks = self.__chunks()
+        return chunks[-1][0] if chunks else 0
@@ -0,0 +1,80 @@
+import time
+import zlib
+import asyncio
+import collections
+
+# Twitch allows 20 JOINs per 10 seconds per account (2000 for verified bots).
+# The limit is per account, so every shard shares one limiter.
+JOIN_RATE = 2.0
+JOIN_BURST = 20
+
+class JoinLimiter():
+    # At most capacity joins in any capacity / rate seconds, which is how
+    # Twitch counts them. A token bucket of the same size would also allow a
+    # full window's refill on top of its burst, twice the limit.
+    #
+    # Twitch counts a join when it arrives, which the time it was granted
+    # says nothing about: twitchio sends joins from tasks of their own. Each
+    # granted join is stamped by sent() once the server has answered it,
+    # after it arrived, and counts against the limit until then.
+    def __init__(self, rate=JOIN_RATE, capacity=JOIN_BURST):
+        self.__capacity = capacity
+        self.__window = capacity / rate
+        # when each join still inside the window was answered
+        self.__sent = collections.deque()
+        self.__pending = 0
+        self.__PENDING_POLL = 0.1
+
+    def available(self):
+        self.__expire()
+        return self.__capacity - len(self.__sent) - self.__pending
+
+    def take(self, n):
+        # takes up to n joins without waiting and returns how many were taken;
+        # each one taken has to be reported to sent() once it is written
+        granted = max(0, min(n, self.available()))
+        self.__pending += granted
+        return granted
+
+    def sent(self, n):
+        self.__pending -= n
+        self.__sent.extend([time.monotonic()] * n)
+
+    async def acquire(self, n):
+        # waits until at least one join is free, then takes up to n
+        while True:
+            granted = self.take(n)
+            if granted > 0:
+                return granted
+            if self.__sent:
+                await asyncio.sleep(self.__sent[0] + self.__window - time.monotonic())
+            else:
+                # everything is granted and still unanswered
+                await asyncio.sleep(self.__PENDING_POLL)
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __expire(self):
+        cutoff = time.monotonic() - self.__window
+        while self.__sent and self.__sent[0] <= cutoff:
+            self.__sent.popleft()
+
+def shard_of(channel, shards):
+    # stable across restarts and processes, unlike hash()
+    return zlib.crc32(channel.lower().encode('utf-8')) % shards
+
+def owner_of(channel, shards, processes=1):
+    # (process, shard within it) for a channel. The process is
+    # shard_of(channel, processes) whatever each process' shard count.
+    slot = shard_of(channel, shards * processes)
+    return slot % processes, slot // processes
+
+def shard_channels(channels, shards, process=0, processes=1):
+    # the channels this process owns, split over its shards
+    out = [[] for _ in range(shards)]
+    for channel in channels:
+        owner, shard = owner_of(channel, shards, processes)
+        if owner == process:
+            out[shard].append(channel)
+    return out
@@ -0,0 +1,441 @@
+import os
+import sys
+import time
+import mmap
+import struct
+import zlib
+import ujson
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+
+# Binary snapshot layout (native little-endian arrays, sections 8-byte aligned):
+#   header
+#   context offsets  Q * (contexts + 1)   into the context text blob
+#   row pointers     Q * (contexts + 1)   into the edge arrays
+#   edge chars       I * edges            code points
+#   edge counts      I * edges            running totals within each row (v3+)
+#   last used        H * contexts         compaction epoch of last use (v2+)
+#   context index    i * slots            open addressing on crc32 (v3+)
+#   context text     utf-8, contexts sorted bytewise
+# v1 and v2 snapshots store plain counts and have no index; they still load,
+# and the next compaction rewrites them as v3.
+MAGIC = b'ANIVSNAP'
+VERSION = 3
+PREAMBLE = struct.Struct('<8sI')
+HEADERS = {
+    1: struct.Struct('<8sIIQQQQ'),
+    2: struct.Struct('<8sIIQQQQQQ'),
+    3: struct.Struct('<8sIIQQQQQQ'),
+}
+MAX_EPOCH = 0xffff
+SLICE_ROWS = 4096
+
+def _align(n):
+    return (n + 7) & ~7
+
+def _index_slots(contexts):
+    # a power of two at least twice the contexts, so lookups probe ~1.5 slots
+    slots = 1
+    while slots < 2 * contexts:
+        slots *= 2
+    return slots
+
+def _layout(contexts, edges, text_len, version=VERSION):
+    sizes = [8 * (contexts + 1), 8 * (contexts + 1), 4 * edges, 4 * edges]
+    if version >= 2:
+        sizes.append(2 * contexts)
+    if version >= 3:
+        sizes.append(4 * _index_slots(contexts))
+    sizes.append(text_len)
+    offsets = []
+    pos = _align(HEADERS[version].size)
+    for size in sizes:
+        offsets.append(pos)
+        pos = _align(pos + size)
+    return offsets, pos
+
+class Snapshot():
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise ValueError("Snapshots can only be mapped on little-endian hosts")
+        self.__path = path
+        self.__file = open(path, 'rb')
+        self.__mm = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = PREAMBLE.unpack_from(self.__mm, 0)
+        if magic != MAGIC or version not in HEADERS:
+            raise ValueError(f"'{path}' is not a version 1-{VERSION} snapshot")
+        self.__epoch = 0
+        self.__decayed_at = 0
+        if version == 1:
+            _, _, self.__order, self.__journal_segment, self.__contexts, self.__edges, text_len = HEADERS[1].unpack_from(self.__mm, 0)
+        else:
+            _, _, self.__order, self.__journal_segment, self.__contexts, self.__edges, text_len, self.__epoch, self.__decayed_at = HEADERS[version].unpack_from(self.__mm, 0)
+
+        offsets, _ = _layout(self.__contexts, self.__edges, text_len, version)
+        mv = memoryview(self.__mm)
+        self.__ctx_offsets = mv[offsets[0]:offsets[0] + 8 * (self.__contexts + 1)].cast('Q')
+        self.__row_ptr = mv[offsets[1]:offsets[1] + 8 * (self.__contexts + 1)].cast('Q')
+        self.__edge_chars = mv[offsets[2]:offsets[2] + 4 * self.__edges].cast('I')
+        self.__edge_counts = mv[offsets[3]:offsets[3] + 4 * self.__edges].cast('I')
+        self.__last_used = None
+        if version >= 2:
+            self.__last_used = mv[offsets[4]:offsets[4] + 2 * self.__contexts].cast('H')
+        # v3 counts are running totals, so a row is sampled by bisecting
+        # the mapped section in place
+        self.__running_totals = version >= 3
+        self.__index = None
+        if version >= 3:
+            slots = _index_slots(self.__contexts)
+            self.__index = mv[offsets[5]:offsets[5] + 4 * slots].cast('i')
+            self.__index_mask = slots - 1
+        self.__text_start = offsets[-1]
+
+    def __len__(self):
+        return self.__contexts
+
+    def get_epoch(self):
+        return self.__epoch
+
+    def get_decayed_at(self):
+        return self.__decayed_at
+
+    def last_used(self, idx):
+        if self.__last_used is None:
+            return 0
+        return self.__last_used[idx]
+
+    def get_order(self):
+        return self.__order
+
+    def get_journal_segment(self):
+        return self.__journal_segment
+
+    def nbytes(self):
+        return len(self.__mm)
+
+    def lookup(self, ctx):
+        key = ctx.encode('utf-8', 'surrogatepass')
+        if self.__index is not None:
+            index = self.__index
+            mask = self.__index_mask
+            i = zlib.crc32(key) & mask
+            while True:
+                idx = index[i]
+                if idx < 0:
+                    return -1
+                if self.__key(idx) == key:
+                    return idx
+                i = (i + 1) & mask
+        lo = 0
+        hi = self.__contexts
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            probe = self.__key(mid)
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def context(self, idx):
+        return self.__key(idx).decode('utf-8', 'surrogatepass')
+
+    def edges(self, idx):
+        begin = self.__row_ptr[idx]
+        end = self.__row_ptr[idx + 1]
+        return [(chr(code), count) for code, count in zip(self.__edge_chars[begin:end], self.__row_counts(begin, end))]
+
+    def cumulative(self, idx):
+        # ([code, ...], [running total, ...]) for a row; snapshot counts are
+        # always positive
+        begin = self.__row_ptr[idx]
+        end = self.__row_ptr[idx + 1]
+        if self.__running_totals:
+            return self.__edge_chars[begin:end].tolist(), self.__edge_counts[begin:end].tolist()
+        return self.__edge_chars[begin:end].tolist(), list(accumulate(self.__edge_counts[begin:end]))
+
+    def sample(self, idx, u):
+        # the code point of a row's edge at u in [0, 1) of its total count,
+        # read straight from the map
+        begin = self.__row_ptr[idx]
+        end = self.__row_ptr[idx + 1]
+        if end - begin == 1:
+            return self.__edge_chars[begin]
+        counts = self.__edge_counts
+        if self.__running_totals:
+            return self.__edge_chars[bisect_right(counts, u * counts[end - 1], begin, end - 1)]
+        r = u * sum(counts[begin:end])
+        for e in range(begin, end - 1):
+            r -= counts[e]
+            if r < 0:
+                return self.__edge_chars[e]
+        return self.__edge_chars[end - 1]
+
+    def raw_items(self):
+        # (context bytes, [(code point, count), ...], last used) in snapshot order
+        chars = self.__edge_chars
+        for idx in range(self.__contexts):
+            begin = self.__row_ptr[idx]
+            end = self.__row_ptr[idx + 1]
+            yield self.__key(idx), list(zip(chars[begin:end], self.__row_counts(begin, end))), self.last_used(idx)
+
+    def close(self):
+        # views must be released before the map can be closed
+        for view in (self.__ctx_offsets, self.__row_ptr, self.__edge_chars, self.__edge_counts, self.__last_used, self.__index):
+            if view is not None:
+                view.release()
+        self.__mm.close()
+        self.__file.close()
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __key(self, idx):
+        start = self.__text_start
+        return self.__mm[start + self.__ctx_offsets[idx]:start + self.__ctx_offsets[idx + 1]]
+
+    def __row_counts(self, begin, end):
+        counts = self.__edge_counts[begin:end].tolist()
+        if self.__running_totals:
+            return [total - prev for total, prev in zip(counts, [0] + counts)]
+        return counts
+
+class _SectionWriter():
+    def __init__(self, f, offset, typecode):
+        self.__f = f
+        self.__offset = offset
+        self.__typecode = typecode
+        self.__buf = bytearray() if typecode is None else array(typecode)
+
+    def append(self, value):
+        self.__buf.append(value)
+        if len(self.__buf) >= 65536:
+            self.flush()
+
+    def extend(self, values):
+        self.__buf.extend(values)
+        if len(self.__buf) >= 65536:
+            self.flush()
+
+    def flush(self):
+        if len(self.__buf) == 0:
+            return
+        data = bytes(self.__buf) if self.__typecode is None else self.__buf.tobytes()
+        self.__f.seek(self.__offset)
+        self.__f.write(data)
+        self.__offset += len(data)
+        self.__buf = bytearray() if self.__typecode is None else array(self.__typecode)
+
+def merge_layers(base, overlays, touched=None, decay=False):
+    # Generator factory over the sorted union of a snapshot and in-memory
+    # TransitionTables, summing counts and dropping anything that is not
+    # positive. Rows touched since the base was written, and rows with overlay
+    # counts, are stamped with the base's epoch; decay halves the base's
+    # counts before the overlays are added, so what was just learned keeps
+    # its full weight.
+    pending = dict()
+    for table in overlays:
+        for ctx, mapping in table.items():
+            key = ctx.encode('utf-8', 'surrogatepass')
+            merged = pending.setdefault(key, dict())
+            for char, count in mapping.items():
+                code = ord(char)
+                merged[code] = merged.get(code, 0) + count
+    keys = sorted(pending)
+    epoch = base.get_epoch() if base is not None else 0
+    shift = 1 if decay else 0
+
+    def clean(edges):
+        return [(code, count) for code, count in sorted(edges.items()) if count > 0]
+
+    def stream():
+        i = 0
+        if base is not None:
+            for idx, (key, edges, last_used) in enumerate(base.raw_items()):
+                while i < len(keys) and keys[i] < key:
+                    yield keys[i], clean(pending[keys[i]]), epoch
+                    i += 1
+                if touched is not None and touched[idx >> 3] & (1 << (idx & 7)):
+                    last_used = epoch
+                if i < len(keys) and keys[i] == key:
+                    combined = {code: count >> shift for code, count in edges}
+                    for code, count in pending[key].items():
+                        combined[code] = combined.get(code, 0) + count
+                    yield key, clean(combined), epoch
+                    i += 1
+                elif decay:
+                    yield key, clean({code: count >> shift for code, count in edges}), last_used
+                else:
+                    yield key, edges, last_used
+        while i < len(keys):
+            yield keys[i], clean(pending[keys[i]]), epoch
+            i += 1
+
+    return stream
+
+def _eviction_group(row, last_used):
+    # rows are evicted least recently used epoch first and, within an
+    # epoch, rows seen least often first (by the bit length of their total)
+    return last_used, min(sum(count for _, count in row).bit_length(), 32)
+
+def write_snapshot(path, order, journal_segment, stream, epoch=0, decayed_at=0, max_bytes=None):
+    # Two passes over the merged stream: one to size the sections (and pick
+    # what to evict to fit max_bytes), one to write; a third finds where to
+    # stop when only part of a group has to go, so stream() has to yield the
+    # same rows every time it is called. Every pass yields the GIL
+    # every SLICE_ROWS rows so a background compaction never starves the
+    # threads serving the model.
+    groups = dict()
+    dropped = 0
+    rows = 0
+    for key, row, last_used in stream():
+        rows += 1
+        if rows % SLICE_ROWS == 0:
+            time.sleep(0)
+        if not row:
+            dropped += 1
+            continue
+        group = _eviction_group(row, last_used) if max_bytes is not None else None
+        totals = groups.setdefault(group, [0, 0, 0])
+        totals[0] += 1
+        totals[1] += len(row)
+        totals[2] += len(key)
+
+    contexts = sum(totals[0] for totals in groups.values())
+    edges = sum(totals[1] for totals in groups.values())
+    text_len = sum(totals[2] for totals in groups.values())
+    # whole groups that go, then the group evicted from until it fits
+    evicted_groups = set()
+    partial = None
+    partial_rows = 0
+    for group in sorted(groups) if max_bytes is not None else ():
+        if _layout(contexts, edges, text_len)[1] <= max_bytes:
+            break
+        g_contexts, g_edges, g_text = groups[group]
+        if _layout(contexts - g_contexts, edges - g_edges, text_len - g_text)[1] > max_bytes:
+            evicted_groups.add(group)
+            contexts -= g_contexts
+            edges -= g_edges
+            text_len -= g_text
+            continue
+        partial = group
+        rows = 0
+        for key, row, last_used in stream():
+            rows += 1
+            if rows % SLICE_ROWS == 0:
+                time.sleep(0)
+            if not row or _eviction_group(row, last_used) != group:
+                continue
+            partial_rows += 1
+            contexts -= 1
+            edges -= len(row)
+            text_len -= len(key)
+            if _layout(contexts, edges, text_len)[1] <= max_bytes:
+                break
+        break
+    evicted = sum(groups[group][0] for group in evicted_groups) + partial_rows
+
+    # keep epochs within 16 bits by sliding everything down
+    rebase = 0
+    if epoch > MAX_EPOCH:
+        rebase = epoch - MAX_EPOCH // 2
+        epoch -= rebase
+
+    offsets, total = _layout(contexts, edges, text_len)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.truncate(total)
+        f.seek(0)
+        f.write(HEADERS[VERSION].pack(MAGIC, VERSION, order, journal_segment, contexts, edges, text_len, epoch, int(decayed_at)))
+        ctx_offsets = _SectionWriter(f, offsets[0], 'Q')
+        row_ptr = _SectionWriter(f, offsets[1], 'Q')
+        edge_chars = _SectionWriter(f, offsets[2], 'I')
+        edge_counts = _SectionWriter(f, offsets[3], 'I')
+        last_used_section = _SectionWriter(f, offsets[4], 'H')
+        text = _SectionWriter(f, offsets[6], None)
+        # crc32 of each written context, in row order, for the index
+        hashes = array('I')
+
+        text_pos = 0
+        edge_pos = 0
+        ctx_offsets.append(0)
+        row_ptr.append(0)
+        rows = 0
+        skip = partial_rows
+        for key, row, last_used in stream():
+            rows += 1
+            if rows % SLICE_ROWS == 0:
+                time.sleep(0)
+            if not row:
+                continue
+            if max_bytes is not None:
+                group = _eviction_group(row, last_used)
+                if group in evicted_groups:
+                    continue
+                if skip and group == partial:
+                    skip -= 1
+                    continue
+            text.extend(key)
+            text_pos += len(key)
+            ctx_offsets.append(text_pos)
+            hashes.append(zlib.crc32(key))
+            total = 0
+            for code, count in row:
+                total = min(total + count, 0xffffffff)
+                edge_chars.append(code)
+                edge_counts.append(total)
+            edge_pos += len(row)
+            row_ptr.append(edge_pos)
+            last_used_section.append(max(0, last_used - rebase))
+
+        mask = _index_slots(contexts) - 1
+        index = array('i', [-1]) * (mask + 1)
+        for idx, h in enumerate(hashes):
+            i = h & mask
+            while index[i] >= 0:
+                i = (i + 1) & mask
+            index[i] = idx
+        del hashes
+        f.seek(offsets[5])
+        f.write(index.tobytes())
+        del index
+
+        for section in (ctx_offsets, row_ptr, edge_chars, edge_counts, last_used_section, text):
+            section.flush()
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return {
+        'contexts': contexts,
+        'bytes': total,
+        'evicted': evicted,
+        'dropped': dropped,
+    }
+
+def convert_json_snapshot(json_path, snapshot_path, order=10):
+    # one-shot conversion of the old markov_dict.txt format
+    with open(json_path, 'r') as f:
+        r = ujson.loads(f.read())
+    d = r.pop('dict')
+    rows = dict()
+    while d:
+        key, mapping = d.popitem()
+        rows[key.encode('utf-8', 'surrogatepass')] = sorted((ord(char), count) for char, count in mapping.items())
+    keys = sorted(rows)
+
+    def stream():
+        for key in keys:
+            yield key, rows[key], 0
+
+    write_snapshot(snapshot_path, order, r.get('journal', 0), stream)
+    return len(keys)
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'convert':
+        count = convert_json_snapshot(sys.argv[2], sys.argv[3])
+        print(f"Wrote {count} contexts to {sys.argv[3]}")
+    else:
+        print("Usage: snapshot.py convert <markov_dict.txt> <markov_dict.bin>")
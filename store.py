@@ -0,0 +1,261 @@
+import os
+import time
+import atexit
+import asyncio
+import sqlite3
+import datetime
+import threading
+import ujson
+from concurrent.futures import ThreadPoolExecutor
+from logger import BACKUP_STAMP, prune_backups
+
+class SettingsStore():
+    # Channel settings and the channel list in SQLite (WAL mode). Reads come
+    # from memory; a change only marks its channel dirty, and every change
+    # made within flush_delay goes to disk as one transaction on a worker
+    # thread, writing just the rows that changed. Backups are online copies
+    # through SQLite's backup API, taken at most once per backup_interval.
+    def __init__(self, path='data/aniv.db', backup_dir='data/backups', flush_delay=0.5, backup_interval=24 * 60 * 60, backups=14,
+            legacy_settings='data/channel_settings.json', legacy_channels='data/channels.json'):
+        self.__path = path
+        self.__backup_dir = backup_dir
+        self.__flush_delay = flush_delay
+        self.__backup_interval = backup_interval
+        self.__backups = backups
+        self.__lock = threading.Lock()
+        self.__worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='store')
+        self.__flush_handle = None
+        self.__flush_task = None
+        self.__flushing = 0
+        self.__pending_settings = dict()
+        self.__pending_channels = dict()
+        self.__stats = {
+            'commits': 0,
+            'rows_written': 0,
+            'coalesced': 0,
+            'backups': 0,
+            'errors': 0,
+        }
+
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        # WAL with synchronous=NORMAL can lose the last commits on power loss
+        # but never corrupts; settings are cheap to re-enter
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute('PRAGMA busy_timeout=5000')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS settings (channel TEXT PRIMARY KEY, post_min INTEGER NOT NULL, post_max INTEGER NOT NULL, translate TEXT NOT NULL)')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS channels (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL)')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.__migrate(legacy_settings, legacy_channels)
+        self.__last_backup = float(self.__meta('last_backup', 0))
+
+        self.__settings = dict()
+        for channel, post_min, post_max, translate in self.__db.execute('SELECT channel, post_min, post_max, translate FROM settings'):
+            self.__settings[channel] = {'post_min': post_min, 'post_max': post_max, 'translate': ujson.loads(translate)}
+        self.__channels = [name for name, in self.__db.execute('SELECT name FROM channels ORDER BY id')]
+        atexit.register(self.close)
+
+    def load_settings(self):
+        # the returned dict is the store's own; hand changes back through put_settings
+        return self.__settings
+
+    def get_channels(self):
+        return list(self.__channels)
+
+    def put_settings(self, channel, settings):
+        self.__settings[channel] = settings
+        self.__mark(self.__pending_settings, channel, settings)
+
+    def add_channel(self, channel):
+        if channel not in self.__channels:
+            self.__channels.append(channel)
+            self.__mark(self.__pending_channels, channel, True)
+
+    def remove_channel(self, channel):
+        if channel in self.__channels:
+            self.__channels.remove(channel)
+            self.__mark(self.__pending_channels, channel, False)
+
+    def reload(self):
+        # picks up what other processes sharing the database committed; our
+        # own changes not yet committed win. Returns the channels (added,
+        # removed), or nothing while a flush is in flight, since the database
+        # may not have its rows yet.
+        if self.__flushing:
+            return [], []
+        with self.__lock:
+            rows = self.__db.execute('SELECT channel, post_min, post_max, translate FROM settings').fetchall()
+            names = [name for name, in self.__db.execute('SELECT name FROM channels ORDER BY id')]
+        for channel, post_min, post_max, translate in rows:
+            settings = {'post_min': post_min, 'post_max': post_max, 'translate': ujson.loads(translate)}
+            if channel not in self.__pending_settings and self.__settings.get(channel) != settings:
+                self.__settings[channel] = settings
+        pending = self.__pending_channels
+        channels = [name for name in names if pending.get(name, True)]
+        channels.extend(name for name in self.__channels if pending.get(name) and name not in channels)
+        added = [name for name in channels if name not in self.__channels]
+        removed = [name for name in self.__channels if name not in channels]
+        self.__channels = channels
+        return added, removed
+
+    def has_pending(self):
+        return len(self.__pending_settings) > 0 or len(self.__pending_channels) > 0
+
+    def stats(self):
+        stats = dict(self.__stats)
+        stats['pending'] = len(self.__pending_settings) + len(self.__pending_channels)
+        return stats
+
+    async def flush(self):
+        # the worker runs commits one at a time in submission order, so a
+        # later flush can never be overwritten by an earlier one
+        if self.__flush_handle is not None:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+        if not self.has_pending():
+            return True
+        settings, channels = self.__take_pending()
+        self.__flushing += 1
+        try:
+            await asyncio.get_event_loop().run_in_executor(self.__worker, self.__commit, settings, channels)
+        except sqlite3.Error as e:
+            self.__restore_pending(settings, channels, e)
+            return False
+        finally:
+            self.__flushing -= 1
+        return True
+
+    def flush_sync(self):
+        if self.__flush_handle is not None:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+        if not self.has_pending():
+            return True
+        settings, channels = self.__take_pending()
+        try:
+            self.__commit(settings, channels)
+        except sqlite3.Error as e:
+            self.__restore_pending(settings, channels, e)
+            return False
+        return True
+
+    def backup(self):
+        with self.__lock:
+            self.__backup()
+
+    def close(self):
+        if self.__db is None:
+            return
+        self.__worker.shutdown(wait=True)
+        self.flush_sync()
+        with self.__lock:
+            self.__db.close()
+            self.__db = None
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __mark(self, pending, key, value):
+        if key in pending:
+            self.__stats['coalesced'] += 1
+        pending[key] = value
+        self.__schedule_flush()
+
+    def __schedule_flush(self):
+        if self.__flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop (REPL, scripts): write straight through
+            self.flush_sync()
+            return
+        self.__flush_handle = loop.call_later(self.__flush_delay, self.__start_flush)
+
+    def __start_flush(self):
+        self.__flush_handle = None
+        self.__flush_task = asyncio.ensure_future(self.flush())
+
+    def __take_pending(self):
+        settings = [(channel, s['post_min'], s['post_max'], ujson.dumps(s['translate'])) for channel, s in self.__pending_settings.items()]
+        channels = list(self.__pending_channels.items())
+        self.__pending_settings = dict()
+        self.__pending_channels = dict()
+        return settings, channels
+
+    def __restore_pending(self, settings, channels, error):
+        print("Exception occured while saving settings:", error)
+        self.__stats['errors'] += 1
+        # anything changed again since is newer than what failed
+        for channel, _, _, _ in settings:
+            if channel not in self.__pending_settings and channel in self.__settings:
+                self.__pending_settings[channel] = self.__settings[channel]
+        for channel, present in channels:
+            self.__pending_channels.setdefault(channel, present)
+        self.__schedule_flush()
+
+    def __commit(self, settings, channels):
+        with self.__lock:
+            db = self.__db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.executemany('INSERT OR REPLACE INTO settings (channel, post_min, post_max, translate) VALUES (?, ?, ?, ?)', settings)
+                db.executemany('INSERT OR IGNORE INTO channels (name) VALUES (?)', [(name,) for name, present in channels if present])
+                db.executemany('DELETE FROM channels WHERE name = ?', [(name,) for name, present in channels if not present])
+                db.execute('COMMIT')
+            except sqlite3.Error:
+                db.execute('ROLLBACK')
+                raise
+            self.__stats['commits'] += 1
+            self.__stats['rows_written'] += len(settings) + len(channels)
+            if time.time() - self.__last_backup >= self.__backup_interval:
+                try:
+                    self.__backup()
+                except (sqlite3.Error, OSError) as e:
+                    print("Exception occured while backing up settings:", e)
+                    self.__stats['errors'] += 1
+
+    def __backup(self):
+        os.makedirs(self.__backup_dir, exist_ok=True)
+        base = os.path.splitext(os.path.basename(self.__path))[0]
+        stamp = datetime.datetime.now().strftime(BACKUP_STAMP)
+        dest = os.path.join(self.__backup_dir, f'{base}.{stamp}.db')
+        target = sqlite3.connect(dest)
+        try:
+            self.__db.backup(target)
+        finally:
+            target.close()
+        self.__last_backup = time.time()
+        self.__db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('last_backup', str(self.__last_backup)))
+        self.__stats['backups'] += 1
+        prune_backups(self.__backup_dir, base + '.', '.db', self.__backups)
+
+    def __meta(self, key, default=None):
+        row = self.__db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def __migrate(self, legacy_settings, legacy_channels):
+        # one-time import of the JSON files this store replaces; they are
+        # left in place but no longer written
+        if self.__meta('migrated') is not None:
+            return
+        settings = dict()
+        channels = []
+        if legacy_settings and os.path.exists(legacy_settings):
+            with open(legacy_settings, 'r', encoding='utf-8') as f:
+                settings = ujson.load(f)
+        if legacy_channels and os.path.exists(legacy_channels):
+            with open(legacy_channels, 'r', encoding='utf-8') as f:
+                channels = ujson.load(f)['channels']
+        self.__db.execute('BEGIN IMMEDIATE')
+        try:
+            self.__db.executemany('INSERT OR REPLACE INTO settings (channel, post_min, post_max, translate) VALUES (?, ?, ?, ?)',
+                [(channel, s['post_min'], s['post_max'], ujson.dumps(s.get('translate', []))) for channel, s in settings.items()])
+            self.__db.executemany('INSERT OR IGNORE INTO channels (name) VALUES (?)', [(name,) for name in channels])
+            self.__db.execute('INSERT INTO meta (key, value) VALUES (?, ?)', ('migrated', str(time.time())))
+            self.__db.execute('COMMIT')
+        except sqlite3.Error:
+            self.__db.execute('ROLLBACK')
+            raise
+        if settings or channels:
+            print(f"Imported {len(settings)} channel settings and {len(channels)} channels into {self.__path}")
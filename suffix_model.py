@@ -0,0 +1,542 @@
+import os
+import sys
+import heapq
+import random
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Alternative model engine: keeps the learned text itself plus sorted runs of
+# suffix positions (a suffix array built incrementally, LSM-style). The next
+# character distribution for any context length is the set of characters that
+# follow its occurrences, so one structure answers every order and generation
+# can back off from order 10 to shorter contexts when the full one is unseen.
+#
+# Learned buffers are stored back to back, separated by SEPARATOR. As with
+# TransitionTable.learn, the first `order` characters of each buffer are only
+# context (the bot re-sends the previous buffer's tail), so occurrences whose
+# next character falls inside them are skipped.
+#
+# The text is kept in chunks of up to CHUNK_CHARS, so learning appends to the
+# last chunk instead of copying everything learned so far. Every chunk ends
+# with SEPARATOR, and a suffix's sort key stops at the end of its chunk;
+# keys reaching a SEPARATOR are ordered before it, so that changes no order.
+#
+# On disk the model is a small manifest listing files next to it: one per
+# text chunk (its buffer starts, then its utf-8 text) and one per saved run.
+# A compaction writes only the chunks and runs that changed since the last
+# one, and ages out the oldest text when the model is over its budget.
+#
+# version 1: one file holding the whole text, the starts and one merged run
+# version 2: the manifest; the header's last three fields are the next file
+#            serial and the number of chunk and run entries that follow
+
+SEPARATOR = '\0'
+MAGIC = b'ANIVSUFX'
+VERSION = 2
+HEADER = struct.Struct('<8sIIQQQQ')
+# (serial, offset) per chunk and (serial, length) per run in the manifest,
+# (starts, text bytes) at the head of a chunk file
+ENTRY = struct.Struct('<QQ')
+CHUNK_CHARS = 1 << 20
+# positions are 32-bit; once aging out has moved the oldest kept text past
+# this, a compaction renumbers everything from 0
+REBASE_AT = 1 << 31
+
+def suffix_key(chunks, offsets, k):
+    # position -> the k characters starting there, within its chunk
+    if len(chunks) == 1:
+        text = chunks[0]
+        base = offsets[0]
+        if base == 0:
+            return lambda p: text[p:p+k]
+        return lambda p: text[p-base:p-base+k]
+
+    def key(p):
+        c = bisect_right(offsets, p) - 1
+        p -= offsets[c]
+        return chunks[c][p:p+k]
+    return key
+
+class SuffixArrayModel():
+    def __init__(self, order, min_order=4, chunk_chars=CHUNK_CHARS):
+        self.__order = order
+        self.__min_order = min_order
+        self.__CHUNK_CHARS = chunk_chars
+        # text chunks, the position each starts at, and the file each was
+        # last saved in with how long it was then (None until first saved)
+        self.__chunks = []
+        self.__offsets = []
+        self.__chunk_files = []
+        self.__text_len = 0
+        self.__starts = array('Q')
+        # the first len(saved_runs) runs are saved, in the files listed there
+        self.__runs = []
+        self.__saved_runs = []
+        self.__next_serial = 1
+        self.__merge_floor = 0
+        self.__pending = []
+        self.__pending_len = 0
+        self.__INDEX_CHUNK = 16 * 1024
+        # merges of runs up to this many positions happen inline; bigger ones
+        # on a background thread, one at a time, swapped in once done
+        self.__MAX_INLINE_MERGE = 64 * 1024
+        self.__merger = ThreadPoolExecutor(1, 'suffix-merge')
+        self.__merging = None
+        self.__MAX_REJECTIONS = 16
+        # (order used, [(run, lo, hi), ...], total) per context; learning
+        # can add occurrences to any context, so the cache is cleared wholesale
+        self.__ranges = OrderedDict()
+        self.__MAX_RANGES = 1 << 14
+        self.backoffs = 0
+
+    def __contains__(self, ctx):
+        return self.__find(ctx) is not None
+
+    def get_order(self):
+        return self.__order
+
+    def learn(self, data):
+        data = data.replace(SEPARATOR, '')
+        if len(data) <= self.__order:
+            return
+        self.__pending.append(data)
+        self.__pending_len += len(data)
+        if self.__pending_len >= self.__INDEX_CHUNK:
+            self.index()
+
+    def index(self):
+        # make pending buffers searchable as a new run
+        self.__install_merge()
+        if not self.__pending:
+            return
+        start = self.__text_len
+        pieces = []
+        pos = start
+        for data in self.__pending:
+            self.__starts.append(pos)
+            pieces.append(data)
+            pieces.append(SEPARATOR)
+            pos += len(data) + 1
+        added = ''.join(pieces)
+        self.__pending = []
+        self.__pending_len = 0
+
+        # the last chunk grows until it is chunk_chars long, so each append
+        # copies at most that much
+        if self.__chunks and len(self.__chunks[-1]) + len(added) <= self.__CHUNK_CHARS:
+            self.__chunks[-1] = self.__chunks[-1] + added
+        else:
+            self.__chunks.append(added)
+            self.__offsets.append(start)
+            self.__chunk_files.append(None)
+        self.__text_len = pos
+
+        k = self.__order
+        chunk = self.__chunks[-1]
+        base = self.__offsets[-1]
+        positions = [i for i in range(start, pos) if chunk[i - base] != SEPARATOR]
+        positions.sort(key=lambda i: chunk[i - base:i - base + k])
+        self.__runs.append(array('I', positions))
+        self.__ranges.clear()
+        self.__merge_tail()
+
+    def counts(self, ctx):
+        found = self.__find(ctx)
+        if found is None:
+            return None
+        k, ranges, total = found
+        mapping = dict()
+        for p in self.__occurrences(ranges):
+            char = self.__next_char(p + k)
+            if char is not None:
+                mapping[char] = mapping.get(char, 0) + 1
+        return mapping or None
+
+    def step(self, ctx):
+        # returns (next char, next context), or (None, None) at a dead end
+        found = self.__find(ctx)
+        if found is None:
+            return None, None
+        k, ranges, total = found
+        for _ in range(self.__MAX_REJECTIONS):
+            char = self.__next_char(self.__pick(ranges, random.randrange(total)) + k)
+            if char is not None:
+                return char, ctx[1:] + char
+        # mostly overlaps or separators; fall back to the exact distribution
+        mapping = self.counts(ctx[-k:])
+        if not mapping:
+            return None, None
+        char = random.choices(list(mapping.keys()), list(mapping.values()))[0]
+        return char, ctx[1:] + char
+
+    def view(self):
+        # everything a compaction needs, safe to read from another thread:
+        # chunks are immutable strings and runs are replaced, never mutated
+        self.index()
+        # a background merge still running covers runs captured here; the
+        # compaction handles them anyway, so its result is dropped rather
+        # than installed next to the compaction's
+        if self.__merging is not None:
+            self.__merging[0].cancel()
+            self.__merging = None
+        self.__merge_floor = len(self.__runs)
+        return {
+            'text': self.__text_view(),
+            'chunk_files': tuple(self.__chunk_files),
+            'starts': self.__starts[:],
+            'runs': list(self.__runs),
+            'saved_runs': list(self.__saved_runs),
+            'next_serial': self.__next_serial,
+        }
+
+    def apply_compaction(self, view, result):
+        # installs what write_suffix_model saved; runs indexed since the view
+        # stay in memory until the next compaction
+        shift = result['shift']
+        later = [r for r in self.__runs if not any(r is x for x in view['runs'])]
+        if shift:
+            later = [array('I', (p - shift for p in run)) for run in later]
+            # a background merge of the old positions can't be installed
+            if self.__merging is not None:
+                self.__merging[0].cancel()
+                self.__merging = None
+        self.__runs = [run for serial, run in result['runs']] + later
+        self.__saved_runs = [serial for serial, run in result['runs']]
+        self.__merge_floor = len(self.__saved_runs)
+
+        # age out the text before the cut, which may fall inside a chunk
+        cut = result['cut']
+        keep = max(bisect_right(self.__offsets, cut) - 1, 0)
+        self.__chunks = self.__chunks[keep:]
+        self.__offsets = self.__offsets[keep:]
+        if self.__chunks and cut > self.__offsets[0]:
+            self.__chunks[0] = self.__chunks[0][cut - self.__offsets[0]:]
+            self.__offsets[0] = cut
+        self.__offsets = [offset - shift for offset in self.__offsets]
+        self.__chunk_files = [result['chunks'].get(offset) for offset in self.__offsets]
+        starts = self.__starts[bisect_left(self.__starts, cut):]
+        self.__starts = array('Q', (p - shift for p in starts)) if shift else starts
+        self.__text_len -= shift
+        self.__next_serial = result['next_serial']
+        self.__ranges.clear()
+        self.__install_merge()
+
+    def stats(self):
+        sa_bytes = sum(len(r) * r.itemsize for r in self.__runs)
+        text_bytes = sum(sys.getsizeof(chunk) for chunk in self.__chunks)
+        return {
+            'engine': 'suffix',
+            'text_chars': self.__text_len,
+            'text_chunks': len(self.__chunks),
+            'pending_chars': self.__pending_len,
+            'runs': len(self.__runs),
+            'saved_runs': len(self.__saved_runs),
+            'indexed_positions': sum(len(r) for r in self.__runs),
+            'merging': 1 if self.__merging is not None else 0,
+            'resident_bytes': text_bytes + sa_bytes + len(self.__starts) * self.__starts.itemsize,
+            'backoffs': self.backoffs,
+        }
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            magic, version, order, journal_segment, a, b, c = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version not in (1, VERSION):
+                raise ValueError(f"'{path}' is not a suffix model")
+            if order != self.__order:
+                raise ValueError(f"'{path}' was built for order {order}, not {self.__order}")
+            if version == 1:
+                # rewritten in the current layout by the next compaction
+                text_bytes, n_starts, n_positions = a, b, c
+                text = f.read(text_bytes).decode('utf-8', 'surrogatepass')
+                self.__chunks = [text] if text else []
+                self.__offsets = [0] if text else []
+                self.__chunk_files = [None] if text else []
+                self.__text_len = len(text)
+                self.__starts = array('Q')
+                self.__starts.fromfile(f, n_starts)
+                run = array('I')
+                run.fromfile(f, n_positions)
+                self.__runs = [run] if len(run) else []
+                self.__saved_runs = []
+            else:
+                self.__next_serial, n_chunks, n_runs = a, b, c
+                chunks = [ENTRY.unpack(f.read(ENTRY.size)) for _ in range(n_chunks)]
+                runs = [ENTRY.unpack(f.read(ENTRY.size)) for _ in range(n_runs)]
+                self.__load_chunks(path, chunks)
+                self.__runs = []
+                for serial, length in runs:
+                    run = array('I')
+                    with open(f'{path}.{serial}', 'rb') as rf:
+                        run.fromfile(rf, length)
+                    self.__runs.append(run)
+                self.__saved_runs = [serial for serial, length in runs]
+        self.__merge_floor = len(self.__saved_runs)
+        self.__merging = None
+        self.__ranges.clear()
+        return journal_segment
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __find(self, ctx):
+        # longest suffix of ctx (down to min_order) that has occurrences
+        cached = self.__ranges.get(ctx)
+        if cached is not None:
+            return cached
+        self.__install_merge()
+        found = None
+        for k in range(min(self.__order, len(ctx)), self.__min_order - 1, -1):
+            probe = ctx[-k:]
+            ranges = []
+            total = 0
+            key = suffix_key(self.__chunks, self.__offsets, k)
+            for run in self.__runs:
+                lo = bisect_left(run, probe, key=key)
+                hi = bisect_right(run, probe, lo=lo, key=key)
+                if hi > lo:
+                    ranges.append((run, lo, hi))
+                    total += hi - lo
+            if total > 0:
+                if k < self.__order:
+                    self.backoffs += 1
+                found = (k, ranges, total)
+                break
+        if found is None:
+            return None
+        if len(self.__ranges) >= self.__MAX_RANGES:
+            self.__ranges.popitem(last=False)
+        self.__ranges[ctx] = found
+        return found
+
+    def __pick(self, ranges, r):
+        for run, lo, hi in ranges:
+            if r < hi - lo:
+                return run[lo + r]
+            r -= hi - lo
+
+    def __occurrences(self, ranges):
+        for run, lo, hi in ranges:
+            for i in range(lo, hi):
+                yield run[i]
+
+    def __text_view(self):
+        return tuple(self.__chunks), tuple(self.__offsets)
+
+    def __load_chunks(self, path, chunks):
+        self.__chunks = []
+        self.__offsets = []
+        self.__chunk_files = []
+        self.__starts = array('Q')
+        for serial, offset in chunks:
+            with open(f'{path}.{serial}', 'rb') as f:
+                n_starts, text_bytes = ENTRY.unpack(f.read(ENTRY.size))
+                starts = array('I')
+                starts.fromfile(f, n_starts)
+                text = f.read(text_bytes).decode('utf-8', 'surrogatepass')
+            self.__starts.extend(offset + p for p in starts)
+            self.__chunks.append(text)
+            self.__offsets.append(offset)
+            self.__chunk_files.append((serial, len(text)))
+        self.__text_len = self.__offsets[-1] + len(self.__chunks[-1]) if self.__chunks else 0
+
+    def __tail_floor(self):
+        # runs before this are saved, being compacted or merged in the
+        # background
+        floor = self.__merge_floor
+        if self.__merging is not None:
+            last = self.__merging[1][-1]
+            for i, run in enumerate(self.__runs):
+                if run is last:
+                    floor = max(floor, i + 1)
+                    break
+        return floor
+
+    def __merge_tail(self):
+        # merge equal-sized neighbours so lookups only ever visit O(log n)
+        # runs; the model's thread only merges small runs itself
+        while True:
+            runs = self.__runs
+            # rightmost run at least half as big as the one before it
+            i = len(runs) - 1
+            floor = self.__tail_floor()
+            while i > floor and len(runs[i]) * 2 < len(runs[i - 1]):
+                i -= 1
+            if i <= floor:
+                return
+            if len(runs[i - 1]) <= self.__MAX_INLINE_MERGE:
+                self.__runs = runs[:i - 1] + [merge_runs(self.__text_view(), self.__order, runs[i - 1:i + 1])] + runs[i + 1:]
+            elif self.__merging is None:
+                # everything from there on goes in one background merge
+                group = runs[i - 1:]
+                future = self.__merger.submit(merge_runs, self.__text_view(), self.__order, group)
+                self.__merging = (future, group)
+            else:
+                return
+
+    def __install_merge(self):
+        # swaps in a finished background merge on the model's own thread,
+        # unless compaction has replaced its runs meanwhile (view() drops
+        # merges that are still running when it is called)
+        if self.__merging is None or not self.__merging[0].done():
+            return
+        future, group = self.__merging
+        self.__merging = None
+        merged = future.result()
+        runs = self.__runs
+        n = len(group)
+        for i in range(len(runs) - n + 1):
+            if all(runs[i + j] is run for j, run in enumerate(group)):
+                self.__runs = runs[:i] + [merged] + runs[i + n:]
+                self.__ranges.clear()
+                # the merged run may now pair up with its neighbours
+                self.__merge_tail()
+                return
+
+    def __next_char(self, pos):
+        # None if pos is a separator or inside the context-only head of a buffer
+        if pos >= self.__text_len:
+            return None
+        c = bisect_right(self.__offsets, pos) - 1
+        char = self.__chunks[c][pos - self.__offsets[c]]
+        if char == SEPARATOR:
+            return None
+        start = self.__starts[bisect_right(self.__starts, pos) - 1]
+        if pos - start < self.__order:
+            return None
+        return char
+
+def merge_runs(text, order, runs):
+    # text is the (chunks, offsets) view the runs were built over
+    merged = array('I')
+    merged.extend(heapq.merge(*runs, key=suffix_key(*text, order)))
+    return merged
+
+def write_suffix_model(path, order, journal_segment, view, max_bytes=None):
+    # Saves a compaction's view next to path and returns what
+    # apply_compaction installs. The runs indexed since the last compaction
+    # are merged into one, which also takes in the saved runs before it that
+    # are no more than twice its size, so at most O(log n) runs are saved.
+    # Only chunks and runs that changed get written. With max_bytes, the
+    # oldest chunks are aged out until the model is estimated to fit.
+    chunks, offsets = view['text']
+    serial = view['next_serial']
+    runs = view['runs']
+    saved = list(zip(view['saved_runs'], runs))
+    old_files = set(view['saved_runs']) | {saved[0] for saved in view['chunk_files'] if saved is not None}
+    changed = runs[len(saved):]
+    if changed:
+        merged = merge_runs(view['text'], order, changed) if len(changed) > 1 else changed[0]
+        while saved and len(merged) * 2 >= len(saved[-1][1]):
+            merged = merge_runs(view['text'], order, [saved.pop()[1], merged])
+        saved.append((None, merged))
+
+    # estimated resident bytes per chunk: its text, about one 4-byte
+    # position per character and its buffer starts
+    starts = view['starts']
+    ends = list(offsets[1:]) + [offsets[-1] + len(chunks[-1])] if chunks else []
+    sizes = [sys.getsizeof(chunk) + 4 * len(chunk) + 8 * (bisect_left(starts, end) - bisect_left(starts, offset))
+             for chunk, offset, end in zip(chunks, offsets, ends)]
+    # the oldest chunks go whole, then the first one kept loses about the
+    # excess from its head, cut at a buffer start; the newest buffer stays
+    keep = 0
+    cut = offsets[0] if chunks else 0
+    if max_bytes is not None and chunks:
+        total = sum(sizes)
+        while keep < len(chunks) - 1 and total - sizes[keep] > max_bytes:
+            total -= sizes[keep]
+            keep += 1
+        cut = offsets[keep]
+        if total > max_bytes:
+            drop = (total - max_bytes) * len(chunks[keep]) // sizes[keep]
+            i = bisect_left(starts, offsets[keep] + drop)
+            if i < len(starts) and starts[i] < ends[keep]:
+                cut = starts[i]
+            elif keep < len(chunks) - 1:
+                keep += 1
+                cut = offsets[keep]
+            else:
+                cut = starts[-1]
+    evicted_chars = cut - offsets[0] if chunks else 0
+    shift = cut if cut >= REBASE_AT else 0
+
+    runs = []
+    for run_serial, run in saved:
+        if min(run) < cut:
+            run = array('I', (p - shift for p in run if p >= cut))
+            run_serial = None
+        elif shift:
+            run = array('I', (p - shift for p in run))
+            run_serial = None
+        if len(run):
+            runs.append((run_serial, run))
+
+    # new files first, then the manifest that points at them, then the
+    # files nothing points at any more
+    saved_chunks = {}
+    chunk_entries = []
+    for i in range(keep, len(chunks)):
+        offset = max(offsets[i], cut)
+        saved_chunk = view['chunk_files'][i]
+        # the last chunk grows after it is first saved, and the first one
+        # kept may have lost its head
+        if saved_chunk is not None and saved_chunk[1] == len(chunks[i]) and offset == offsets[i]:
+            chunk_serial = saved_chunk[0]
+            length = saved_chunk[1]
+        else:
+            chunk_serial = serial
+            serial += 1
+            lo = bisect_left(starts, offset)
+            hi = bisect_left(starts, ends[i])
+            chunk_starts = array('I', (p - offset for p in starts[lo:hi]))
+            text = chunks[i][offset - offsets[i]:]
+            length = len(text)
+            encoded = text.encode('utf-8', 'surrogatepass')
+            with open(f'{path}.{chunk_serial}', 'wb') as f:
+                f.write(ENTRY.pack(len(chunk_starts), len(encoded)))
+                chunk_starts.tofile(f)
+                f.write(encoded)
+                f.flush()
+                os.fsync(f.fileno())
+        saved_chunks[offset - shift] = (chunk_serial, length)
+        chunk_entries.append((chunk_serial, offset - shift))
+    written_runs = 0
+    for i, (run_serial, run) in enumerate(runs):
+        if run_serial is None:
+            written_runs += 1
+            run_serial = serial
+            serial += 1
+            with open(f'{path}.{run_serial}', 'wb') as f:
+                run.tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            runs[i] = (run_serial, run)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, order, journal_segment, serial, len(chunk_entries), len(runs)))
+        for entry in chunk_entries:
+            f.write(ENTRY.pack(*entry))
+        for run_serial, run in runs:
+            f.write(ENTRY.pack(run_serial, len(run)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    live = {s for s, offset in chunk_entries} | {s for s, run in runs}
+    for old in old_files - live:
+        try:
+            os.remove(f'{path}.{old}')
+        except FileNotFoundError:
+            pass
+
+    return {
+        'runs': runs,
+        'chunks': saved_chunks,
+        'cut': cut,
+        'shift': shift,
+        'next_serial': serial,
+        'evicted_chars': evicted_chars,
+        'written_runs': written_runs,
+    }
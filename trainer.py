@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+import heapq
+import shutil
+import tempfile
+import ujson
+from collections import Counter
+from multiprocessing import Pool
+from filters import ContentFilter
+from snapshot import Snapshot, write_snapshot
+
+# Offline training over archived chat logs. Log files are split into byte
+# ranges, each range is filtered and counted in a worker process into its own
+# sorted partial snapshot, and the partials are k-way merged into the model.
+#
+# Each log line is one of:
+#   {"channel": ..., "user": ..., "message": ...}   (JSON lines)
+#   channel<TAB>user<TAB>message
+#   message                                         (no channel/user)
+
+ORDER = 10
+CHUNK_SIZE = 4 * 1024 * 1024
+
+_filter = None
+_order = ORDER
+
+def parse_log_line(line):
+    line = line.rstrip('\r\n')
+    if line.startswith('{'):
+        try:
+            entry = ujson.loads(line)
+            return entry.get('channel', ''), entry.get('user', ''), entry.get('message', '')
+        except ValueError:
+            pass
+    parts = line.split('\t', 2)
+    if len(parts) == 3:
+        return parts[0], parts[1], parts[2]
+    return '', '', line
+
+def split_chunks(paths, chunk_size=CHUNK_SIZE):
+    # byte ranges whose boundaries are moved forward to the next newline
+    chunks = []
+    for path in paths:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            start = 0
+            while start < size:
+                end = min(start + chunk_size, size)
+                if end < size:
+                    f.seek(end)
+                    f.readline()
+                    end = f.tell()
+                chunks.append((path, start, end))
+                start = end
+    return chunks
+
+def _init_worker(order):
+    global _filter, _order
+    _order = order
+    _filter = ContentFilter()
+
+def _count_chunk(task):
+    path, start, end, out_path = task
+    streams = dict()
+    lines = 0
+    learned = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start).decode('utf-8', 'replace')
+    for line in data.splitlines():
+        channel, user, message = parse_log_line(line)
+        lines += 1
+        if message and _filter.is_safe_to_learn(channel, user, message):
+            streams.setdefault(channel, []).append(message + '\n')
+            learned += 1
+
+    # count (context + next char) grams; like live learning, transitions never
+    # cross from one channel into another
+    counts = Counter()
+    for messages in streams.values():
+        data = ''.join(messages)
+        counts.update(data[i:i+_order+1] for i in range(len(data) - _order))
+    # code point order matches the snapshot's utf-8 byte order
+    grams = sorted(counts)
+
+    def stream():
+        current = None
+        row = []
+        for gram in grams:
+            ctx = gram[:-1]
+            if ctx != current:
+                if current is not None:
+                    yield current.encode('utf-8', 'surrogatepass'), row, 0
+                current = ctx
+                row = []
+            row.append((ord(gram[-1]), counts[gram]))
+        if current is not None:
+            yield current.encode('utf-8', 'surrogatepass'), row, 0
+
+    write_snapshot(out_path, _order, 0, stream)
+    return out_path, lines, learned, end - start
+
+def merge_snapshots(snapshots):
+    # sum the rows of several sorted snapshots in a single streaming pass,
+    # keeping the most recent last-used epoch of each context
+    def stream():
+        merged = heapq.merge(*(s.raw_items() for s in snapshots), key=lambda row: row[0])
+        current = None
+        edges = None
+        epoch = 0
+        for key, row, last_used in merged:
+            if key != current:
+                if current is not None:
+                    yield current, sorted(edges.items()), epoch
+                current = key
+                edges = dict()
+                epoch = 0
+            for code, count in row:
+                edges[code] = edges.get(code, 0) + count
+            epoch = max(epoch, last_used)
+        if current is not None:
+            yield current, sorted(edges.items()), epoch
+    return stream
+
+def train(paths, out_path='markov_dict.bin', workers=None, order=ORDER, chunk_size=CHUNK_SIZE):
+    t = time.perf_counter()
+    workers = workers or os.cpu_count()
+    chunks = split_chunks(paths, chunk_size)
+    total_bytes = sum(end - start for _, start, end in chunks)
+    print(f"Training on {len(paths)} file(s), {total_bytes} bytes in {len(chunks)} chunk(s) with {workers} worker(s)")
+
+    tmp_dir = tempfile.mkdtemp(prefix='train_', dir=os.path.dirname(os.path.abspath(out_path)))
+    try:
+        tasks = [(path, start, end, os.path.join(tmp_dir, f'part{i}.bin')) for i, (path, start, end) in enumerate(chunks)]
+        partials = []
+        lines = 0
+        learned = 0
+        done_bytes = 0
+        with Pool(workers, initializer=_init_worker, initargs=(order,)) as pool:
+            for part, part_lines, part_learned, part_bytes in pool.imap_unordered(_count_chunk, tasks):
+                partials.append(part)
+                lines += part_lines
+                learned += part_learned
+                done_bytes += part_bytes
+                print(f"  {done_bytes}/{total_bytes} bytes, {learned}/{lines} lines learned")
+        count_time = time.perf_counter() - t
+
+        # training adds to an existing model, keeping its journal position
+        snapshots = [Snapshot(part) for part in partials]
+        journal_segment = 0
+        epoch = 0
+        decayed_at = 0
+        if os.path.exists(out_path):
+            existing = Snapshot(out_path)
+            journal_segment = existing.get_journal_segment()
+            epoch = existing.get_epoch()
+            decayed_at = existing.get_decayed_at()
+            snapshots.append(existing)
+        write_snapshot(out_path, order, journal_segment, merge_snapshots(snapshots), epoch, decayed_at)
+        for s in snapshots:
+            s.close()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    elapsed = time.perf_counter() - t
+    print(f"Counted in {count_time:.1f}s ({total_bytes / max(count_time, 1e-9) / 1e6:.1f} MB/s), wrote {out_path} in {elapsed:.1f}s total")
+    return {'lines': lines, 'learned': learned, 'bytes': total_bytes, 'count_seconds': count_time, 'seconds': elapsed}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: trainer.py <log file> [log file ...]")
+        sys.exit(1)
+    train(sys.argv[1:])
@@ -0,0 +1,233 @@
+from array import array
+
+class TransitionTable():
+    # Compact replacement for a dict of {context: {char: count}}. Contexts are
+    # interned to integer ids through an open-addressing hash table, their text
+    # lives in one packed utf-8 blob, and next-character counts are kept in
+    # parallel edge arrays chained per context.
+    #
+    # That costs ingest speed: bench.py backoff learns about 285k chars/s
+    # into a table against 880k into the dict, for a sixth of the memory
+    # (22.6 MB against 136.6 MB). Chat arrives far slower than either, and
+    # learning runs off the event loop, so the table trades the right way.
+    def __init__(self, order):
+        self.__order = order
+        self.__capacity = 1024
+        self.__slots = array('i', [-1]) * self.__capacity
+        self.__fingerprints = array('I')
+        self.__text = bytearray()
+        self.__text_offsets = array('I', [0])
+        self.__heads = array('i')
+        self.__edge_chars = array('I')
+        # signed: unlearning subtracts from counts held by lower layers
+        self.__edge_counts = array('i')
+        self.__edge_next = array('i')
+
+    def __len__(self):
+        return len(self.__heads)
+
+    def __contains__(self, ctx):
+        return self.lookup(ctx) >= 0
+
+    def get_order(self):
+        return self.__order
+
+    def lookup(self, ctx):
+        h = hash(ctx)
+        fp = (h >> 32) & 0xffffffff
+        key = None
+        mask = self.__capacity - 1
+        i = h & mask
+        slots = self.__slots
+        while True:
+            cid = slots[i]
+            if cid < 0:
+                return -1
+            if self.__fingerprints[cid] == fp:
+                if key is None:
+                    key = ctx.encode('utf-8', 'surrogatepass')
+                if self.__text[self.__text_offsets[cid]:self.__text_offsets[cid + 1]] == key:
+                    return cid
+            i = (i + 1) & mask
+
+    def intern(self, ctx):
+        h = hash(ctx)
+        fp = (h >> 32) & 0xffffffff
+        key = ctx.encode('utf-8', 'surrogatepass')
+        mask = self.__capacity - 1
+        i = h & mask
+        slots = self.__slots
+        while True:
+            cid = slots[i]
+            if cid < 0:
+                break
+            if self.__fingerprints[cid] == fp and self.__text[self.__text_offsets[cid]:self.__text_offsets[cid + 1]] == key:
+                return cid
+            i = (i + 1) & mask
+
+        cid = len(self.__heads)
+        slots[i] = cid
+        self.__fingerprints.append(fp)
+        self.__text += key
+        self.__text_offsets.append(len(self.__text))
+        self.__heads.append(-1)
+        if (cid + 1) * 3 > self.__capacity * 2:
+            self.__grow()
+        return cid
+
+    def add(self, ctx, char, delta=1):
+        self.add_by_id(self.intern(ctx), ord(char), delta)
+
+    def add_by_id(self, cid, code, delta=1):
+        e = self.__heads[cid]
+        while e >= 0:
+            if self.__edge_chars[e] == code:
+                self.__edge_counts[e] += delta
+                return
+            e = self.__edge_next[e]
+        self.__edge_chars.append(code)
+        self.__edge_counts.append(delta)
+        self.__edge_next.append(self.__heads[cid])
+        self.__heads[cid] = len(self.__edge_chars) - 1
+
+    def learn(self, data):
+        # intern() and add_by_id() inlined, with the arrays held in locals
+        order = self.__order
+        fingerprints = self.__fingerprints
+        text = self.__text
+        text_offsets = self.__text_offsets
+        heads = self.__heads
+        edge_chars = self.__edge_chars
+        edge_counts = self.__edge_counts
+        edge_next = self.__edge_next
+        slots = self.__slots
+        mask = self.__capacity - 1
+        grow_at = self.__capacity * 2 // 3
+        for i in range(len(data) - order):
+            ctx = data[i:i+order]
+            code = ord(data[i+order])
+            h = hash(ctx)
+            fp = (h >> 32) & 0xffffffff
+            key = None
+            j = h & mask
+            while True:
+                cid = slots[j]
+                if cid < 0:
+                    break
+                if fingerprints[cid] == fp:
+                    if key is None:
+                        key = ctx.encode('utf-8', 'surrogatepass')
+                    if text[text_offsets[cid]:text_offsets[cid + 1]] == key:
+                        break
+                j = (j + 1) & mask
+
+            if cid < 0:
+                # a new context: its first edge
+                cid = len(heads)
+                slots[j] = cid
+                fingerprints.append(fp)
+                text += key if key is not None else ctx.encode('utf-8', 'surrogatepass')
+                text_offsets.append(len(text))
+                heads.append(len(edge_chars))
+                edge_chars.append(code)
+                edge_counts.append(1)
+                edge_next.append(-1)
+                if cid + 1 > grow_at:
+                    self.__grow()
+                    slots = self.__slots
+                    mask = self.__capacity - 1
+                    grow_at = self.__capacity * 2 // 3
+                continue
+
+            e = heads[cid]
+            while e >= 0:
+                if edge_chars[e] == code:
+                    edge_counts[e] += 1
+                    break
+                e = edge_next[e]
+            else:
+                edge_chars.append(code)
+                edge_counts.append(1)
+                edge_next.append(heads[cid])
+                heads[cid] = len(edge_chars) - 1
+
+    def context(self, cid):
+        return self.__text[self.__text_offsets[cid]:self.__text_offsets[cid + 1]].decode('utf-8', 'surrogatepass')
+
+    def edges(self, cid):
+        e = self.__heads[cid]
+        while e >= 0:
+            yield chr(self.__edge_chars[e]), self.__edge_counts[e]
+            e = self.__edge_next[e]
+
+    def edge_list(self, cid):
+        # edges() as a list, without resuming a generator per edge
+        chars = self.__edge_chars
+        counts = self.__edge_counts
+        nxt = self.__edge_next
+        out = []
+        e = self.__heads[cid]
+        while e >= 0:
+            out.append((chr(chars[e]), counts[e]))
+            e = nxt[e]
+        return out
+
+    def cumulative(self, cid):
+        # ([code, ...], [running total, ...]) over the edges with positive
+        # counts, in one walk of the chain
+        chars = self.__edge_chars
+        counts = self.__edge_counts
+        nxt = self.__edge_next
+        codes = []
+        cum = []
+        total = 0
+        e = self.__heads[cid]
+        while e >= 0:
+            count = counts[e]
+            if count > 0:
+                total += count
+                codes.append(chars[e])
+                cum.append(total)
+            e = nxt[e]
+        return codes, cum
+
+    def counts(self, ctx):
+        cid = self.lookup(ctx)
+        if cid < 0:
+            return None
+        return dict(self.edges(cid))
+
+    def items(self):
+        for cid in range(len(self.__heads)):
+            yield self.context(cid), dict(self.edges(cid))
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (
+            self.__slots,
+            self.__fingerprints,
+            self.__text_offsets,
+            self.__heads,
+            self.__edge_chars,
+            self.__edge_counts,
+            self.__edge_next,
+        )) + len(self.__text)
+
+    def bytes_per_context(self):
+        if len(self) == 0:
+            return 0.0
+        return self.nbytes() / len(self)
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __grow(self):
+        self.__capacity *= 2
+        mask = self.__capacity - 1
+        slots = array('i', [-1]) * self.__capacity
+        # only a 32-bit fingerprint is kept per context, so rehash from the text
+        for cid in range(len(self.__heads)):
+            i = hash(self.context(cid)) & mask
+            while slots[i] >= 0:
+                i = (i + 1) & mask
+            slots[i] = cid
+        self.__slots = slots
@@ -0,0 +1,141 @@
+import inspect
+import asyncio
+from collections import OrderedDict
+
+class GoogleTranslateBackend():
+    # googletrans 4 is asyncio-native: detect and translate are coroutines on
+    # one shared client, awaited on the bot's own loop. Older releases are
+    # blocking and are run on the loop's default executor instead.
+    def __init__(self):
+        from googletrans import Translator
+        self.__translator_class = Translator
+        self.__translator = None
+
+    async def detect(self, text):
+        return (await self.__call('detect', text)).lang
+
+    async def translate(self, text, dest):
+        return (await self.__call('translate', text, dest)).text
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    async def __call(self, name, *args):
+        # the client is created on first use, inside the loop it belongs to
+        if self.__translator is None:
+            self.__translator = self.__translator_class()
+        method = getattr(self.__translator, name)
+        if inspect.iscoroutinefunction(method):
+            return await method(*args)
+        return await asyncio.get_event_loop().run_in_executor(None, method, *args)
+
+class StubTranslateBackend():
+    # Local stand-in for tests and benchmarks: tags the text with the target
+    # language after an optional artificial delay.
+    def __init__(self, source_lang='en', delay=0.0):
+        self.__source_lang = source_lang
+        self.__delay = delay
+        self.detect_calls = 0
+        self.translate_calls = 0
+
+    async def detect(self, text):
+        self.detect_calls += 1
+        await asyncio.sleep(self.__delay)
+        return self.__source_lang
+
+    async def translate(self, text, dest):
+        self.translate_calls += 1
+        await asyncio.sleep(self.__delay)
+        return f'[{dest}] {text}'
+
+class AsyncTranslator():
+    # workers backend calls run at once; up to max_pending more wait for a
+    # slot, and past that a new text is sent untranslated rather than queued
+    def __init__(self, backend, workers=4, cache_size=4096, timeout=4.0, max_pending=64):
+        self.__backend = backend
+        self.__workers = workers
+        self.__slots = None
+        self.__timeout = timeout
+        self.__MAX_PENDING = max_pending
+        self.__CACHE_SIZE = cache_size
+        self.__translations = OrderedDict()
+        self.__source_langs = OrderedDict()
+        self.__in_flight = dict()
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.errors = 0
+
+    async def translate(self, text, dest):
+        # returns the untranslated text if the backend fails, is too slow or
+        # already has too much waiting
+        key = (text, dest)
+        cached = self.__translations.get(key)
+        if cached is not None:
+            self.__translations.move_to_end(key)
+            self.hits += 1
+            return cached
+        self.misses += 1
+
+        # identical concurrent requests share one backend call
+        task = self.__in_flight.get(key)
+        if task is None:
+            if len(self.__in_flight) >= self.__workers + self.__MAX_PENDING:
+                self.rejected += 1
+                return text
+            if self.__slots is None:
+                self.__slots = asyncio.Semaphore(self.__workers)
+            task = asyncio.ensure_future(self.__translate_backend(text, dest, self.__source_langs.get(text)))
+            self.__in_flight[key] = task
+            task.add_done_callback(lambda t: self.__finished(key, t))
+
+        try:
+            return (await asyncio.wait_for(asyncio.shield(task), self.__timeout))[1]
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return text
+        except Exception as e:
+            print("Exception occured during translation:", e)
+            return text
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'pending': len(self.__in_flight),
+            'cached': len(self.__translations),
+        }
+
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    async def __translate_backend(self, text, dest, source_lang):
+        async with self.__slots:
+            if source_lang is None:
+                source_lang = await self.__backend.detect(text)
+            if source_lang == dest:
+                return source_lang, text
+            return source_lang, await self.__backend.translate(text, dest)
+
+    def __finished(self, key, task):
+        # runs even when every waiter timed out, so a slow result still lands
+        # in the cache for next time
+        self.__in_flight.pop(key, None)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self.errors += 1
+            return
+        source_lang, translated = task.result()
+        self.__remember(self.__source_langs, key[0], source_lang)
+        self.__remember(self.__translations, key, translated)
+
+    def __remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > self.__CACHE_SIZE:
+            cache.popitem(last=False)